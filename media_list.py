@@ -10,29 +10,108 @@
         """complex filenames, and create playlist files for playback."""
 import os
 import re
-
-__all__ = ['makeplaylist', 'sortfiles', 'getseqnum', 'mkpls', 'mkm3u']
+import sys
+import json
+import time
+import zlib
+import struct
+import sqlite3
+import hashlib
+import tempfile
+import collections
+import itertools
+import threading
+import Queue
+
+__all__ = ['makeplaylist', 'treeplaylist', 'Catalog', 'ismedia', 'duration',
+        'duplicates', 'verify', 'getcrc', 'sortfiles', 'sortentries',
+        'getkey', 'getkeys',
+        'getseqnum', 'getseqnums', 'mkpls', 'mkm3u']
 __author__ = 'Dylan Steinmetz <dtsteinm@gmail.com>'
 __version__ = '0.2.2'
 __license__ = 'WTFPL'
 
+# Where makeplaylist() remembers what it has written, in start_dir.
+MANIFEST = '.media_list.json'
+
+# Where the lengths of media files are kept for extended playlists, in
+# start_dir.
+DURATIONS = '.media_list.durations.json'
+
+# Where a Catalog of the tree is kept, in start_dir.
+CATALOG = '.media_list.sqlite'
+
+# Where verify() keeps the CRC32s of the files it has read, in start_dir.
+CHECKSUMS = '.media_list.crc32.json'
+
+# Where duplicates() keeps the hashes of the files it has compared, in
+# start_dir.
+HASHES = '.media_list.sha1.json'
+
+# File extensions known to hold media, and those known not to; files
+# with any other extension (or none) are sniffed by ismedia().
+MEDIA_EXTS = frozenset(['.mkv', '.mka', '.webm', '.avi', '.wmv', '.wma',
+    '.asf', '.mp4', '.m4v', '.m4a', '.mov', '.mpg', '.mpeg', '.ts', '.mp3',
+    '.mp2', '.aac', '.flac', '.ogg', '.ogv', '.oga', '.opus', '.wav'])
+OTHER_EXTS = frozenset(['.jpg', '.jpeg', '.png', '.gif', '.bmp', '.txt',
+    '.nfo', '.srt', '.ass', '.ssa', '.sub', '.idx', '.sup', '.vtt', '.cue',
+    '.log', '.sfv', '.md5', '.sha1', '.par2', '.url', '.pdf', '.db', '.ini',
+    '.xml', '.json', '.torrent', '.pls', '.m3u', '.m3u8', '.webp'])
+
 
 # TODO: Make playlist_type selection clearer.
 # TODO: Add a 'depth' option, or something along those lines.
-def makeplaylist(start_dir=os.getcwd(), playlist_type='pls'):
+def makeplaylist(start_dir=os.getcwd(), playlist_type='pls',
+        manifest=MANIFEST, jobs=1, extended=False, dedupe=False):
     """Create media playlist(s) for specified directory and playlist """\
             """type.
 
     Attributes:
         start_dir -- directory from which to start; if None, prompt user?
         playlist_type -- type of playlist to create; 'pls' and/or 'm3u'
+        manifest -- name of the file in start_dir remembering what each
+                    directory held when its playlists were written, or
+                    None to write every playlist afresh
+        jobs -- number of directories to sort and write at once
+        extended -- give each entry its length, which means reading
+                    the headers of files we haven't seen before
+        dedupe -- leave out all but the first copy of files found more
+                  than once in the tree, as duplicates() finds them
+
+    Directories whose listing hasn't changed since their playlists were
+    written are left alone, and those that have are written again. A
+    playlist we didn't write ourselves is never replaced.
+
+    The tree is listed in one thread while up to jobs others sort and
+    write playlists, which keeps slow (network) storage busy. Whatever
+    jobs is, the playlists, messages and manifest come out the same.
+
+    Entries are absolute paths, so a playlist works from its own
+    directory even when start_dir was given relative to ours:
+
+    >>> import shutil
+    >>> tree, cwd = tempfile.mkdtemp(), os.getcwd()
+    >>> os.makedirs(os.path.join(tree, 'lib', 'Show'))
+    >>> open(os.path.join(tree, 'lib', 'Show', 'ep01.mkv'), 'w').close()
+    >>> os.chdir(tree)
+    >>> makeplaylist('lib', 'm3u', manifest=None)
+    >>> path = open(os.path.join('lib', 'Show', 'Show.m3u')).read().split()[-1]
+    >>> os.path.isabs(path), os.path.isfile(path)
+    (True, True)
+    >>> os.chdir(cwd); shutil.rmtree(tree)
 
     Example: media_list.makeplaylist('/path/to/media', """ \
             """playlist_type=['pls','m3u'])
     """
 
-    # Clean up user input
-    start_dir = os.path.expanduser(start_dir.strip())
+    # Clean up user input. Absolute path to files, so playlists written
+    # inside the tree don't depend on where we were run from.
+    start_dir = os.path.abspath(os.path.expanduser(start_dir.strip()))
+
+    manifest_ = None
+    durations = None
+    hashes = None
+    finished = False
 
     try:
         if os.path.isdir(start_dir) is False:
@@ -47,66 +126,296 @@ def makeplaylist(start_dir=os.getcwd(), playlist_type='pls'):
         # TODO: There _has_ to be a better way to do this.
         # Check to see if playlist_type was passed as a string or list
         # and set the appropriate flag in either case. Also clean up input.
-        if type(playlist_type) is str:
-            playlist_type.strip()
-            if playlist_type is 'pls':
+        if isinstance(playlist_type, basestring):
+            playlist_type = playlist_type.strip()
+            if playlist_type == 'pls':
                 PLS = True
-            if playlist_type is 'm3u':
+            if playlist_type == 'm3u':
                 M3U = True
         elif type(playlist_type) is list:
             for type_ in playlist_type:
-                type_.strip()
-                if type_ is 'pls':
+                type_ = type_.strip()
+                if type_ == 'pls':
                     PLS = True
-                if type_ is 'm3u':
+                if type_ == 'm3u':
                     M3U = True
         # Default to a PLS file if no valid filetype was specified.
         else:
             PLS = True
 
-        # Anonymous function to check for dotfiles
-        dot_check = lambda name: re.match(r'^\..*$', name)
-
-        # List of known media file extensions for later use.
-        # media_exts = ['mkv', 'avi', 'wmv', 'mp4', 'mp3', 'flac', 'ogg']
-
-        # Start in startdir, and create a pls and/or m3u playlist
-        # file for directories containing valid media files. Send the
-        # current basedir and the list returned from sortedfiles()
-        # for the creation of playlist files with absolute paths.
-        for basedir, pathnames, files in os.walk(start_dir):
-            # Skip hidden directories (pathnames) and files in current basedir
-            for pathname in pathnames:
-                if dot_check(pathname):
-                    pathnames.remove(pathname)
-            for file_ in files:
-                if dot_check(file_):
-                    files.remove(file_)
-            # TODO: throw some checking in here to only make a playlist
-            #       if basedir contains media files (mkv, avi, mp3, etc.)
-            if PLS:
-                mkpls(basedir, sortfiles(files))
-            if M3U:
-                mkm3u(basedir, sortfiles(files))
-
-        # End of os.walk() for loop
+        if manifest is not None:
+            manifest_ = Manifest(os.path.join(start_dir, manifest), start_dir)
+        if extended:
+            durations = Durations(os.path.join(start_dir, DURATIONS))
+
+        # Copies to leave out. They're left out of the listing the
+        # manifest sees too, so a directory whose copies change is
+        # written again. Which files are copies is only known once the
+        # whole tree has been listed, so then the playlists are written
+        # from that listing rather than from a second walk.
+        copies = set()
+        tree = _walk(start_dir)
+        if dedupe:
+            tree = list(tree)
+            hashes = Hashes(os.path.join(start_dir, HASHES))
+            for group in _duplicates(tree, max(jobs, 4), hashes):
+                copies.update(group[1:])
+
+        def listing():
+            for basedir, files in tree:
+                if copies:
+                    files = [file_ for file_ in files
+                            if os.path.join(basedir, file_) not in copies]
+                yield basedir, files
+
+        types = [type_ for type_, flag in (('pls', PLS), ('m3u', M3U))
+                if flag]
+
+        # Create a pls and/or m3u playlist file in each directory holding
+        # media files, with absolute paths to them.
+        def write(job):
+            basedir, files = job
+            written = {}
+            if manifest_ is not None:
+                written = manifest_.playlists(basedir)
+                if manifest_.unchanged(basedir, files, types, extended):
+                    return None
+
+            media = [file_ for file_ in files
+                    if ismedia(os.path.join(basedir, file_))]
+            if not media:
+                # Nothing to play; any playlists we wrote for it before
+                # are out of date.
+                for path in written.itervalues():
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+                return basedir, files, {}, []
+
+            # Sort once, and let both playlists share the result. The
+            # playlists we wrote last time are ours to replace.
+            entries = sortentries(media)
+            errors = []
+            for type_ in types:
+                try:
+                    written[type_] = _write(type_, basedir, entries,
+                            type_ in written, durations)
+                except PlaylistExistsError as e:
+                    written[type_] = None
+                    errors.append(e)
+                except:
+                    written[type_] = None
+            return basedir, files, written, errors
+
+        # Start in startdir, listing each directory for the workers,
+        # and report back in the order the tree was listed, whichever
+        # worker finished first.
+        for result in _imap(write, listing(), jobs):
+            if result is None:
+                continue
+            basedir, files, written, errors = result
+            for e in errors:
+                print '\n{} already exists.'.format(e)
+            if manifest_ is not None:
+                manifest_.record(basedir, files, written, bool(written),
+                        extended)
+
+        # End of for loop
+        finished = True
 
     except DirectoryError as e:
         print '\n{} does not exist.'.format(e)
     except:
         pass
 
+    # Whatever we managed to write, remember it for next time. Only a
+    # walk that got to the end knows which directories have gone.
+    finally:
+        # Directories the manifest skipped never asked for their
+        # lengths, so only a walk that rewrote everything knows which
+        # of those are stale.
+        for cache, options in ((manifest_, {'complete': finished}),
+                (durations, {'complete': finished and manifest_ is None}),
+                (hashes, {'complete': finished})):
+            if cache is not None:
+                try:
+                    cache.save(**options)
+                except (IOError, OSError) as e:
+                    print '\nUnable to save {}: {}'.format(cache.path, e)
+
     # End of try...except block
 # End of makeplaylist function
 
 
-def mkpls(directory, file_list):
+def mkpls(directory, file_list, overwrite=False, durations=None):
     """Creates a PLS format playlist file from a base directory and a """\
             """list of filenames.
 
     Attributes:
         directory -- directory in which sorted files are stored
-        file_list -- a sorted list of files
+        file_list -- sorted filenames, or (file, key) pairs as returned
+                     by sortentries(); any iterable will do
+        overwrite -- replace the playlist if it already exists
+        durations -- function giving the length of a file in seconds,
+                     such as duration(), to write one for each entry
+
+    Returns the playlist's path, or None if it wasn't written.
+    """
+
+    try:
+        return _write('pls', directory, file_list, overwrite, durations)
+    except PlaylistExistsError as e:
+        print '\n{} already exists.'.format(e)
+    except:
+        pass
+    # End of try...except block
+# End of mkpls function
+
+
+def mkm3u(directory, file_list, overwrite=False, durations=None):
+    """Creates a M3U format playlist file from a base directory and a """\
+            """list of filenames.
+
+    Attributes:
+        directory -- directory in which sorted files are stored
+        file_list -- sorted filenames, or (file, key) pairs as returned
+                     by sortentries(); any iterable will do
+        overwrite -- replace the playlist if it already exists
+        durations -- function giving the length of a file in seconds,
+                     such as duration(), to write an extended playlist
+
+    Returns the playlist's path, or None if it wasn't written.
+    """
+
+    try:
+        return _write('m3u', directory, file_list, overwrite, durations)
+    except PlaylistExistsError as e:
+        print '\n{} already exists.'.format(e)
+    except:
+        pass
+
+    # End of try...except block
+# End of mkm3u function
+
+
+def treeplaylist(start_dir=os.getcwd(), output='-', playlist_type='m3u',
+        extended=False):
+    """Create a single playlist of every media file below start_dir.
+
+    Directories are taken in order, and their files in the order
+    makeplaylist() would give them. Only one directory is held in
+    memory at a time, however large the tree.
+
+    Attributes:
+        start_dir -- directory from which to start
+        output -- file to write the playlist to, or '-' for standard
+                  output; an open file will do as well
+        playlist_type -- type of playlist to create; 'pls' or 'm3u'
+        extended -- give each entry its length, as makeplaylist() does
+
+    Example: media_list.treeplaylist('/path/to/media', 'all.m3u')
+    """
+
+    # Clean up user input
+    start_dir = os.path.abspath(os.path.expanduser(start_dir.strip()))
+
+    durations = None
+    finished = False
+
+    try:
+        if os.path.isdir(start_dir) is False:
+            raise DirectoryError(start_dir)
+
+        if extended:
+            durations = Durations(os.path.join(start_dir, DURATIONS))
+
+        def items():
+            for basedir, files in _walk(start_dir):
+                media = [file_ for file_ in files
+                        if ismedia(os.path.join(basedir, file_))]
+                for item in _titled(basedir, sortentries(media),
+                        durations):
+                    yield item
+
+        _output(output, _RENDERERS[playlist_type.strip()](items()))
+        finished = True
+
+    except DirectoryError as e:
+        print '\n{} does not exist.'.format(e)
+
+    finally:
+        if durations is not None:
+            try:
+                durations.save(complete=finished)
+            except (IOError, OSError) as e:
+                print '\nUnable to save {}: {}'.format(durations.path, e)
+
+    # End of try...except block
+# End of treeplaylist function
+
+
+def _output(output, chunks):
+    """Writes chunks to output: a file, '-' for standard output, or """\
+            """an open file."""
+    if output == '-':
+        _buffered(sys.stdout, chunks)
+    elif hasattr(output, 'write'):
+        _buffered(output, chunks)
+    else:
+        with _AtomicFile(output) as f:
+            _buffered(f, chunks)
+
+
+def _walk(start_dir):
+    """Yields each directory below start_dir, in order, with the """\
+            """files a playlist might list."""
+
+    # Anonymous function to check for dotfiles
+    dot_check = lambda name: re.match(r'^\..*$', name)
+
+    for basedir, pathnames, files in os.walk(start_dir):
+        # Skip hidden directories (pathnames), and take the rest in the
+        # order their names give (Season 2 before Season 10), then by
+        # name where that doesn't decide.
+        pathnames[:] = sortfiles(sorted(pathname for pathname in pathnames
+                if not dot_check(pathname)))
+        # Leave our own playlists out of the listing, along with
+        # anything hidden. Files are in name order before they're
+        # sorted, so ties come out the same as they do from Catalog,
+        # whatever order the filesystem lists them in.
+        files = sorted(file_ for file_ in files if not dot_check(file_)
+                and os.path.splitext(file_)[1] not in ('.pls', '.m3u'))
+        yield basedir, files
+# End of _walk function
+
+
+def _write(type_, directory, file_list, overwrite=False, durations=None):
+    """Writes a playlist of type_ for directory, as mkpls() or """\
+            """mkm3u() do, raising PlaylistExistsError rather than """\
+            """printing it."""
+
+    # Use the same basename as used in the filesystem, next to the
+    # files themselves.
+    path = os.path.join(directory,
+            os.path.basename(directory) + '.' + type_)
+
+    if not overwrite and os.path.isfile(path):
+        raise PlaylistExistsError(path)
+
+    with _AtomicFile(path) as f:
+        _buffered(f, _RENDERERS[type_](_titled(directory, file_list,
+            durations)))
+    return path
+# End of _write function
+
+
+def _titled(directory, file_list, durations=None):
+    """Yields the absolute path, title and length of each file in """\
+            """file_list, as a playlist shows them.
+
+    Lengths are only looked up as they're needed, if durations is
+    given; otherwise they're None. A length that can't be found is -1.
     """
 
     # Retrieve title of media from filesystem structure, and make it
@@ -114,121 +423,1266 @@ def mkpls(directory, file_list):
     # TODO: Perform more intelligent title extraction
     #       (comparison of start_dir against directory?)
     #       take a look at normpath/abspath
-    name = os.path.basename(directory)
-    title = re.sub('[._]', ' ', name)
+    title = re.sub('[._]', ' ', os.path.basename(directory)) + ' '
+    # Filenames never hold a separator, so this does for os.path.join().
+    directory = os.path.join(directory, '')
+
+    # Used to count extra materials.
+    extra = 1
+
+    for file_, key in _entries(file_list):
+
+        # Mark unsortable files as an 'Extra' in the playlist.
+        title_num = _label(key)
+        if title_num is None:
+            title_num = 'Extra ' + str(extra)
+            extra += 1
+
+        length = None
+        if durations is not None:
+            length = durations(directory + file_)
+            length = -1 if length is None else int(round(length))
+
+        yield directory + file_, title + title_num, length
+# End of _titled function
+
+
+def _pls(items):
+    """Yields a PLS format playlist of (path, title, length) items, """\
+            """in pieces. A length of None is left out.
+
+    >>> print ''.join(_pls([('/a/1.mkv', 'a 1', None),
+    ...         ('/a/2.mkv', 'a 2', 1380)])),
+    [playlist]
+    <BLANKLINE>
+    File1=/a/1.mkv
+    Title1=a 1
+    File2=/a/2.mkv
+    Title2=a 2
+    Length2=1380
+    <BLANKLINE>
+    NumberOfEntries=2
+    Version=2
+    """
+
+    # Heading for PLS files, skip a line.
+    yield '[playlist]\n\n'
+
+    # Count entries as they go by, for the footer.
+    i = 0
+    for batch in _batches(items):
+        # Absolute path to file, and title of file displayed to user.
+        yield ''.join([(_PLS_ENTRY if length is None else
+                _PLS_EXTENDED).format(n, path, title, length)
+                for n, (path, title, length) in enumerate(batch, i + 1)])
+        i += len(batch)
+
+    # Standard data for playlist file.
+    yield '\nNumberOfEntries={}\nVersion=2\n'.format(i)
+# End of _pls function
+
+
+def _m3u(items):
+    """Yields a M3U format playlist of (path, title, length) items, """\
+            """in pieces. A length of None is left out.
+
+    >>> print ''.join(_m3u([('/a/1.mkv', 'a 1', None),
+    ...         ('/a/2.mkv', 'a 2', 1380)])),
+    #EXTM3U
+    <BLANKLINE>
+    #EXTINF:a 1
+    /a/1.mkv
+    #EXTINF:1380,a 2
+    /a/2.mkv
+    """
+
+    # Heading for M3U files, skip a line.
+    yield '#EXTM3U\n\n'
+
+    for batch in _batches(items):
+        # TODO: Make sure this is valid in an m3u
+        # Title of file displayed to user, then absolute path to file.
+        yield ''.join([(_M3U_ENTRY if length is None else
+                _M3U_EXTENDED).format(path, title, length)
+                for path, title, length in batch])
+# End of _m3u function
+
+
+# Playlist entries, with and without their lengths.
+_PLS_ENTRY = 'File{0}={1}\nTitle{0}={2}\n'
+_PLS_EXTENDED = 'File{0}={1}\nTitle{0}={2}\nLength{0}={3}\n'
+_M3U_ENTRY = '#EXTINF:{1}\n{0}\n'
+_M3U_EXTENDED = '#EXTINF:{2},{1}\n{0}\n'
+
+
+def _batches(items, size=1024):
+    """Yields lists of up to size of items at a time."""
+    items = iter(items)
+    while True:
+        batch = list(itertools.islice(items, size))
+        if not batch:
+            return
+        yield batch
+
+
+# Playlist renderers, by type.
+_RENDERERS = {'pls': _pls, 'm3u': _m3u}
+
+# How much of a playlist to build up before writing it out.
+_BUFFER = 1 << 16
+
+
+def _buffered(f, chunks, size=_BUFFER):
+    """Writes chunks to f in batches of at least size bytes, rather """\
+            """than one at a time."""
+    batch = []
+    length = 0
+    for chunk in chunks:
+        batch.append(chunk)
+        length += len(chunk)
+        if length >= size:
+            f.write(''.join(batch))
+            batch = []
+            length = 0
+    f.write(''.join(batch))
+# End of _buffered function
+
+
+class _Task(object):
+    """An item for _imap() to pass to its function, and what came of """\
+            """it once a worker has done so."""
+
+    def __init__(self, item):
+        self.item = item
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+def _imap(func, items, jobs=1):
+    """Yields func(item) for each of items, in order, with up to jobs """\
+            """of them running at once.
+
+    items is read in a thread of its own, never too far ahead of the
+    results, so that slow listings overlap with the work done on them.
+    An exception from func or items is raised here, in its turn.
+
+    >>> list(_imap(lambda n: n * n, xrange(10), jobs=4))
+    [0, 1, 4, 9, 16, 25, 36, 49, 64, 81]
+    >>> list(_imap(lambda n: 1 / n, [1, 0], jobs=2))
+    Traceback (most recent call last):
+        ...
+    ZeroDivisionError: integer division or modulo by zero
+    """
 
-    file_ = name + '.pls'
+    if jobs < 2:
+        for item in items:
+            yield func(item)
+        return
+
+    todo = Queue.Queue()
+    # Tasks in order, bounding how far ahead items are read.
+    pending = Queue.Queue(jobs * 4)
+    stop = threading.Event()
+    failed = []
+
+    def read():
+        try:
+            for item in items:
+                if stop.is_set():
+                    break
+                task = _Task(item)
+                pending.put(task)
+                todo.put(task)
+        except:
+            failed.append(sys.exc_info())
+        finally:
+            pending.put(None)
+            for _ in xrange(jobs):
+                todo.put(None)
+
+    def work():
+        for task in iter(todo.get, None):
+            if not stop.is_set():
+                try:
+                    task.result = func(task.item)
+                except:
+                    task.error = sys.exc_info()
+            task.done.set()
+
+    threads = [threading.Thread(target=read)]
+    threads.extend(threading.Thread(target=work) for _ in xrange(jobs))
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
 
     try:
-        if os.path.isfile(file_):
-            raise PlaylistExistsError(file_)
+        for task in iter(pending.get, None):
+            # Wait in short steps, so that ^C isn't held up.
+            while not task.done.wait(0.1):
+                pass
+            if task.error is not None:
+                raise task.error[0], task.error[1], task.error[2]
+            yield task.result
+        if failed:
+            raise failed[0][0], failed[0][1], failed[0][2]
+    finally:
+        # Let the threads run down, rather than work on for nothing.
+        stop.set()
+        while True:
+            try:
+                pending.get_nowait()
+            except Queue.Empty:
+                break
+# End of _imap function
+
+
+class _AtomicFile(object):
+    """A file opened for writing that only replaces path once it has """\
+            """been written in full, so nothing ever sees half of it.
 
-        # Open the file using the same basename as used in the filesystem.
-        with open(file_, 'w') as f:
+    Attributes:
+        path -- file to write
+    """
 
-            # Used to count extra materials.
-            extra = 1
+    def __init__(self, path):
+        self.path = path
+        fd, self.tmp = tempfile.mkstemp(prefix='.' +
+                os.path.basename(path) + '.', dir=os.path.dirname(path) or '.')
+        self.f = os.fdopen(fd, 'w')
+
+    def __enter__(self):
+        return self.f
+
+    def __exit__(self, type_, value, traceback):
+        try:
+            self.f.close()
+            if type_ is None:
+                # Keep the permissions a file opened normally would get.
+                umask = os.umask(0)
+                os.umask(umask)
+                os.chmod(self.tmp, 0666 & ~umask)
+                os.rename(self.tmp, self.path)
+        finally:
+            if os.path.exists(self.tmp):
+                os.remove(self.tmp)
+
+
+class Manifest(object):
+    """Remembers what each directory held when its playlists were """\
+            """written, so makeplaylist() only rewrites those that """\
+            """have changed.
+
+    Directories are kept by their path relative to start_dir, so the
+    tree can be moved without losing track of them.
 
-            # Heading for PLS files, skip a line.
-            f.write('[playlist]\n\n')
+    Attributes:
+        path -- file to keep the manifest in
+        start_dir -- directory the manifest describes
+
+    >>> import shutil
+    >>> tree = tempfile.mkdtemp()
+    >>> manifest = Manifest(os.path.join(tree, MANIFEST), tree)
+    >>> manifest.unchanged(tree, ['a.mkv'], ['pls'])
+    False
+    >>> open(os.path.join(tree, 'a.pls'), 'w').close()
+    >>> manifest.record(tree, ['a.mkv'], {'pls': os.path.join(tree, 'a.pls')})
+    >>> manifest.save()
+    >>> manifest = Manifest(os.path.join(tree, MANIFEST), tree)
+    >>> manifest.unchanged(tree, ['a.mkv'], ['pls'])
+    True
+    >>> manifest.unchanged(tree, ['a.mkv', 'b.mkv'], ['pls'])
+    False
+    >>> manifest.unchanged(tree, ['a.mkv'], ['pls', 'm3u'])
+    False
+    >>> manifest.record(tree, ['a.txt'], {}, media=False)
+    >>> manifest.save()
+    >>> manifest = Manifest(os.path.join(tree, MANIFEST), tree)
+    >>> manifest.unchanged(tree, ['a.txt'], ['pls'])
+    True
+
+    A walk that stopped part way only adds to what it knew:
+
+    >>> manifest = Manifest(os.path.join(tree, MANIFEST), tree)
+    >>> manifest.save(complete=False)
+    >>> manifest = Manifest(os.path.join(tree, MANIFEST), tree)
+    >>> manifest.unchanged(tree, ['a.txt'], ['pls'])
+    True
+    >>> shutil.rmtree(tree)
+    """
 
-            # Iterate, getting an entry number and filename for each file.
-            for i, file_ in enumerate(file_list, 1):
+    def __init__(self, path, start_dir):
+        self.path = path
+        self.start_dir = start_dir
+        self.old = {}
+        self.new = {}
+        try:
+            with open(path) as f:
+                data = json.load(f)
+            if data.get('version') == 1:
+                self.old = data['directories']
+        except (IOError, ValueError, KeyError, AttributeError):
+            # No manifest yet, or one we can't make sense of; either
+            # way, every playlist gets written.
+            pass
+
+    def _key(self, directory):
+        return os.path.relpath(directory, self.start_dir)
+
+    def playlists(self, directory):
+        """Returns the playlists we last wrote for directory, by type."""
+        entry = self.old.get(self._key(directory))
+        return dict(entry['playlists']) if entry else {}
+
+    def unchanged(self, directory, files, types, extended=False):
+        """Checks whether directory holds just what it did when we """\
+                """last wrote each of its playlists of types (or found """\
+                """it had no media), and remembers it for next time if """\
+                """so. Playlists are only as good if they were just as """\
+                """extended."""
+        key = self._key(directory)
+        entry = self.old.get(key)
+        if entry is None:
+            return False
+        # The mtime alone won't do: writing our playlists, or this
+        # manifest, moves it on, and it can be too coarse to tell two
+        # changes apart. The listing is already in hand, so compare that.
+        if entry['files'] != sorted(files):
+            return False
+        if entry.get('media', True) and (any(not os.path.isfile(
+                entry['playlists'].get(type_) or '') for type_ in types) or
+                entry.get('extended', False) != extended):
+            return False
+        try:
+            entry['mtime'] = os.stat(directory).st_mtime
+        except OSError:
+            return False
+        self.new[key] = entry
+        return True
+
+    def record(self, directory, files, playlists, media=True,
+            extended=False):
+        """Remembers what directory holds now that its playlists have """\
+                """been written, or that it holds no media at all."""
+        playlists = dict((type_, os.path.abspath(path)) for type_, path in
+                playlists.iteritems() if path)
+        try:
+            mtime = os.stat(directory).st_mtime
+        except OSError:
+            return
+        self.new[self._key(directory)] = {'mtime': mtime,
+                'files': sorted(files), 'playlists': playlists,
+                'media': media, 'extended': extended}
+
+    def save(self, complete=True):
+        """Writes out every directory seen since we were loaded. """\
+                """After a complete walk, those we didn't see are gone, """\
+                """and forgotten; after an interrupted one, they were """\
+                """only missed, and are kept."""
+        directories = self.new
+        if not complete:
+            directories = dict(self.old)
+            directories.update(self.new)
+        with _AtomicFile(self.path) as f:
+            json.dump({'version': 1, 'directories': directories}, f,
+                    sort_keys=True)
+
+
+class Catalog(object):
+    """An index of every media file below start_dir, so playlists """\
+            """can be queried for rather than walked for.
+
+    Each file is kept with its size, mtime, when it was first seen and
+    the key it sorts by, under a sort key taking in its directories, so
+    rows come out of the database already in playlist order. A refresh
+    only lists directories whose mtime has moved on; the rest cost a
+    stat() each. Files changed in place, without their directory
+    changing, aren't noticed until something else in it changes.
 
-                # Number used for this entry in the PLS file.
-                entry_num = str(i)
+    Attributes:
+        start_dir -- directory to catalog
+        path -- SQLite database file, by default CATALOG in start_dir
+
+    >>> import shutil
+    >>> tree = tempfile.mkdtemp()
+    >>> for name in ('Season 2/Show 03.mkv', 'Season 2/Show 01.mkv',
+    ...         'Season 10/Show 01.mkv', 'Season 2/notes.txt'):
+    ...     if not os.path.isdir(os.path.join(tree, os.path.dirname(name))):
+    ...         os.mkdir(os.path.join(tree, os.path.dirname(name)))
+    ...     open(os.path.join(tree, name), 'w').close()
+    >>> catalog = Catalog(tree)
+    >>> catalog.refresh()
+    3
+    >>> for path, title, length in catalog.entries():
+    ...     print os.path.relpath(path, tree), '|', title
+    Season 2/Show 01.mkv | Season 2 1
+    Season 2/Show 03.mkv | Season 2 3
+    Season 10/Show 01.mkv | Season 10 1
+    >>> catalog.refresh()
+    0
+    >>> [os.path.relpath(path, tree) for path, title, length in
+    ...         catalog.entries(under=os.path.join(tree, 'Season 10'))]
+    ['Season 10/Show 01.mkv']
+    >>> catalog.close(); shutil.rmtree(tree)
+    """
 
-                # Sequence number for actual content.
-                seqnum = getseqnum(file_)
+    # Commit after this many directories have been listed.
+    batch = 500
+
+    def __init__(self, start_dir=os.getcwd(), path=None):
+        self.start_dir = os.path.abspath(os.path.expanduser(start_dir))
+        self.path = path or os.path.join(self.start_dir, CATALOG)
+        self.pending = 0
+        self.conn = sqlite3.connect(self.path)
+        # Paths are byte strings, whatever their encoding.
+        self.conn.text_factory = str
+        # Keep the journal around between transactions, rather than
+        # changing the mtime of the directory we're in with each one.
+        self.conn.execute('PRAGMA journal_mode = PERSIST')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS directories ('
+                'path TEXT PRIMARY KEY, mtime REAL NOT NULL, '
+                'subdirs TEXT NOT NULL)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS files ('
+                'path TEXT PRIMARY KEY, directory TEXT NOT NULL, '
+                'sortkey TEXT NOT NULL, size INTEGER, mtime REAL, '
+                'added REAL NOT NULL, extra INTEGER, disc INTEGER, '
+                'season INTEGER, episode INTEGER, last_episode INTEGER, '
+                'part INTEGER, version INTEGER)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS files_sortkey '
+                'ON files (sortkey)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS files_directory '
+                'ON files (directory)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS files_added '
+                'ON files (added)')
+
+    def refresh(self):
+        """Brings the catalog up to date with the tree, and returns """\
+                """the number of directories that had to be listed."""
+
+        known = dict((path, (mtime, subdirs)) for path, mtime, subdirs in
+                self.conn.execute('SELECT path, mtime, subdirs '
+                'FROM directories'))
+        seen = set()
+        listed = 0
+
+        # Directories' sort keys are built up from their parents'.
+        stack = [(self.start_dir, '')]
+        while stack:
+            directory, sortkey = stack.pop()
+            try:
+                mtime = os.stat(directory).st_mtime
+            except OSError:
+                continue
+            seen.add(directory)
+            if directory in known and known[directory][0] == mtime:
+                subdirs = json.loads(known[directory][1])
+            else:
+                subdirs = self._list(directory, sortkey, mtime)
+                listed += 1
+            for name, key in zip(subdirs, getkeys(subdirs)):
+                stack.append((os.path.join(directory, name),
+                        sortkey + '\x01' + _sortable(key, name)))
+
+        # Forget whatever has gone from the tree.
+        for directory in set(known) - seen:
+            self.conn.execute('DELETE FROM directories WHERE path = ?',
+                    (directory,))
+            self.conn.execute('DELETE FROM files WHERE directory = ?',
+                    (directory,))
+        self.conn.commit()
+        self.pending = 0
+        return listed
+
+    def _list(self, directory, sortkey, mtime):
+        """Catalogs the media files in directory, and returns the """\
+                """names of the directories in it."""
+        subdirs = []
+        media = []
+        for name in os.listdir(directory):
+            if name.startswith('.'):
+                continue
+            path = os.path.join(directory, name)
+            # Don't follow links to directories, just as os.walk()
+            # doesn't.
+            if os.path.isdir(path):
+                if not os.path.islink(path):
+                    subdirs.append(name)
+            elif os.path.splitext(name)[1] not in ('.pls', '.m3u') and \
+                    ismedia(path):
+                media.append(name)
+
+        # Keep when files we already knew of were first seen.
+        added = dict(self.conn.execute('SELECT path, added FROM files '
+                'WHERE directory = ?', (directory,)))
+        self.conn.execute('DELETE FROM files WHERE directory = ?',
+                (directory,))
+        now = time.time()
+        rows = []
+        for name, key in zip(media, getkeys(media)):
+            path = os.path.join(directory, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            rows.append((path, directory,
+                    sortkey + '\x01\x01' + _sortable(key, name), st.st_size,
+                    st.st_mtime, added.get(path, now)) + key)
+        self.conn.executemany('INSERT INTO files VALUES (?, ?, ?, ?, ?, ?, '
+                '?, ?, ?, ?, ?, ?, ?)', rows)
+        self.conn.execute('INSERT OR REPLACE INTO directories VALUES '
+                '(?, ?, ?)', (directory, mtime, json.dumps(subdirs)))
+
+        self.pending += 1
+        if self.pending >= self.batch:
+            self.conn.commit()
+            self.pending = 0
+        return subdirs
+
+    def entries(self, under=None, recent=None, durations=None):
+        """Yields the path, title and length of cataloged files, as """\
+                """makeplaylist() would list them.
+
+        Attributes:
+            under -- only list files below this directory
+            recent -- only list this many files, those most recently
+                      added first
+            durations -- function giving the length of a file in
+                         seconds, such as a Durations
+        """
+        sql = 'SELECT directory, path, extra, disc, season, episode, ' \
+                'last_episode, part, version FROM files'
+        args = []
+        if under is not None:
+            # Everything in the directory, or sorting between it and
+            # the first name that can't be below it.
+            under = os.path.abspath(os.path.expanduser(under))
+            sql += ' WHERE directory = ? OR (directory >= ? AND ' \
+                    'directory < ?)'
+            args += [under, os.path.join(under, ''),
+                    os.path.join(under, '')[:-1] + chr(ord(os.sep) + 1)]
+        if recent is not None:
+            sql += ' ORDER BY added DESC, sortkey LIMIT ?'
+            args.append(recent)
+        else:
+            sql += ' ORDER BY sortkey'
+
+        rows = self.conn.execute(sql, args)
+        for directory, group in itertools.groupby(rows, lambda row: row[0]):
+            for item in _titled(directory, ((os.path.basename(row[1]),
+                    row[2:]) for row in group), durations):
+                yield item
+
+    def playlist(self, output='-', playlist_type='m3u', under=None,
+            recent=None, extended=False):
+        """Writes a playlist of cataloged files to output, as """\
+                """treeplaylist() does; under and recent choose the """\
+                """files as for entries()."""
+        durations = None
+        if extended:
+            durations = Durations(os.path.join(self.start_dir, DURATIONS))
+        finished = False
+        try:
+            _output(output, _RENDERERS[playlist_type](self.entries(under,
+                recent, durations)))
+            finished = under is None and recent is None
+        finally:
+            if durations is not None:
+                durations.save(complete=finished)
+
+    def close(self):
+        """Commits any outstanding changes and closes the database."""
+        self.conn.commit()
+        self.conn.close()
+# End of Catalog class
+
+
+def _sortable(key, name):
+    """Returns key and name as a string that sorts as they would."""
+    return ''.join(['{:010d}'.format(min(part, 9999999999)) for part in key]) \
+            + name
+
+
+# Leading bytes of the containers ismedia() recognises, as the
+# (offset, bytes) pairs each must start with. RIFF alone isn't enough:
+# WebP images are RIFF too, so the form type has to match as well.
+_SIGNATURES = (
+        ((0, '\x1a\x45\xdf\xa3'),),     # EBML: Matroska, WebM
+        ((0, 'RIFF'), (8, 'AVI ')),
+        ((0, 'RIFF'), (8, 'WAVE')),
+        ((4, 'ftyp'),),                 # MP4, MOV
+        ((0, 'ID3'),),                  # MP3 with an ID3v2 tag
+        ((0, 'fLaC'),),
+        ((0, 'OggS'),),
+        ((0, '\x30\x26\xb2\x75\x8e\x66\xcf\x11'),),  # ASF: WMV, WMA
+        )
+
+# Whether each file sniffed was media, by device, inode and mtime.
+_sniffed = {}
+
+
+def ismedia(path):
+    """Checks whether path is a media file.
+
+    Its extension decides, where it's one we know; otherwise the first
+    few bytes are checked against the containers we know of. What was
+    found is remembered until the file changes.
+
+    >>> import shutil
+    >>> tree = tempfile.mkdtemp()
+    >>> ismedia(os.path.join(tree, 'Show - 01.mkv'))
+    True
+    >>> ismedia(os.path.join(tree, 'cover.jpg'))
+    False
+    >>> with open(os.path.join(tree, 'track'), 'wb') as f:
+    ...     f.write('fLaC\\x00\\x00\\x00\\x22')
+    >>> ismedia(os.path.join(tree, 'track'))
+    True
+    >>> with open(os.path.join(tree, 'notes'), 'wb') as f:
+    ...     f.write('Ripped by...')
+    >>> ismedia(os.path.join(tree, 'notes'))
+    False
+    >>> with open(os.path.join(tree, 'folder'), 'wb') as f:
+    ...     f.write('RIFF\\x24\\x00\\x00\\x00WEBPVP8 ')
+    >>> ismedia(os.path.join(tree, 'folder'))
+    False
+    >>> shutil.rmtree(tree)
+    """
 
-                # Mark unsortable files as an 'Extra' in the playlist.
-                if seqnum == 9999:
-                    title_num = 'Extra ' + str(extra)
-                    extra += 1
-                else:
-                    title_num = str(seqnum)
+    ext = os.path.splitext(path)[1].lower()
+    if ext in MEDIA_EXTS:
+        return True
+    if ext in OTHER_EXTS:
+        return False
 
-                # Absolute path to file.
-                f.write('File' + entry_num + '=' +
-                        os.path.join(directory, file_) + '\n')
-                # Title of file displayed to user.
-                f.write('Title' + entry_num + '=' +
-                        title + ' ' + title_num + '\n')
+    try:
+        st = os.stat(path)
+    except OSError:
+        return False
+    key = (st.st_dev, st.st_ino, st.st_mtime)
+    media = _sniffed.get(key)
+    if media is None:
+        media = _sniffed[key] = _sniff(path)
+    return media
+# End of ismedia function
+
+
+def _sniff(path):
+    """Checks the first few bytes of path for a media container."""
+    try:
+        with open(path, 'rb') as f:
+            head = f.read(12)
+    except IOError:
+        return False
+    for signature in _SIGNATURES:
+        if all(head.startswith(part, offset) for offset, part in signature):
+            return True
+    # A bare MPEG audio frame: the sync bits, then a layer and bitrate
+    # that aren't reserved.
+    if len(head) >= 3 and head[0] == '\xff':
+        second, third = ord(head[1]), ord(head[2])
+        return second & 0xe0 == 0xe0 and second & 0x06 != 0 and \
+                third & 0xf0 != 0xf0
+    return False
+# End of _sniff function
+
+
+# How much of each end of a file to hash before hashing all of it, and
+# how much to read at a time when we do.
+_PARTIAL = 1 << 16
+_CHUNK = 1 << 20
+
+
+def duplicates(start_dir=os.getcwd(), jobs=4, hashes=HASHES):
+    """Finds media files below start_dir with identical contents.
+
+    Files are grouped by size first, then by a hash of their first and
+    last 64 KiB, and only files still alike after that are hashed in
+    full, up to jobs at once. Most files are never read at all, and
+    the hashes are kept in the hashes file in start_dir, so looking
+    again only reads files that are new or have changed.
+
+    Returns a list of groups of paths, each in the order the tree is
+    walked, so keeping the first of each group and dropping the rest
+    leaves one copy of everything.
 
-            # Standard data for playlist file.
-            f.write('\nNumberOfEntries=' + str(i))
-            f.write('\nVersion=2\n')
+    Attributes:
+        start_dir -- directory from which to start
+        jobs -- number of files to hash at once
+        hashes -- name of the file in start_dir keeping the hashes of
+                  files already compared, or None to hash them all
+
+    >>> import shutil
+    >>> tree = tempfile.mkdtemp()
+    >>> for name, data in (('a', 'x' * 300000), ('b', 'x' * 300000),
+    ...         ('c', 'x' * 299999 + 'y'), ('d', 'z')):
+    ...     with open(os.path.join(tree, name + '.mkv'), 'wb') as f:
+    ...         f.write(data)
+    >>> [[os.path.basename(path) for path in group]
+    ...         for group in duplicates(tree)]
+    [['a.mkv', 'b.mkv']]
+    >>> len(Hashes(os.path.join(tree, HASHES)).values)
+    3
+    >>> shutil.rmtree(tree)
+    """
 
-            # End of enumerated for loop
-        # End of with block
-    except PlaylistExistsError as e:
-        print '\n{} already exists.'.format(e)
-    except:
-        pass
-    # End of try...except block
-# End of mkpls function
+    start_dir = os.path.abspath(os.path.expanduser(start_dir.strip()))
 
+    cache = None
+    if hashes is not None:
+        cache = Hashes(os.path.join(start_dir, hashes))
+    finished = False
+    try:
+        groups = _duplicates(_walk(start_dir), jobs, cache)
+        finished = True
+        return groups
+    finally:
+        if cache is not None:
+            cache.save(complete=finished)
+# End of duplicates function
+
+
+def _duplicates(tree, jobs=4, hashes=None):
+    """Finds the groups of identical media files in tree, a listing """\
+            """of (basedir, files) as _walk() gives, as duplicates() """\
+            """does, keeping their hashes in hashes if given."""
+
+    partial_hash, full_hash = _partial_hash, _full_hash
+    if hashes is not None:
+        partial_hash, full_hash = hashes.partial, hashes.full
+
+    sizes = collections.OrderedDict()
+    for basedir, files in tree:
+        for file_ in files:
+            path = os.path.join(basedir, file_)
+            try:
+                size = os.path.getsize(path)
+            except OSError:
+                continue
+            # Empty files are alike, but there's nothing to play in them.
+            if size and ismedia(path):
+                sizes.setdefault(size, []).append(path)
+
+    groups = [group for group in sizes.itervalues() if len(group) > 1]
+    groups = _regroup(groups, partial_hash, jobs)
+
+    # Small files have been hashed in full already.
+    small = [group for group in groups
+            if os.path.getsize(group[0]) <= 2 * _PARTIAL]
+    large = [group for group in groups
+            if os.path.getsize(group[0]) > 2 * _PARTIAL]
+    groups = small + _regroup(large, full_hash, jobs)
+
+    order = dict((path, i) for i, path in
+            enumerate(itertools.chain(*sizes.itervalues())))
+    return sorted(groups, key=lambda group: order[group[0]])
+
+
+# A CRC32 tagged onto a filename, in brackets or parentheses.
+_crc_re = re.compile(r'[\[(]([0-9A-Fa-f]{8})[\])]')
+
+
+def getcrc(filename):
+    """Returns the CRC32 tagged onto filename, in upper case, or None.
+
+    >>> getcrc('[Group] Show - 01 [1A2B3C4D].mkv')
+    '1A2B3C4D'
+    >>> getcrc('Show.S01E02.720p.mkv') is None
+    True
+    """
+    tags = _crc_re.findall(filename)
+    return tags[-1].upper() if tags else None
+
+
+def crc32(path):
+    """Returns the CRC32 of path as eight hex digits, or None if it """\
+            """can't be read.
+
+    >>> import shutil
+    >>> tree = tempfile.mkdtemp()
+    >>> path = os.path.join(tree, 'file')
+    >>> with open(path, 'wb') as f:
+    ...     f.write('123456789')
+    >>> crc32(path)
+    'CBF43926'
+    >>> shutil.rmtree(tree)
+    """
+    crc = 0
+    try:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(_CHUNK), ''):
+                crc = zlib.crc32(chunk, crc)
+    except IOError:
+        return None
+    return '{:08X}'.format(crc & 0xffffffff)
 
-def mkm3u(directory, file_list):
-    """Creates a M3U format playlist file from a base directory and a """\
-            """list of filenames.
+
+def verify(start_dir=os.getcwd(), jobs=4, checksums=CHECKSUMS):
+    """Checks every file below start_dir with a CRC32 in its name.
+
+    Files are read up to jobs at once. What's read is kept in the
+    checksums file in start_dir, so checking again only reads files
+    that are new or have changed.
+
+    Yields the path, tagged CRC32 and actual CRC32 (None if the file
+    couldn't be read) of each file, in the order the tree is walked.
 
     Attributes:
-        directory -- directory in which sorted files are stored
-        file_list -- a sorted list of files
+        start_dir -- directory from which to start
+        jobs -- number of files to read at once
+        checksums -- name of the file in start_dir keeping the CRC32s
+                     of files already read, or None to read them all
+
+    >>> import shutil
+    >>> tree = tempfile.mkdtemp()
+    >>> for name in ('Show - 01 [CBF43926].mkv', 'Show - 02 [00000000].mkv'):
+    ...     with open(os.path.join(tree, name), 'wb') as f:
+    ...         f.write('123456789')
+    >>> for path, tagged, actual in verify(tree):
+    ...     print os.path.basename(path), tagged, actual
+    Show - 01 [CBF43926].mkv CBF43926 CBF43926
+    Show - 02 [00000000].mkv 00000000 CBF43926
+    >>> shutil.rmtree(tree)
     """
 
-    # Retrieve title of media from filesystem structure, and make it
-    # more human readable.
-    # TODO: Perform more intelligent title extraction
-    #       (comparison of start_dir against directory?)
-    name = os.path.basename(directory)
-    title = re.sub('[._]', ' ', name)
+    start_dir = os.path.abspath(os.path.expanduser(start_dir.strip()))
 
-    file_ = name + '.m3u'
+    cache = crc32
+    if checksums is not None:
+        cache = Checksums(os.path.join(start_dir, checksums))
 
-    try:
-        if os.path.isfile(file_):
-            raise PlaylistExistsError(file_)
+    def tagged():
+        for basedir, files in _walk(start_dir):
+            for file_ in sorted(files):
+                crc = getcrc(file_)
+                if crc is not None:
+                    yield os.path.join(basedir, file_), crc
 
-        # Open the file using the same basename as used in the filesystem.
-        with open(file_, 'w') as f:
+    def check(item):
+        path, crc = item
+        return path, crc, cache(path)
 
-            # Used to count extra materials.
-            extra = 1
+    finished = False
+    try:
+        for result in _imap(check, tagged(), jobs):
+            yield result
+        finished = True
+    finally:
+        if checksums is not None:
+            cache.save(complete=finished)
+# End of verify function
+
+
+def _regroup(groups, func, jobs=1):
+    """Splits each group of paths by func(path), running up to jobs """\
+            """at once, and keeps those still holding more than one."""
+    paths = [path for group in groups for path in group]
+    keys = dict(zip(paths, _imap(func, paths, jobs)))
+    regrouped = []
+    for group in groups:
+        split = collections.OrderedDict()
+        for path in group:
+            if keys[path] is not None:
+                split.setdefault(keys[path], []).append(path)
+        regrouped.extend(paths for paths in split.itervalues()
+                if len(paths) > 1)
+    return regrouped
+
+
+def _partial_hash(path):
+    """Returns a hex digest of the first and last _PARTIAL bytes of """\
+            """path, or None if it can't be read."""
+    digest = hashlib.sha1()
+    try:
+        with open(path, 'rb') as f:
+            digest.update(f.read(_PARTIAL))
+            f.seek(0, 2)
+            f.seek(max(_PARTIAL, f.tell() - _PARTIAL))
+            digest.update(f.read(_PARTIAL))
+    except IOError:
+        return None
+    return digest.hexdigest()
+
+
+def _full_hash(path):
+    """Returns a hex digest of the whole of path, or None if it """\
+            """can't be read."""
+    digest = hashlib.sha1()
+    try:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(_CHUNK), ''):
+                digest.update(chunk)
+    except IOError:
+        return None
+    return digest.hexdigest()
 
-            # Heading for M3U files, skip a line.
-            f.write('#EXTM3U\n\n')
 
-            # Iterate, getting an entry number and filename for each file.
-            for file_ in file_list:
+class _FileCache(object):
+    """Something read from each file, kept on disk so each file is """\
+            """only read once.
 
-                # Sequence number for actual content.
-                seqnum = getseqnum(file_)
+    A file is known by its device, inode, size and mtime, so one that's
+    been replaced or rewritten is read again. Call with a file's path
+    for what read() gives for it, or None if the file has gone.
 
-                # Mark unsortable files as an 'Extra' in the playlist.
-                if seqnum == 9999:
-                    title_num = 'Extra ' + str(extra)
-                    extra += 1
-                else:
-                    title_num = str(seqnum)
+    Attributes:
+        path -- file to keep what was read in
+    """
 
-                # TODO: Make sure this is valid in an m3u
-                # Title of file displayed to user.
-                f.write('#EXTINF:' + title + ' ' + title_num + '\n')
-                # Absolute path to file.
-                f.write(os.path.join(directory, file_) + '\n')
+    # What's being kept, as named in the file.
+    kind = None
+    # Whether read() giving None only means the file couldn't be read
+    # this time, and is worth trying again, rather than an answer.
+    transient = False
+
+    def __init__(self, path):
+        self.path = path
+        self.values = {}
+        self.seen = set()
+        self.changed = False
+        try:
+            with open(path) as f:
+                data = json.load(f)
+            if data.get('version') == 1:
+                self.values = data[self.kind]
+        except (IOError, ValueError, KeyError, AttributeError):
+            # Nothing kept yet, or nothing we can use; files will just
+            # be read again.
+            pass
+
+    def __call__(self, path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        key = '{}:{}:{}:{!r}'.format(st.st_dev, st.st_ino, st.st_size,
+                st.st_mtime)
+        self.seen.add(key)
+        value = self.values.get(key)
+        if value is None and (self.transient or key not in self.values):
+            value = self.read(path)
+            if value is not None or not self.transient:
+                self.values[key] = value
+                self.changed = True
+        return value
+
+    def read(self, path):
+        raise NotImplementedError
+
+    def save(self, complete=False):
+        """Writes what was read out, if anything was added. After a """\
+                """complete run, one that asked about every file there """\
+                """is, what's kept for files not asked about is for """\
+                """ones that have gone or changed, and is dropped."""
+        if complete:
+            for key in set(self.values) - self.seen:
+                del self.values[key]
+                self.changed = True
+        if self.changed:
+            with _AtomicFile(self.path) as f:
+                json.dump({'version': 1, self.kind: self.values}, f,
+                        sort_keys=True)
+            self.changed = False
+
+
+class Durations(_FileCache):
+    """Lengths of media files in seconds, as duration() finds them, """\
+            """kept on disk so each file's headers are only read once."""
+
+    kind = 'durations'
+
+    def read(self, path):
+        return duration(path)
+
+
+class Checksums(_FileCache):
+    """CRC32s of files, as eight hex digits, kept on disk so each """\
+            """file is only read in full once.
+
+    A file that couldn't be read isn't kept, so it's read again next
+    time rather than failing for good, and after a complete run one
+    that wasn't asked about is forgotten:
+
+    >>> import shutil
+    >>> tree = tempfile.mkdtemp()
+    >>> checksums = Checksums(os.path.join(tree, CHECKSUMS))
+    >>> checksums(tree) is None, checksums.values
+    (True, {})
+    >>> checksums.values['0:0:0:0.0'] = '00000000'
+    >>> checksums.save(complete=True)
+    >>> Checksums(checksums.path).values
+    {}
+    >>> shutil.rmtree(tree)
+    """
 
-            # End of for loop
-        # End of with block
+    kind = 'crc32'
+    transient = True
+
+    def read(self, path):
+        return crc32(path)
+
+
+class Hashes(_FileCache):
+    """Hashes of the ends and of the whole of files, as duplicates() """\
+            """compares them, kept on disk so each file is only read """\
+            """once. Each is only worked out when first asked for, and """\
+            """one that couldn't be read isn't kept."""
+
+    kind = 'sha1'
+
+    def read(self, path):
+        return {}
+
+    def partial(self, path):
+        """Returns _partial_hash(path), reading it if need be."""
+        return self._hash(path, 'partial', _partial_hash)
+
+    def full(self, path):
+        """Returns _full_hash(path), reading it if need be."""
+        return self._hash(path, 'full', _full_hash)
+
+    def _hash(self, path, name, func):
+        hashes = self(path)
+        if hashes is None:
+            return None
+        if name not in hashes:
+            digest = func(path)
+            if digest is None:
+                return None
+            hashes[name] = digest
+            self.changed = True
+        return hashes[name]
+
+
+def duration(path):
+    """Returns the length of a media file in seconds, or None if it """\
+            """can't be found.
+
+    Only the headers are read: the Xing or VBRI header, or the first
+    frame, of an MP3; the segment info of a Matroska file; the movie
+    header of an MP4; and the STREAMINFO block of a FLAC.
+
+    >>> import shutil
+    >>> tree = tempfile.mkdtemp()
+    >>> with open(os.path.join(tree, 'cbr.mp3'), 'wb') as f:
+    ...     f.write('\\xff\\xfb\\x90\\x00'.ljust(16000, '\\x00'))
+    >>> duration(os.path.join(tree, 'cbr.mp3'))
+    1.0
+    >>> with open(os.path.join(tree, 'track.flac'), 'wb') as f:
+    ...     f.write('fLaC\\x80\\x00\\x00\\x22' + '\\x00' * 10 +
+    ...             struct.pack('>Q', 44100 << 44 | 1 << 41 | 15 << 36 |
+    ...             441000) + '\\x00' * 16)
+    >>> duration(os.path.join(tree, 'track.flac'))
+    10.0
+    >>> duration(os.path.join(tree, 'missing.mkv')) is None
+    True
+    >>> shutil.rmtree(tree)
+    """
 
-    except PlaylistExistsError as e:
-        print '\n{} already exists.'.format(e)
-    except:
+    try:
+        with open(path, 'rb') as f:
+            head = f.read(12)
+            f.seek(0)
+            if head.startswith('fLaC'):
+                return _flac_duration(f)
+            if head.startswith('\x1a\x45\xdf\xa3'):
+                return _mkv_duration(f)
+            if head.startswith('ftyp', 4):
+                return _mp4_duration(f)
+            if head.startswith('ID3') or head.startswith('\xff'):
+                return _mp3_duration(f)
+    except (IOError, OSError, EOFError, ValueError, struct.error,
+            ZeroDivisionError):
         pass
+    return None
+# End of duration function
+
+
+def _flac_duration(f):
+    """Reads the length of a FLAC from its STREAMINFO block."""
+    f.seek(4)
+    while True:
+        header = f.read(4)
+        if len(header) < 4:
+            return None
+        last, size = ord(header[0]) & 0x80, struct.unpack('>I',
+                '\x00' + header[1:])[0]
+        if ord(header[0]) & 0x7f == 0:
+            info = f.read(size)
+            # 20 bits of sample rate, 3 of channels and 5 of bit depth,
+            # then 36 of samples.
+            bits = struct.unpack('>Q', info[10:18])[0]
+            rate, samples = bits >> 44, bits & 0xfffffffff
+            return float(samples) / rate if samples else None
+        if last:
+            return None
+        f.seek(size, 1)
+
+
+def _ebml_number(f, marker=False):
+    """Reads an EBML variable length number, keeping its length """\
+            """marker for element IDs. An unknown size is None."""
+    first = f.read(1)
+    if not first:
+        raise EOFError
+    value = ord(first)
+    length = 1
+    mask = 0x80
+    while not value & mask:
+        mask >>= 1
+        length += 1
+        if not mask:
+            raise ValueError('bad EBML number')
+    if not marker:
+        value &= mask - 1
+    unknown = value == mask - 1
+    for byte in f.read(length - 1):
+        value = value << 8 | ord(byte)
+        unknown = unknown and byte == '\xff'
+    return None if unknown and not marker else value
+
+
+def _mkv_duration(f):
+    """Reads the length of a Matroska file from its segment info."""
+    # The EBML header, then into the segment, then through its elements
+    # until the info turns up. Clusters of media come after it.
+    f.seek(4)
+    f.seek(_ebml_number(f), 1)
+    if _ebml_number(f, marker=True) != 0x18538067:
+        return None
+    _ebml_number(f)
+    while True:
+        id_, size = _ebml_number(f, marker=True), _ebml_number(f)
+        if id_ == 0x1f43b675 or size is None:
+            return None
+        if id_ == 0x1549a966:
+            break
+        f.seek(size, 1)
+
+    scale, length = 1000000, None
+    end = f.tell() + size
+    while f.tell() < end:
+        id_, size = _ebml_number(f, marker=True), _ebml_number(f)
+        if size is None:
+            return None
+        data = f.read(size)
+        if id_ == 0x2ad7b1:
+            scale = int(data.encode('hex'), 16)
+        elif id_ == 0x4489:
+            length = struct.unpack('>f' if size == 4 else '>d', data)[0]
+    return length * scale / 1e9 if length else None
+
+
+def _mp4_duration(f):
+    """Reads the length of an MP4 from the movie header in its moov """\
+            """box, wherever in the file that is."""
+
+    def boxes(end):
+        while end is None or f.tell() < end:
+            start = f.tell()
+            header = f.read(8)
+            if len(header) < 8:
+                return
+            size, type_ = struct.unpack('>I4s', header)
+            if size == 1:
+                size = struct.unpack('>Q', f.read(8))[0]
+            if 0 < size < 8:
+                return
+            yield type_, start + size if size else None
+            if not size:
+                return
+            f.seek(start + size)
+
+    for type_, end in boxes(None):
+        if type_ == 'moov':
+            for type_, _ in boxes(end):
+                if type_ == 'mvhd':
+                    version = ord(f.read(4)[0])
+                    if version == 1:
+                        scale, length = struct.unpack('>16xIQ', f.read(28))
+                    else:
+                        scale, length = struct.unpack('>8xII', f.read(16))
+                    return float(length) / scale
+            return None
+    return None
+
+
+# MPEG audio bitrates in kbit/s by bitrate index, for MPEG-1 layers I,
+# II and III, then MPEG-2 and 2.5 layer I, and layers II and III.
+_MP3_BITRATES = (
+        (0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448),
+        (0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384),
+        (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+        (0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256),
+        (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+        )
+
+# Sample rates for MPEG-1, by sample rate index.
+_MP3_RATES = (44100, 48000, 32000)
+
+
+def _mp3_duration(f):
+    """Reads the length of an MP3 from the Xing or VBRI header in its """\
+            """first frame, or works it out from the bitrate of that """\
+            """frame if it has neither."""
+
+    # Skip over an ID3v2 tag, whose size is kept seven bits to a byte.
+    start = 0
+    head = f.read(10)
+    if head.startswith('ID3'):
+        start = 10 + reduce(lambda size, byte: size << 7 | ord(byte) & 0x7f,
+                head[6:10], 0)
+        if ord(head[5]) & 0x10:
+            start += 10
+
+    # The first frame is normally straight after it, though some taggers
+    # leave padding in between.
+    f.seek(start)
+    data = f.read(1 << 14)
+    offset = data.find('\xff')
+    while 0 <= offset < len(data) - 4:
+        b1, b2, b3 = [ord(byte) for byte in data[offset + 1:offset + 4]]
+        version, layer = b1 >> 3 & 3, b1 >> 1 & 3
+        index, rate = b2 >> 4, b2 >> 2 & 3
+        if b1 & 0xe0 == 0xe0 and version != 1 and layer and \
+                index not in (0, 15) and rate != 3:
+            break
+        offset = data.find('\xff', offset + 1)
+    else:
+        return None
 
-    # End of try...except block
-# End of mkm3u function
+    mpeg1 = version == 3
+    rate = _MP3_RATES[rate] >> (0 if mpeg1 else 1 if version == 2 else 2)
+    if mpeg1:
+        bitrate = _MP3_BITRATES[3 - layer][index]
+    else:
+        bitrate = _MP3_BITRATES[3 if layer == 3 else 4][index]
+    samples = 384 if layer == 3 else 1152 if mpeg1 or layer == 2 else 576
+
+    # Xing (or Info) comes after the side information, VBRI at a fixed
+    # place; either counts the frames.
+    mono = b3 >> 6 == 3
+    side = (17 if mono else 32) if mpeg1 else (9 if mono else 17)
+    xing = data[offset + 4 + side:offset + 4 + side + 12]
+    vbri = data[offset + 36:offset + 36 + 18]
+    frames = None
+    if xing[:4] in ('Xing', 'Info') and len(xing) == 12 and \
+            ord(xing[7]) & 1:
+        frames = struct.unpack('>I', xing[8:12])[0]
+    elif vbri.startswith('VBRI'):
+        frames = struct.unpack('>I', vbri[14:18])[0]
+    if frames:
+        return float(frames) * samples / rate
+
+    # A constant bitrate, then, across whatever lies between the first
+    # frame and an ID3v1 tag.
+    f.seek(0, 2)
+    size = f.tell() - start - offset
+    if size > 128:
+        f.seek(-128, 2)
+        if f.read(3) == 'TAG':
+            size -= 128
+    return size * 8.0 / (bitrate * 1000)
+# End of _mp3_duration function
 
 
 # TODO: Make it easier to get a list from sortfiles (?)
@@ -241,10 +1695,236 @@ def sortfiles(files):
             """'Testfile_No._22_[CRC32CRC].ext'])
     ['Testfile_No._22_[CRC32CRC].ext', """\
             """'Another_Testfile_No._23_[CRC32CRC].ext']
+    >>> sortfiles(['Show.S02E01.mkv', 'Show.S01E10.mkv', 'Show.S01E02.mkv'])
+    ['Show.S01E02.mkv', 'Show.S01E10.mkv', 'Show.S02E01.mkv']
     """
 
-    # TODO: Allow sorting of files in format SXXEYY
-    return sorted(files, key=lambda number: getseqnum(number))
+    return [file_ for file_, key in sortentries(files)]
+
+
+def sortentries(files):
+    """Returns (file, key) pairs for files, sorted by key, so """\
+            """playlists can reuse the keys sorting found.
+
+    Attributes:
+        files -- unsorted list of filenames
+    >>> sortentries(['Show_03.mkv', 'Show_01.mkv', 'Notes.txt'])
+    ... # doctest: +NORMALIZE_WHITESPACE
+    [('Show_01.mkv', (0, 0, 0, 1, 1, 0, 1)),
+     ('Show_03.mkv', (0, 0, 0, 3, 3, 0, 1)),
+     ('Notes.txt', (1, 0, 0, 0, 0, 0, 1))]
+    """
+
+    entries = zip(files, getkeys(files))
+    # Sorting by key alone keeps files with the same key in the order
+    # they were given, as sorted() is stable.
+    entries.sort(key=lambda entry: entry[1])
+    return entries
+
+
+def _entries(file_list, batch=4096):
+    """Yields file_list as (file, key) pairs, working out the keys """\
+            """for plain filenames a batch at a time."""
+    for files in _batches(file_list, batch):
+        if not isinstance(files[0], tuple):
+            files = zip(files, getkeys(files))
+        for entry in files:
+            yield entry
+
+
+# Everything getkeys() looks for in a filename, as one pattern, so a
+# name is scanned only once. Tokens only start at the beginning of a
+# word, so getkeys() puts a separator in front of each name and the
+# pattern starts by matching one: the regex engine then skips quickly
+# from one separator to the next, and only tries the tokens at those
+# that are followed by something a token could start with. Tokens are
+# grouped by their first character, so few are tried at each. Within
+# each group, alternatives are tried in order; those without numbers
+# to keep only stop the rest from seeing numbers that aren't episode
+# numbers.
+_TOKENS = r'''
+    # Tokens starting with a digit, or with E or # for episodes.
+    (?=[0-9Ee\#]) (?:
+        # Resolutions, bit depths and bracketed years.
+        (?:\d{3,4}(?:[pPiI]|x\d{3,4})|\d{1,2}-?bit|(?:19|20)\d\d(?=[\])]))
+            (?![0-9A-Za-z])
+        # CRC32s.
+      | [0-9A-Fa-f]{8}(?![0-9A-Za-z])
+        # 1x02 and 1x02-03.
+      | (?P<x_season>\d{1,2})[xX](?P<x_first>\d{2,3})
+            (?:-(?P<x_last>\d{2,3}))?(?![0-9])
+        # Anything else: 05, E05, Ep05, #05, 05v2 and ranges like 01-02.
+      | (?:[Ee]p(?:isode)?[ ._]?|[Ee]|\#)?(?P<n_first>\d{1,4})
+            (?:v(?P<n_version>\d{1,2}))?
+            (?:[-~](?P<n_last>\d{1,4})(?:v\d{1,2})?)?(?![0-9])
+      )
+    # Codecs, audio extensions, and CRC32s starting with a letter.
+    | (?:[xXhH]\.?26[45]|[mM][pP][34]|[0-9A-Fa-f]{8})(?![0-9A-Za-z])
+    # S01E02, S01E02E03 and S01E02-03.
+    | [Ss](?P<s_season>\d{1,3})[ ._-]?[Ee](?P<s_first>\d{1,4})
+        (?:(?:-?[Ee]|-)(?P<s_last>\d{1,4}))?(?![0-9])
+    | (?:[Dd]is[ck]|CD|cd|DVD|dvd)[ ._-]?(?P<d_number>\d{1,2})(?![0-9])
+    | (?:[Pp]art|[Pp]t)[ ._-]?(?P<p_number>\d{1,2})(?![0-9])
+    | [vV](?P<v_number>\d{1,2})(?![0-9A-Za-z])
+'''
+_token_re = re.compile(r'[^0-9A-Za-z] (?=[0-9SsXxHhMmDdCcPpVvEe\#]) (?:' +
+        _TOKENS + ')', re.X)
+
+# The same tokens, and then numbers run on from a word, as in Track01
+# or Disc1Track02, for names _token_re found no episode number in. The
+# tokens still have to be matched, or a CRC32 starting with a letter
+# could give up its digits.
+_tail_re = re.compile(r'''[^0-9A-Za-z] (?:''' + _TOKENS + r''')
+    | (?<=[A-Za-z]) (?P<tail>\d{1,4}) (?![0-9A-Za-z])''', re.X)
+
+# A quick look for any such number at all, before scanning for them
+# properly. Codecs and audio extensions would only waste the scan.
+_run_on_re = re.compile(
+        r'[A-Za-z](?<![mM][pP])(?<![xXhH])\d{1,4}(?![0-9A-Za-z])')
+
+
+def getkeys(files):
+    """Returns a sort key for each of files, for a whole directory """\
+            """listing at once.
+
+    Each key is a tuple of (extra, disc, season, episode, last, part,
+    version): extra is 1 for files without an episode number, which
+    sort after the rest; last is the end of a range of episodes; and
+    version is 2 or more for revised releases.
+
+    Attributes:
+        files -- list of filenames
+
+    Examples:
+    >>> getkeys(['Show.S01E02.720p.HDTV.x264.mkv', 'Show 1x03.avi',
+    ...         'Show.S01E04E05.mkv', 'Show.S01E06-07.mkv'])
+    ... # doctest: +NORMALIZE_WHITESPACE
+    [(0, 0, 1, 2, 2, 0, 1), (0, 0, 1, 3, 3, 0, 1),
+     (0, 0, 1, 4, 5, 0, 1), (0, 0, 1, 6, 7, 0, 1)]
+    >>> getkeys(['[Group] Show - 01-02 [1080p][DEADBEEF].mkv',
+    ...         '[Group] Show - 12v2 [0123ABCD].mkv', 'Show - 12 [v3].mkv'])
+    ... # doctest: +NORMALIZE_WHITESPACE
+    [(0, 0, 0, 1, 2, 0, 1), (0, 0, 0, 12, 12, 0, 2),
+     (0, 0, 0, 12, 12, 0, 3)]
+    >>> getkeys(['Movie Disc 2 Part 1.avi', 'Movie CD1.avi',
+    ...         'Show Ep07 (2013).mkv', '03 - Track.mp3', 'NCOP.mkv'])
+    ... # doctest: +NORMALIZE_WHITESPACE
+    [(1, 2, 0, 0, 0, 1, 1), (1, 1, 0, 0, 0, 0, 1), (0, 0, 0, 7, 7, 0, 1),
+     (0, 0, 0, 3, 3, 0, 1), (1, 0, 0, 0, 0, 0, 1)]
+    """
+
+    # findall() gives every group of every token, in the order they
+    # appear in _TOKENS; those a token doesn't have are empty.
+    findall = _token_re.findall
+    tails = _tail_re.findall
+    run_on = _run_on_re.search
+
+    keys = []
+    append = keys.append
+    for filename in files:
+        season = first = last = None
+        disc = part = 0
+        version = 1
+        # Whether first came from S01E02 or 1x02, which outranks any
+        # plain number.
+        marked = False
+
+        for (x_season, x_first, x_last, n_first, n_version, n_last,
+                s_season, s_first, s_last, d_number, p_number,
+                v_number) in findall('/' + filename):
+            if n_first:
+                if first is None:
+                    first, last = n_first, n_last
+                    if n_version:
+                        version = int(n_version)
+            elif s_season:
+                if not marked:
+                    marked = True
+                    season, first, last = s_season, s_first, s_last
+            elif x_season:
+                if not marked:
+                    marked = True
+                    season, first, last = x_season, x_first, x_last
+            elif d_number:
+                disc = int(d_number)
+            elif p_number:
+                part = int(p_number)
+            elif v_number:
+                version = int(v_number)
+
+        # Failing all else, a number run on from a word will do.
+        if first is None and run_on(filename):
+            for token in tails('/' + filename):
+                if token[-1]:
+                    first = token[-1]
+                    break
+
+        if first is None:
+            append((1, disc, 0, 0, 0, part, version))
+        else:
+            first = int(first)
+            append((0, disc, int(season or 0), first,
+                    int(last) if last else first, part, version))
+    return keys
+
+
+def getkey(filename):
+    """Returns the sort key for one filename; see getkeys().
+
+    >>> getkey('Show.S01E02.mkv')
+    (0, 0, 1, 2, 2, 0, 1)
+    >>> getkey('Show - E05.mkv'), getkey('Show E12 720p.mkv')
+    ((0, 0, 0, 5, 5, 0, 1), (0, 0, 0, 12, 12, 0, 1))
+
+    Numbers run on from a word are only used when there's nothing
+    better, so CRC32s and codecs still give theirs up to nothing:
+
+    >>> [getkey(name)[:4] for name in ('Track01.mp3', 'Chapter12.mkv',
+    ...         'Lecture05.mp4', 'AudioTrack3.flac', 'Disc1Track02.flac')]
+    [(0, 0, 0, 1), (0, 0, 0, 12), (0, 0, 0, 5), (0, 0, 0, 3), (0, 1, 0, 2)]
+    >>> getkey('NCOP [AB12CD34].mkv'), getkey('Intro.x264.mkv')
+    ((1, 0, 0, 0, 0, 0, 1), (1, 0, 0, 0, 0, 0, 1))
+    """
+    return getkeys([filename])[0]
+
+
+def _label(key):
+    """Returns how a playlist should number a file with key, or """\
+            """None for an extra.
+
+    >>> _label(getkey('Show.S01E02-03.mkv')), _label(getkey('Show_22.avi'))
+    ('S01E02-03', '22')
+    >>> _label(getkey('Movie CD2 Part 1.avi')), _label(getkey('Notes.txt'))
+    (None, None)
+    """
+    extra, disc, season, first, last, part, version = key
+    if extra:
+        return None
+    if season:
+        label = 'S{:02d}E{:02d}'.format(season, first)
+        if last != first:
+            label += '-{:02d}'.format(last)
+    else:
+        label = str(first)
+        if last != first:
+            label += '-' + str(last)
+    if disc:
+        label = 'Disc {} {}'.format(disc, label)
+    if part:
+        label += ' Part {}'.format(part)
+    return label
+
+
+def getseqnums(files):
+    """Returns the sequence number of each of files, as getseqnum() """\
+            """would, for a whole directory listing at once.
+
+    Attributes:
+        files -- list of filenames
+    >>> getseqnums(['Testfile_No._22_[CRC32CRC].ext', 'Extras.ext'])
+    [22, 9999]
+    """
+    return [9999 if key[0] else key[3] for key in getkeys(files)]
 
 
 def getseqnum(filename):
@@ -261,31 +1941,11 @@ def getseqnum(filename):
     23
     """
 
-    # If filename does not contain a non-CRC number, re.findall(...)[0]
-    # will throw an IndexError exception for the empty list produced.
     # TODO: Optional user-specified sorting, maybe?
-    try:
-
-        # Finds and returns (as an integer) a sequence number from
-        # a complex filename. NOTE: May not work with all formats.
-        # NOTE: This can probably be cleaned up for readability.
-        # Explanation:
-        # - filename[::-1]: reverse the string; essentially starts
-        #                     re.sub from last character
-        # - re.sub(..., 1)[::-1]: replace CRC32s with a single 'X'
-        #                         and unreverse string
-        # - int.findall(...)[0]: find all occurrences of one or more
-        #                        numbers, and reference only the first
-        # - int(...): cast string from re.findall() to int; key in
-        #             sorted() only takes an integer?
-        return int(re.findall('([0-9]+)', re.sub('[0-9A-Fa-f]{8}',
-            'X', filename[::-1], 1)[::-1])[0])
-
-    # If the filename did not contain a sequence number, return
+    # If the filename did not contain a sequence number, we get
     # something unreasonably large to place it at the end of the
     # sorted list.
-    except IndexError:
-        return 9999
+    return getseqnums([filename])[0]
 
 
 # Begin customized module Exceptions.
@@ -338,17 +1998,72 @@ if __name__ == "__main__":
             help='starting directory')
     parser.add_argument('-t', '--playlist-type', default='pls',
             choices=['pls', 'm3u'], help='type of playlist to create')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+            help='number of directories to write playlists for at once')
+    parser.add_argument('-e', '--extended', action='store_true',
+            help='give the length of each entry, reading it from the \
+                    files where it is not already known')
+    parser.add_argument('-o', '--output', metavar='FILE',
+            help="write one playlist for the whole tree to FILE ('-' for \
+                    standard output) instead")
+    parser.add_argument('-d', '--dedupe', action='store_true',
+            help='leave all but the first copy of duplicate files out of \
+                    playlists')
+    parser.add_argument('--duplicates', action='store_true',
+            help='list duplicate files, rather than writing playlists')
+    parser.add_argument('--verify', action='store_true',
+            help='check files against the CRC32s in their names, rather \
+                    than writing playlists')
+    parser.add_argument('-c', '--catalog', action='store_true',
+            help='keep a catalog of the tree, and write the playlist for \
+                    --output from it rather than walking the tree')
+    parser.add_argument('--under', metavar='DIR',
+            help='with --catalog, only list files below DIR')
+    parser.add_argument('--recent', type=int, metavar='N',
+            help='with --catalog, only list the N files most recently \
+                    added, newest first')
     parser.add_argument('-v', '--version', action='version',
             version='%(prog)s ' + __version__)
     args = parser.parse_args()
 
-    # FIXME: makeplaylist does not like non-default values of
-    #        args.playlist_type
     # TODO: Don't know if I want this to run with a default anymore
-    if args.directory is not None:
-        makeplaylist(args.directory, args.playlist_type)
+    if args.duplicates:
+        wasted = 0
+        for group in duplicates(args.directory or os.getcwd(),
+                max(args.jobs, 4)):
+            print '\n'.join(group) + '\n'
+            wasted += os.path.getsize(group[0]) * (len(group) - 1)
+        print '{:.1f} MiB in duplicate copies'.format(wasted / 1048576.0)
+    elif args.verify:
+        checked = bad = 0
+        for path, tagged, actual in verify(args.directory or os.getcwd(),
+                max(args.jobs, 4)):
+            checked += 1
+            if actual is None:
+                bad += 1
+                print '{} could not be read.'.format(path)
+            elif actual != tagged:
+                bad += 1
+                print '{} is {}, not {}.'.format(path, actual, tagged)
+        print '{} of {} files failed.'.format(bad, checked)
+        sys.exit(1 if bad else 0)
+    elif args.catalog:
+        catalog = Catalog(args.directory or os.getcwd())
+        try:
+            catalog.refresh()
+            catalog.playlist(args.output or '-', args.playlist_type,
+                    args.under, args.recent, args.extended)
+        finally:
+            catalog.close()
+    elif args.output is not None:
+        treeplaylist(args.directory or os.getcwd(), args.output,
+                args.playlist_type, args.extended)
+    elif args.directory is not None:
+        makeplaylist(args.directory, args.playlist_type, jobs=args.jobs,
+                extended=args.extended, dedupe=args.dedupe)
     else:
-        makeplaylist(playlist_type=args.playlist_type)
+        makeplaylist(playlist_type=args.playlist_type, jobs=args.jobs,
+                extended=args.extended, dedupe=args.dedupe)
 
 
 # vim: set ts=4 sts=4 sw=4 et tw=79:
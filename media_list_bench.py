@@ -0,0 +1,113 @@
+#!/usr/bin/env python2
+#
+# Copyright (C) 2013 Dylan Steinmetz <dtsteinm@gmail.com>
+# This work is free. You can redistribute it and/or modify it under the
+# terms of the Do What The Fuck You Want To Public License, Version 2,
+# as published by Sam Hocevar. See the COPYING file for more details.
+
+"""Benchmark media_list's sort key extraction against synthetic """ \
+        """directory listings."""
+import re
+import time
+import random
+
+import media_list
+
+__all__ = ['make_names', 'bench']
+__author__ = 'Dylan Steinmetz <dtsteinm@gmail.com>'
+__version__ = '0.1'
+__license__ = 'WTFPL'
+
+
+def make_names(count, seed=0):
+    """Returns count filenames, in the styles a media library tends """ \
+            """to hold, in no particular order."""
+    rand = random.Random(seed)
+    styles = (
+            '[Group] Show Name - {n:03d} [{crc:08X}].mkv',
+            'Show.Name.S01E{n:02d}.720p.HDTV.x264-GROUP.mkv',
+            'Another_Testfile_No._{n}_[{crc:08X}].avi',
+            '{n:02d} - Track Title.mp3',
+            'Extras - Interview {crc:08x}.mp4',
+            )
+    return [rand.choice(styles).format(n=rand.randint(1, 999),
+            crc=rand.getrandbits(32)) for _ in xrange(count)]
+
+
+def _legacy_getseqnum(filename):
+    """getseqnum() as it was, for comparison."""
+    try:
+        return int(re.findall('([0-9]+)', re.sub('[0-9A-Fa-f]{8}',
+            'X', filename[::-1], 1)[::-1])[0])
+    except IndexError:
+        return 9999
+
+
+def _legacy(names):
+    """Sorts, then works out each number again for each playlist, """ \
+            """as makeplaylist() used to for PLS and M3U together."""
+    for playlist in xrange(2):
+        files = sorted(names, key=_legacy_getseqnum)
+        for file_ in files:
+            _legacy_getseqnum(file_)
+
+
+def _batched(names):
+    """Works out each sort key once, and shares it between playlists."""
+    entries = media_list.sortentries(names)
+    for playlist in xrange(2):
+        for file_, key in entries:
+            pass
+
+
+def _timed(func, *args):
+    start = time.time()
+    func(*args)
+    return time.time() - start
+
+
+def bench(sizes=(10000, 100000, 1000000)):
+    """Times the old and new key extraction on listings of each size.
+
+    Returns a list of dictionaries, one for each size.
+    """
+    results = []
+    for size in sizes:
+        names = make_names(size)
+        keys = _timed(lambda: [_legacy_getseqnum(n) for n in names])
+        batch = _timed(media_list.getseqnums, names)
+        legacy = _timed(_legacy, names)
+        batched = _timed(_batched, names)
+        results.append({'size': size, 'keys': keys, 'batch': batch,
+                'legacy': legacy, 'batched': batched})
+    return results
+
+
+def print_results(results):
+    """Prints benchmark results as a table."""
+    print '{:>9} {:>10} {:>10} {:>8} {:>10} {:>10} {:>8}'.format('names',
+            'getseqnum', 'batch', 'speedup', 'old list', 'new list',
+            'speedup')
+    for row in results:
+        print '{size:>9} {keys:>10.3f} {batch:>10.3f} {0:>7.1f}x ' \
+                '{legacy:>10.3f} {batched:>10.3f} {1:>7.1f}x'.format(
+                row['keys'] / row['batch'], row['legacy'] / row['batched'],
+                **row)
+
+
+# If we were called from command line...
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Benchmarks \
+            media_list's sort key extraction")
+    parser.add_argument('-n', '--names', type=int, nargs='+',
+            default=[10000, 100000, 1000000],
+            help='directory listing sizes, in filenames')
+    parser.add_argument('-v', '--version', action='version',
+            version='%(prog)s ' + __version__)
+    args = parser.parse_args()
+
+    print_results(bench(args.names))
+
+# vim: set ts=4 sts=4 sw=4 et tw=79:
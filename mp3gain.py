@@ -7,32 +7,113 @@
 # Last updated: March 28, 2013
 
 """Recursively tag MP3 files with ReplayGain attributes """ \
-        """using the mp3gain utility."""
+        """using the mp3gain utility, or others of its kind for """ \
+        """other formats."""
 import os
+import re
+import sys
+import json
+import time
+import errno
+import signal
+import select
+import ctypes
+import ctypes.util
+import hashlib
+import sqlite3
+import struct
 from math import floor
+import collections
+from collections import namedtuple
 import subprocess as sp
-import tempfile as temp
+import threading
+import Queue
 
-__all__ = ['walk', 'mp3gain']
+__all__ = ['walk', 'start', 'Walker', 'watch', 'gain', 'mp3gain', 'Result',
+        'Backend', 'register_backend', 'get_backend', 'which', 'StateIndex',
+        'read_tags', 'album_tagged', 'Journal', 'Progress', 'merge_reports']
 __author__ = 'Dylan Steinmetz <dtsteinm@gmail.com>'
 __version__ = '0.9.4'
 __license__ = 'WTFPL'
 
+# Where walk() remembers which albums it has already processed.
+DEFAULT_INDEX = os.path.join(os.getenv('XDG_CACHE_HOME') or
+        os.path.join(os.path.expanduser('~'), '.cache'),
+        'mp3gain', 'index.sqlite')
 
-# walk looks for directories containing mp3 files,
-# and calls mp3gain() when we have something to do.
-# TODO: Add vorbisgain and aacgain support, look at python-rgain
+# Where walk() keeps track of how far it got, for --resume.
+DEFAULT_JOURNAL = os.path.join(os.path.dirname(DEFAULT_INDEX),
+        'journal.jsonl')
+
+
+# walk looks for directories containing audio files,
+# and calls gain() when we have something to do.
 def walk(start_dir=os.getcwd(), **kwargs):
     """Traverses the filesystem structure, looking for directories """ \
-            """containing MP3 files, and calls mp3gain() when appropriate.
+            """containing audio files, and calls gain() with the """ \
+            """appropriate utility for each of them.
 
     Attributes:
         start_dir -- root directory to begin looking in
         force -- force recalculation on all files and assume mp3s
         skip -- skip ReplayGain calculation for files with existing tags
         clear -- delete ReplayGain tags
-
-    Example: mp3gain.walk('/path/to/Music')
+        jobs -- number of directories to process at once (1)
+        per_device -- most jobs to run at once on any one device
+        devices -- dictionary of paths to the most jobs to run at once
+                   on the device each is on, overriding per_device
+        largest -- process the largest directories first
+        plan -- only print what would be done, and how long it should
+                take
+        speed -- bytes a second one job gets through, for the plan's
+                 estimate (as measured by earlier walks)
+        shard -- (i, n) to process only the i-th of n shares of the
+                 directories, from 1 to n
+        shard_root -- directory the shares are made of, if start_dir
+                      is only part of it (start_dir)
+        index -- path to the state index, or None to disable it
+        backends -- names of the gain utilities to use (all of them)
+        report -- file to write each Result to, as JSON lines
+        timeout -- seconds to allow each utility run before giving up
+        cancel -- threading.Event; once set, nothing new is started
+        journal -- path to the run journal, or None to disable it
+        resume -- carry on from the journal of an unfinished walk
+        rate -- most times a second to redraw the progress bar (4)
+        metrics -- file to append progress counters to, as JSON lines
+        prometheus -- file to keep the counters in, in Prometheus's
+                      text format
+        interval -- seconds between writes of the counters (10)
+
+    Ctrl-C skips whatever is being processed; pressing it twice in
+    quick succession stops the walk altogether.
+
+    Directories whose MP3s have not changed since they were last
+    processed successfully are skipped; force bypasses the index, and
+    clear removes the directories it touches from it.
+
+    Each directory is written to the journal as it is started and
+    finished, so a walk cut short by a crash or Ctrl-C can be resumed
+    without starting over; resuming skips the directories that were
+    finished, and retries those that failed or were still in progress.
+
+    With several jobs, per_device keeps them from fighting over one
+    disk: directories on different devices are processed side by side,
+    while those on a slow disk can be taken one at a time. Faster
+    devices can be given more through devices.
+
+    Finding the largest directories means finding everything before
+    starting anything, but keeps one huge box set from holding up the
+    end of a parallel walk.
+
+    Sharding splits a library between machines that can all reach it,
+    without them talking to each other: each directory belongs to the
+    share its path (relative to start_dir) hashes to, and each share
+    keeps its own journal, report and index; see merge_reports(). An
+    index shared over NFS would not be safe to write from several
+    machines at once.
+
+    Example: mp3gain.walk('/path/to/Music', jobs=4, per_device=1,
+            devices={'/path/to/Music/ssd': 4})
     """
 
     # Clean up supplied directory (whitespace, trailing /).
@@ -44,8 +125,36 @@ def walk(start_dir=os.getcwd(), **kwargs):
     force = kwargs.pop('force', False)
     skip = kwargs.pop('skip', False)
     clear = kwargs.pop('clear', False)
-
-    # Create a dictionary of options to override mp3gain()'s defaults.
+    jobs = max(1, int(kwargs.pop('jobs', 1)))
+    index_path = kwargs.pop('index', DEFAULT_INDEX)
+    backends = kwargs.pop('backends', None)
+    report_path = kwargs.pop('report', None)
+    timeout = kwargs.pop('timeout', None)
+    cancel = kwargs.pop('cancel', None)
+    journal_path = kwargs.pop('journal', DEFAULT_JOURNAL)
+    resume = kwargs.pop('resume', False)
+    per_device = kwargs.pop('per_device', None)
+    devices = kwargs.pop('devices', None) or {}
+    largest = kwargs.pop('largest', False)
+    plan = kwargs.pop('plan', False)
+    speed = kwargs.pop('speed', None)
+    shard = kwargs.pop('shard', None)
+    shard_root = kwargs.pop('shard_root', None)
+    # The utilities this walk has running, kept apart from any other
+    # walk's, so stopping ours leaves theirs alone. A Walker passes its
+    # own in, to be able to cancel us.
+    running = kwargs.pop('running', None) or _Running()
+    progress_options = dict((key, kwargs.pop(key)) for key in
+            ('rate', 'metrics', 'prometheus', 'interval') if key in kwargs)
+
+    # A device allowed no jobs at all would never get any started, and
+    # the walk would wait on it for ever.
+    for limit in [per_device] + devices.values():
+        if limit is not None and limit < 1:
+            raise ValueError('device job limits must be at least 1, not '
+                    '{!r}'.format(limit))
+
+    # Create a dictionary of options to override gain()'s defaults.
     options = {}
     if force:
         options['recalc'] = True
@@ -54,93 +163,208 @@ def walk(start_dir=os.getcwd(), **kwargs):
         options['skip'] = True
     if clear:
         options['delete'] = True
+    if timeout:
+        options['timeout'] = timeout
+
+    # Only look for files handled by the utilities we were asked for.
+    registry = dict((ext, backend) for ext, backend in BACKENDS.iteritems()
+            if backends is None or backend.name in backends)
 
     # Flag to indicate work was done.
     flag = False
 
-    # Anonymous function to check for dotfiles
-    dot_check = lambda name: name.startswith('.')
+    # Directories gain() was unable to process.
+    failed = []
 
-    try:
-        # Check to see if the mp3gain utility is installed.
-        if sp.call('/usr/bin/mp3gain -v', shell=True,
-                stderr=sp.STDOUT, stdout=sp.PIPE) is 127:
-            raise NoExecutableError()
-
-        # Check to make sure we're working in a real directory.
-        if os.path.isdir(start_dir) is False:
-            raise DirectoryError(start_dir)
+    # Directories left alone because the index says nothing changed,
+    # because every file already carries ReplayGain tags, or because
+    # the walk we're resuming had already finished them.
+    skipped = {'unchanged': 0, 'tagged': 0, 'resumed': 0, 'shard': 0}
 
-        # Need to get a count of how many directories we're traveling.
-        # We also have to count which directory we are in.
-        total = 0
-        count = 0
-
-        # Let's make an initial directory count of the files
-        # Pre-emptive walk gathering the numbers of directories
-        # (info[1] is equivalent to pathnames in the next for loop).
-        for info in os.walk(start_dir):
-            total += len(info[1])
-        # We need this as a float, otherwise the math will be off.
-        total = float(total)
-
-        # Iterate filesystem structure, checking each list of files contained
-        # in each directory for anything that resembles an MP3 file.
-        for basedir, pathnames, files in os.walk(start_dir):
-
-            # Better safe than sorry: let's verify it's a real directory.
-            # And since it was skipped, we can forget about it.
-            if os.path.isdir(basedir) is False:
-                total -= 1
-                raise DirectoryError(basedir)
-
-            # Skip hidden directories (dotfiles)
-            # Same as above with hidden files.
-            for pathname in pathnames:
-                if dot_check(pathname):
-                    total -= 1
-                    pathnames.remove(pathname)
-
-            # We need to check each file in the current basedir,
-            # as the first file_ in our list may not be an MP3.
-            for file_ in files:
-                try:
+    # Utilities we found missing, and how many jobs went undone.
+    missing = {}
 
-                    # Skip to next file_ on hidden files
-                    if dot_check(file_):
-                        continue
+    # Tracks that would clip with their suggested gain applied.
+    clipping = 0
 
-                    # Call mp3gain when we hit a directory containing MP3s.
-                    # Passes options as expanded dictionary mapping.
-                    # TODO: Look into mutli-threading to speed up this process.
-                    if '.mp3' == os.path.splitext(file_)[1]:
-                        mp3gain(basedir, **options)
+    index = None
+    report = None
+    journal = None
+    progress = None
 
-                        # Raise our flag
-                        flag = True
+    # Look for each utility afresh once per walk, in case it has been
+    # installed or moved since the last one.
+    _executables.clear()
 
-                        # This directory is done, so we can go to the next one.
-                        break
+    try:
+        # Check to make sure we're working in a real directory.
+        if os.path.isdir(start_dir) is False:
+            raise DirectoryError(start_dir)
 
-                # If we looked at a non-existent directory (deleted while
-                # running?), just go on to the next one on our walk
-                except DirectoryError:
-                    pass
-                # TODO: Allow user to break out of entire program,
-                # like <C-c><C-c>
-                # except:
-                    # print '\nQuitting...'
-                    # return 1
-                finally:
-                    # The directories add up.
-                    count += 1
-                    # FIXME: Breaks completely on directories without
-                    # MP3 files.
-                    print_progress(count, total)
-
-                # End of inner isdir() try...except
-            # End of files loop
-        # End of os.walk() loop
+        # Keep each share's records apart from the others'.
+        if shard:
+            journal_path = _shard_path(journal_path, shard)
+            report_path = _shard_path(report_path, shard)
+            index_path = _shard_path(index_path, shard)
+
+        # A plan leaves everything as it was; it only looks at the
+        # journal to see what a resumed walk would do.
+        if plan:
+            journal_path = journal_path if resume else None
+            report_path = None
+            progress_options['rate'] = 0
+
+        # Pick up where an interrupted walk left off; the progress bar
+        # counts whatever it already finished as done.
+        if journal_path:
+            journal = Journal(journal_path, start_dir, resume, readonly=plan)
+            if journal.finished:
+                print 'Resuming from {}.'.format(journal_path)
+
+        # A plan only looks at an index some earlier walk left behind.
+        if index_path and not plan:
+            index = StateIndex(index_path)
+        elif index_path and os.path.isfile(index_path):
+            index = StateIndex(index_path, readonly=True)
+
+        if report_path:
+            report = open(report_path, 'a')
+
+        progress = Progress(**progress_options)
+
+        # Albums with jobs still running, and how many are left.
+        pending = {}
+        # The size of each job, by (directory, utility).
+        sizes = {}
+
+        def find_work():
+            """Yields a job for each utility each album needs, as the
+            traversal finds them, so a directory of mixed formats is
+            still handled in one pass."""
+            for basedir, files in _find_albums(start_dir, registry):
+                if shard and not _in_shard(shard_root or start_dir,
+                        basedir, shard):
+                    skipped['shard'] += 1
+                    continue
+
+                groups = _group_files(files, registry)
+
+                if journal is not None and journal.completed(basedir):
+                    skipped['resumed'] += 1
+                    progress.resume(len(groups))
+                    continue
+
+                # Drop albums that haven't changed since our last
+                # visit. A forced run wants everything, and clearing
+                # tags should work whether or not we've seen the album
+                # before.
+                if index is not None and not (force or clear) and \
+                        index.unchanged(basedir, files):
+                    skipped['unchanged'] += 1
+                    continue
+
+                album = []
+                for backend, names in groups:
+                    # Reading the tags ourselves is far cheaper than
+                    # starting mp3gain just to find out there's nothing
+                    # for it to do.
+                    if backend.name == 'mp3gain' and \
+                            not (force or clear or skip) and \
+                            album_tagged(basedir, names):
+                        skipped['tagged'] += 1
+                        continue
+                    # Leave the work of missing utilities undone.
+                    if backend not in missing and not backend.available():
+                        missing[backend] = 0
+                        _report('\nThe {} utility is not installed; '
+                                'skipping its directories.'.format(
+                                backend.name))
+                    if backend in missing:
+                        missing[backend] += 1
+                        continue
+                    album.append((basedir, backend, names))
+
+                # Anything left undone means it isn't finished with.
+                whole = not any(backend in missing for backend, _ in groups)
+
+                progress.directory()
+                # Nothing left to do here; it's as good as processed.
+                if not album:
+                    if whole and not plan:
+                        _finished(index, basedir, files, **options)
+                        if journal is not None:
+                            journal.finish(basedir, 'tagged')
+                    progress.directory_done()
+                    continue
+
+                pending[basedir] = [files, len(album), whole]
+                for job in album:
+                    size = sizes[basedir, job[1].name] = _size(basedir,
+                            job[2])
+                    progress.found(len(job[2]), size)
+                    yield job
+            progress.scanned()
+
+        def process(job):
+            if journal is not None:
+                journal.start(job[0])
+            return gain(job[0], job[1], job[2], running=running, **options)
+
+        # Limits for particular devices, by the paths we were given.
+        limits = {}
+        for path, limit in devices.iteritems():
+            limits[os.stat(path).st_dev] = limit
+
+        work = find_work()
+        if largest or plan:
+            work = sorted(work, reverse=True,
+                    key=lambda job: sizes[job[0], job[1].name])
+        if plan:
+            if speed is None and index is not None:
+                speed = index.speed()
+            _print_plan(work, sizes, jobs, speed)
+            return
+
+        # Process each job, possibly several at once. Results come
+        # back in whatever order the jobs finish, so the progress bar
+        # only counts completed jobs.
+        for (basedir, backend, names), results in _run_jobs(process,
+                work, jobs, cancel, key=lambda job: _device(job[0]),
+                limit=lambda device: limits.get(device, per_device),
+                running=running):
+            flag = True
+            album = pending.get(basedir)
+
+            for result in results or ():
+                if result.file is not None and result.clipping:
+                    clipping += 1
+                if report is not None:
+                    report.write(result.json() + '\n')
+
+            if results is None:
+                failed.append(basedir)
+                # Don't record the album when any of it went wrong.
+                if pending.pop(basedir, None) is not None:
+                    progress.directory_done()
+                    if journal is not None:
+                        journal.finish(basedir, 'failed')
+            elif album is not None:
+                album[1] -= 1
+                if not album[1]:
+                    if album[2]:
+                        _finished(index, basedir, album[0], **options)
+                        if journal is not None:
+                            journal.finish(basedir, 'ok')
+                    progress.directory_done()
+                    del pending[basedir]
+
+            # The jobs add up.
+            progress.done(len(names), sizes.pop((basedir, backend.name), 0))
+        # End of _run_jobs() loop
+
+        # Nothing we could do without the utilities we needed.
+        if missing and not flag:
+            raise NoExecutableError(min(missing, key=lambda b: b.name).name)
 
     # Quit on DirectoryError not caught inside for loop.
     # Initial directory doesn't exist, so there's nothing to do.
@@ -151,7 +375,11 @@ def walk(start_dir=os.getcwd(), **kwargs):
     except NoExecutableError:
         print 'Quitting...'
 
-    # User hit Ctrl-C outside of
+    # User hit Ctrl-C twice, or while outside of gain(); stop
+    # anything still running on the way out.
+    except KeyboardInterrupt:
+        running.stop_all()
+        print '\nQuitting...'
 
     # Any other errors encountered were too much for us to handle.
     except:
@@ -160,23 +388,1003 @@ def walk(start_dir=os.getcwd(), **kwargs):
 
     # Made it out of the for loop with no additional errors.
     else:
+        progress.close()
+
+        # Remember how fast we went, for planning the next walk.
+        counters = progress.counters()
+        if index is not None and counters['bytes_done']:
+            index.record_speed(counters['bytes_done'], counters['elapsed'] *
+                    min(jobs, counters['jobs_done']))
+
+        # Nothing left to resume, unless we were cancelled part way.
+        if journal is not None and not (cancel and cancel.is_set()):
+            journal.complete()
+
         # Print a message indicating whether or not files had been processed.
         if flag is True:
             print '\nFinished processing files!'
         else:
             print '\nNo files to process!'
 
-    # Generic completion block for messages like '...done!' after
-    # try block has finished. (currently empty)
+        for reason, message in (('resumed', 'finished before resuming'),
+                ('unchanged', 'unchanged'), ('tagged', 'already tagged'),
+                ('shard', "other shards'")):
+            if skipped[reason]:
+                print 'Skipped {} {} director{}.'.format(skipped[reason],
+                        message, 'y' if skipped[reason] == 1 else 'ies')
+        for backend, count in sorted(missing.items(),
+                key=lambda item: item[0].name):
+            if count:
+                print 'Skipped {} director{} needing {}.'.format(count,
+                        'y' if count == 1 else 'ies', backend.name)
+        if clipping:
+            print '{} track{} would clip at the suggested gain.'.format(
+                    clipping, '' if clipping == 1 else 's')
+
+        # Directories with errors were reported as they happened, but
+        # they are easy to lose behind the progress bar.
+        if failed:
+            print '{} director{} could not be processed:'.format(
+                    len(failed), 'y' if len(failed) == 1 else 'ies')
+            for basedir in sorted(failed):
+                print '  {}'.format(basedir)
+
+    # Whatever happened, keep what we've learned for next time.
     finally:
-        pass
-        # print total, count
+        # Leave the bar as it was if we're on our way out early.
+        if progress is not None:
+            progress.close(draw=False)
+        if index is not None:
+            index.close()
+        if report is not None:
+            report.close()
+        if journal is not None:
+            journal.close()
 
     # End of outer isdir() try...except block
 # End of walk() function
 
 
-# mp3gain is where we do our actual work.
+def _dot_check(name):
+    """Checks for hidden files and directories (dotfiles)."""
+    return name.startswith('.')
+
+
+def _find_albums(start_dir, registry=None):
+    """Yields (directory, filenames) for each directory beneath """ \
+            """start_dir containing files one of our utilities can """ \
+            """handle, skipping hidden files and directories."""
+
+    if registry is None:
+        registry = BACKENDS
+
+    for basedir, pathnames, files in os.walk(start_dir):
+        # Skip hidden directories; os.walk() won't descend into
+        # anything we remove from pathnames.
+        pathnames[:] = [p for p in pathnames if not _dot_check(p)]
+
+        # We need to check each file in the current basedir,
+        # as the first file_ in our list may not be audio.
+        audio = [file_ for file_ in files if not _dot_check(file_) and
+                os.path.splitext(file_)[1].lower() in registry]
+        if audio:
+            yield basedir, audio
+# End of _find_albums() function
+
+
+def _group_files(files, registry=None):
+    """Splits files up by the utility that handles them, returning """ \
+            """a list of (backend, filenames) pairs.
+
+    >>> [(b.name, names) for b, names in _group_files(['a.mp3', 'b.flac'])]
+    [('metaflac', ['b.flac']), ('mp3gain', ['a.mp3'])]
+    """
+
+    if registry is None:
+        registry = BACKENDS
+
+    groups = {}
+    for file_ in sorted(files):
+        backend = registry.get(os.path.splitext(file_)[1].lower())
+        if backend is not None:
+            groups.setdefault(backend, []).append(file_)
+    return sorted(groups.items(), key=lambda group: group[0].name)
+
+
+def _finished(index, directory, files, **options):
+    """Updates the state index once every job for a directory is done."""
+
+    # Fingerprint the files after the utilities have rewritten their
+    # tags, otherwise they'll look changed next time around. Files
+    # that were only analysed (skip) still need tagging.
+    if index is None:
+        return
+    if options.get('delete'):
+        index.forget(directory)
+    elif not options.get('skip'):
+        index.record(directory, files)
+
+
+def _size(directory, files):
+    """Returns the total size of files in directory, as best we can."""
+    size = 0
+    for file_ in files:
+        try:
+            size += os.path.getsize(os.path.join(directory, file_))
+        except OSError:
+            pass
+    return size
+
+
+def _in_shard(start_dir, directory, shard):
+    """Checks whether directory falls in shard (i, n) of start_dir.
+
+    >>> [sum(_in_shard('/m', '/m/' + str(d), (i, 3)) for i in (1, 2, 3))
+    ...         for d in xrange(5)]
+    [1, 1, 1, 1, 1]
+    """
+    i, n = shard
+    path = os.path.relpath(directory, start_dir)
+    return int(hashlib.md5(path).hexdigest(), 16) % n == i - 1
+
+
+def _shard_path(path, shard):
+    """Returns a path for shard (i, n) to keep its own copy of a file.
+
+    >>> _shard_path('/tmp/report.jsonl', (2, 3)), _shard_path(None, (2, 3))
+    ('/tmp/report.2of3.jsonl', None)
+    """
+    if not path:
+        return path
+    root, ext = os.path.splitext(path)
+    return '{}.{}of{}{}'.format(root, shard[0], shard[1], ext)
+
+
+def merge_reports(paths, out):
+    """Combines the reports of several shards, or several walks, into """ \
+            """one, sorted by directory and file.
+
+    Where a file appears more than once, the result from the latest
+    report wins. Lines that can't be read, such as one cut short by a
+    crash, are skipped.
+
+    Attributes:
+        paths -- report files to read, oldest first
+        out -- file object to write the combined report to
+
+    Returns the number of results written.
+    """
+    results = collections.OrderedDict()
+    for path in paths:
+        with open(path) as f:
+            for line in f:
+                try:
+                    result = json.loads(line)
+                    key = (result['directory'], result['file'] or '',
+                            result['backend'])
+                except (ValueError, KeyError, TypeError):
+                    continue
+                results[key] = line if line.endswith('\n') else line + '\n'
+    for key in sorted(results):
+        out.write(results[key])
+    return len(results)
+
+
+def _print_plan(work, sizes, jobs=1, speed=None):
+    """Prints the directories a walk would process, largest first, """ \
+            """and how long it should take."""
+
+    # Put each directory's jobs back together.
+    directories = collections.OrderedDict()
+    for basedir, backend, names in work:
+        entry = directories.setdefault(basedir, [0, 0, []])
+        entry[0] += len(names)
+        entry[1] += sizes[basedir, backend.name]
+        entry[2].append(backend.name)
+
+    print '{:>7} {:>10}  {}'.format('Files', 'MB', 'Directory')
+    for basedir, (files, size, backends) in directories.iteritems():
+        print '{:>7} {:>10.1f}  {}{}'.format(files, size / 2.0 ** 20,
+                basedir, '' if backends == ['mp3gain'] else
+                ' ({})'.format(', '.join(backends)))
+
+    files = sum(entry[0] for entry in directories.itervalues())
+    size = sum(entry[1] for entry in directories.itervalues())
+    print '\n{} director{}, {} file{}, {:.1f} MB.'.format(len(directories),
+            'y' if len(directories) == 1 else 'ies', files,
+            '' if files == 1 else 's', size / 2.0 ** 20)
+
+    if not directories:
+        return
+    if not speed:
+        print 'No speed measured yet to estimate how long that will take; ' \
+                'try --speed.'
+        return
+    # No faster than sharing it all out evenly, or than the largest
+    # job on its own.
+    largest = max(sizes[job[0], job[1].name] for job in work)
+    estimate = max(float(size) / min(jobs, len(work)), largest) / speed
+    print 'Estimated time with {} job{}: {} (at {:.1f} MB/s each).'.format(
+            jobs, '' if jobs == 1 else 's', _duration(estimate),
+            speed / 2 ** 20)
+
+
+def _device(directory):
+    """Returns the device directory is on, or None if it's gone."""
+    try:
+        return os.stat(directory).st_dev
+    except OSError:
+        return None
+
+
+def _run_jobs(func, items, jobs=1, cancel=None, key=None, limit=None,
+        running=None):
+    """Calls func on each of items using up to jobs worker threads, """ \
+            """yielding (item, result) pairs as they finish.
+
+    items may be any iterable, and is only read a little ahead of the
+    workers, in the calling thread; a walk can start work as soon as
+    it finds some. With a single job, items are processed in order in
+    the calling thread, so gain() still sees KeyboardInterrupts itself.
+    Otherwise, a KeyboardInterrupt stops the jobs that are running, and
+    only a second one in quick succession stops us. Once cancel (an
+    Event) is set, no new jobs are started.
+
+    Items can be grouped by key(item), with at most limit(key) of each
+    group running at once (None for no limit beyond jobs). When every
+    group with work waiting is at its limit, items are read further
+    ahead to find work for the idle workers.
+
+    Ctrl-C, and leaving early, stop the utilities in running (a
+    _Running), which should be the one func's jobs use.
+
+    >>> sorted(_run_jobs(lambda x: x * 2, [1, 2, 3], jobs=2))
+    [(1, 2), (2, 4), (3, 6)]
+    >>> sorted(_run_jobs(lambda x: x * 2, iter(xrange(20)), jobs=3))[-1]
+    (19, 38)
+    >>> busy, most = {}, {}
+    >>> def job(x):
+    ...     with lock:
+    ...         busy[x % 2] = busy.get(x % 2, 0) + 1
+    ...         most[x % 2] = max(most.get(x % 2, 0), busy[x % 2])
+    ...     time.sleep(0.01)
+    ...     with lock:
+    ...         busy[x % 2] -= 1
+    >>> lock = threading.Lock()
+    >>> len(list(_run_jobs(job, xrange(20), jobs=4, key=lambda x: x % 2,
+    ...         limit=lambda k: 1)))
+    20
+    >>> most
+    {0: 1, 1: 1}
+    """
+
+    cancelled = cancel.is_set if cancel is not None else lambda: False
+    procs = running if running is not None else _running
+
+    if jobs <= 1:
+        for item in items:
+            if cancelled():
+                return
+            yield item, func(item)
+        return
+
+    if key is None:
+        key = lambda item: None
+    if limit is None:
+        limit = lambda group: None
+
+    items = iter(items)
+    results = Queue.Queue()
+    stop = threading.Event()
+
+    # Items waiting to start, and how many are running, for each group.
+    # Workers and the calling thread share these under ready.
+    ready = threading.Condition()
+    waiting = {}
+    running = {}
+    limits = {}
+    state = {'queued': 0, 'exhausted': False}
+
+    def startable():
+        """Returns the groups with work they may start."""
+        return [group for group, queue in waiting.iteritems() if queue and
+                (limits[group] is None or running[group] < limits[group])]
+
+    def worker():
+        while True:
+            with ready:
+                while True:
+                    if stop.is_set() or cancelled():
+                        return
+                    groups = startable()
+                    if groups:
+                        break
+                    if state['exhausted'] and not state['queued']:
+                        return
+                    ready.wait()
+                # Spread the work between groups.
+                group = min(groups, key=running.get)
+                item = waiting[group].popleft()
+                state['queued'] -= 1
+                running[group] += 1
+            # Hand exceptions back to the main thread rather than
+            # losing them along with this thread.
+            try:
+                results.put((item, func(item), None))
+            except Exception as e:
+                results.put((item, None, e))
+            finally:
+                with ready:
+                    running[group] -= 1
+                    ready.notify_all()
+
+    def hungry():
+        """Checks whether we should read more items."""
+        with ready:
+            if state['queued'] < jobs:
+                return True
+            # Workers sitting idle only because their groups are full.
+            return sum(running.itervalues()) < jobs and not startable()
+
+    threads = [threading.Thread(target=worker) for _ in xrange(jobs)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    pending = 0
+    try:
+        while pending or not state['exhausted']:
+            # Keep each worker fed, without reading far ahead of them.
+            while not state['exhausted'] and hungry():
+                try:
+                    if cancelled():
+                        raise StopIteration
+                    item = next(items)
+                    group = key(item)
+                except StopIteration:
+                    with ready:
+                        state['exhausted'] = True
+                        ready.notify_all()
+                    break
+                with ready:
+                    if group not in waiting:
+                        waiting[group] = collections.deque()
+                        running[group] = 0
+                        limits[group] = limit(group)
+                    waiting[group].append(item)
+                    state['queued'] += 1
+                    ready.notify()
+                pending += 1
+            if not pending:
+                break
+
+            # Block with a timeout, otherwise the main thread never
+            # notices a KeyboardInterrupt.
+            try:
+                item, result, error = results.get(timeout=0.1)
+            except Queue.Empty:
+                # Workers quit early once cancelled; there's nothing
+                # more to wait for once they're gone.
+                if not any(thread.is_alive() for thread in threads) and \
+                        results.empty():
+                    return
+                continue
+            except KeyboardInterrupt:
+                if procs.interrupt():
+                    raise
+                continue
+            pending -= 1
+            if error is not None:
+                raise error
+            yield item, result
+    finally:
+        # Don't start anything new, and if we're leaving early, don't
+        # leave jobs running behind our backs either.
+        stop.set()
+        with ready:
+            ready.notify_all()
+        if pending:
+            procs.stop_all()
+            for thread in threads:
+                thread.join(5)
+# End of _run_jobs() function
+
+
+def start(start_dir=os.getcwd(), **kwargs):
+    """Runs walk() in a background thread, and returns its Walker.
+
+    This keeps a long walk from blocking the caller, which can check on
+    it, wait for it, or cancel it through the Walker.
+
+    Example: mp3gain.start('/path/to/Music', jobs=4, timeout=600)
+    """
+    walker = Walker(start_dir, **kwargs)
+    walker.start()
+    return walker
+
+
+class Walker(threading.Thread):
+    """A walk() running in its own thread; see start().
+
+    Attributes:
+        start_dir -- root directory to begin looking in
+        kwargs -- any other walk() options
+    """
+
+    def __init__(self, start_dir=os.getcwd(), **kwargs):
+        threading.Thread.__init__(self, name='mp3gain.walk')
+        self.daemon = True
+        self.cancelled = threading.Event()
+        # Our walk's utilities, and no one else's.
+        self.running = _Running()
+        self.start_dir = start_dir
+        self.kwargs = kwargs
+        self.kwargs['cancel'] = self.cancelled
+        self.kwargs['running'] = self.running
+
+    def run(self):
+        walk(self.start_dir, **self.kwargs)
+
+    def cancel(self):
+        """Starts nothing new, and stops the utilities running now."""
+        self.cancelled.set()
+        self.running.stop_all()
+
+    def done(self):
+        """Checks whether the walk has finished."""
+        return not self.is_alive()
+
+
+def watch(start_dir=os.getcwd(), **kwargs):
+    """Watches start_dir for new or changed audio files, and calls """ \
+            """walk() on each directory once it has been quiet a while.
+
+    Attributes:
+        start_dir -- root directory to watch
+        quiet -- seconds a directory must go unchanged before it is
+                 processed, so albums still being copied are left be (30)
+        poll -- seconds between scans, if inotify isn't available (60)
+
+    Any other attributes are passed on to walk(). Files that are
+    already there when we start are left to walk() itself. inotify is
+    used on Linux; elsewhere, or when the kernel runs out of watches,
+    the tree is scanned every so often instead. Scans notice files
+    being added, renamed or removed, but not rewritten in place.
+
+    Example: mp3gain.watch('/path/to/Music', quiet=60)
+    """
+
+    start_dir = start_dir.strip().rstrip(os.sep)
+    quiet = kwargs.pop('quiet', 30.0)
+    poll = kwargs.pop('poll', 60.0)
+
+    # Each directory gets a walk of its own; there's no long run to
+    # resume, and journalling each one would only lose the last.
+    kwargs['journal'] = None
+    kwargs.pop('resume', None)
+    # Share out albums by where they are in the tree we watch, as a
+    # walk of all of it would, not by where they are in themselves.
+    kwargs['shard_root'] = os.path.abspath(start_dir)
+
+    registry = dict((ext, backend) for ext, backend in BACKENDS.iteritems()
+            if kwargs.get('backends') is None or
+            backend.name in kwargs['backends'])
+
+    # Directories that changed, and when we last heard about them.
+    pending = {}
+    # Fingerprints of directories as we left them, so the tags we
+    # write ourselves don't set us off again.
+    done = {}
+
+    watcher = None
+    try:
+        if os.path.isdir(start_dir) is False:
+            raise DirectoryError(start_dir)
+
+        try:
+            watcher = _Inotify(start_dir, registry)
+        except (OSError, AttributeError) as e:
+            print 'Unable to use inotify ({}); scanning every {} ' \
+                    'seconds instead.'.format(e, poll)
+            watcher = _Poller(start_dir, registry, poll)
+
+        print 'Watching {} for changes...'.format(start_dir)
+        while True:
+            # Wait for changes, but only until the next directory is
+            # due to be processed.
+            timeout = None
+            if pending:
+                timeout = max(min(pending.itervalues()) + quiet -
+                        time.time(), 0)
+            for directory in watcher.changes(timeout):
+                pending[directory] = time.time()
+
+            now = time.time()
+            for directory, changed in sorted(pending.items()):
+                if now - changed < quiet:
+                    continue
+                del pending[directory]
+                _walk_quiet(directory, registry, done, **kwargs)
+
+    except DirectoryError as e:
+        print '{} is not a real directory.'.format(e)
+    except KeyboardInterrupt:
+        print '\nQuitting...'
+    finally:
+        if watcher is not None:
+            watcher.close()
+# End of watch() function
+
+
+def _walk_quiet(directory, registry, done, **kwargs):
+    """Calls walk() on a directory watch() found settled, unless it """ \
+            """is just as we left it."""
+
+    def fingerprint():
+        try:
+            files = [file_ for file_ in os.listdir(directory)
+                    if not _dot_check(file_) and
+                    os.path.splitext(file_)[1].lower() in registry]
+        except OSError:
+            return None
+        return StateIndex.fingerprint(directory, files) if files else None
+
+    before = fingerprint()
+    if before is None:
+        done.pop(directory, None)
+        return
+    if done.get(directory) == before:
+        return
+    walk(directory, **kwargs)
+    done[directory] = fingerprint()
+
+
+class _Inotify(object):
+    """Tells watch() which directories have had audio files written """ \
+            """to, or moved into them, using Linux's inotify by way of """ \
+            """ctypes.
+
+    Attributes:
+        start_dir -- root directory to watch, along with everything in it
+        registry -- file extensions we care about
+    """
+
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE_SELF = 0x00000400
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ISDIR = 0x40000000
+
+    mask = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE_SELF
+    header = struct.Struct('iIII')
+
+    def __init__(self, start_dir, registry):
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init()
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+        self.registry = registry
+        self.watches = {}
+        try:
+            self._add_tree(start_dir)
+        except OSError:
+            self.close()
+            raise
+
+    def _add_tree(self, top):
+        """Watches top and every directory beneath it, returning """ \
+                """those holding audio."""
+        found = []
+        for basedir, pathnames, files in os.walk(top):
+            pathnames[:] = [p for p in pathnames if not _dot_check(p)]
+            wd = self.libc.inotify_add_watch(self.fd, basedir, self.mask)
+            if wd < 0:
+                err = ctypes.get_errno()
+                # Most likely out of watches (ENOSPC); nothing we can
+                # do about that here.
+                raise OSError(err, os.strerror(err))
+            self.watches[wd] = basedir
+            if any(os.path.splitext(file_)[1].lower() in self.registry
+                    for file_ in files if not _dot_check(file_)):
+                found.append(basedir)
+        return found
+
+    def changes(self, timeout=None):
+        """Waits up to timeout seconds, returning the set of """ \
+                """directories that changed."""
+        changed = set()
+        try:
+            ready = select.select([self.fd], [], [], timeout)[0]
+        except select.error as e:
+            if e.args[0] == errno.EINTR:
+                return changed
+            raise
+        if not ready:
+            return changed
+
+        data = os.read(self.fd, 65536)
+        pos = 0
+        while pos + self.header.size <= len(data):
+            wd, mask, cookie, length = self.header.unpack_from(data, pos)
+            pos += self.header.size
+            name = data[pos:pos + length].rstrip('\0')
+            pos += length
+
+            if mask & self.IN_Q_OVERFLOW:
+                # We've lost track; the next walk() will catch up.
+                print '\rToo many changes at once; some were missed.'
+                continue
+            if mask & self.IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            directory = self.watches.get(wd)
+            if directory is None or _dot_check(name):
+                continue
+
+            path = os.path.join(directory, name)
+            if mask & self.IN_ISDIR:
+                # Watch new directories, and anything already copied
+                # into them before we were watching.
+                if mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                    try:
+                        changed.update(self._add_tree(path))
+                    except OSError:
+                        pass
+            elif mask & (self.IN_CLOSE_WRITE | self.IN_MOVED_TO) and \
+                    os.path.splitext(name)[1].lower() in self.registry:
+                changed.add(directory)
+        return changed
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+class _Poller(object):
+    """Tells watch() which directories have changed by scanning the """ \
+            """tree every so often, for systems without inotify.
+
+    Attributes:
+        start_dir -- root directory to watch
+        registry -- file extensions we care about
+        interval -- seconds between scans
+    """
+
+    def __init__(self, start_dir, registry, interval):
+        self.start_dir = start_dir
+        self.registry = registry
+        self.interval = interval
+        self.mtimes = self._scan()
+        self.next = time.time() + interval
+
+    def _scan(self):
+        """Returns the modification time of every audio directory; """ \
+                """these change when files are added or renamed."""
+        mtimes = {}
+        for basedir, files in _find_albums(self.start_dir, self.registry):
+            try:
+                mtimes[basedir] = os.stat(basedir).st_mtime
+            except OSError:
+                pass
+        return mtimes
+
+    def changes(self, timeout=None):
+        wait = self.next - time.time()
+        if timeout is not None:
+            wait = min(wait, timeout)
+        if wait > 0:
+            time.sleep(wait)
+        if time.time() < self.next:
+            return set()
+
+        mtimes = self._scan()
+        self.next = time.time() + self.interval
+        changed = set(directory for directory, mtime in mtimes.iteritems()
+                if self.mtimes.get(directory) != mtime)
+        self.mtimes = mtimes
+        return changed
+
+    def close(self):
+        pass
+
+
+# gain is where we do our actual work.
+def gain(directory=os.getcwd(), backend='mp3gain', files=None, **kwargs):
+    """Attach ReplayGain tags to the files in the specified directory, """ \
+            """using one of the supported utilities.
+
+    Example: mp3gain.gain('/path/to/Music/Artist/Album', 'vorbisgain')
+
+    Attributes:
+      directory -- Directory on which to apply ReplayGain
+      backend -- Name of the utility to use, or a Backend ('mp3gain')
+      files -- Files to process (every file the utility handles)
+      timeout -- Seconds to allow each run of the utility (no limit)
+      running -- _Running to keep track of the utility in, so it can
+                 be stopped along with the rest of a walk's (shared by
+                 every gain() call outside of a walk)
+
+    Any other attributes are passed on to the utility, as described in
+    mp3gain(); those that don't apply to it are ignored.
+
+    Returns a list of Result records for each track and album, in the
+    order the utility reported them, or None if the directory could not
+    be processed.
+    """
+
+    if not isinstance(backend, Backend):
+        backend = get_backend(backend)
+
+    timeout = kwargs.pop('timeout', None)
+    running = kwargs.pop('running', None) or _running
+
+    # Assume the worst until the process finishes cleanly.
+    results = None
+    collected = []
+    dirbase = os.path.basename(directory)
+
+    try:
+        # Check to make sure we're working in a real directory.
+        if os.path.isdir(directory) is False:
+            raise DirectoryError(directory)
+
+        executable = which(backend.executable)
+        if executable is None:
+            raise NoExecutableError(backend.name)
+
+        # Some utilities can't do what was asked of them; that's
+        # not an error, there's just nothing to do.
+        args = backend.command(**kwargs)
+        if args is None:
+            return []
+
+        # Without a shell there's no globbing, so find the files
+        # ourselves if we weren't told which ones to use.
+        if files is None:
+            files = sorted(file_ for file_ in os.listdir(directory)
+                    if not _dot_check(file_) and
+                    os.path.splitext(file_)[1].lower() in backend.extensions)
+        if not files:
+            raise NoMP3Error(directory)
+
+        # Keep files that look like options from being taken as such.
+        files = [os.path.join(os.curdir, file_) if file_.startswith('-')
+                else file_ for file_ in files]
+
+        command = [executable] + args
+        chunks = list(_split_args(command, files))
+        # The utilities only calculate album gain over the files they
+        # are given at once, so say so when we can't give them all.
+        if len(chunks) > 1:
+            _report('\r{} has too many files for one command; album gain '
+                    'will be calculated over {} parts.'.format(dirbase,
+                    len(chunks)))
+
+        # Some utilities only tell us their results when asked again.
+        report = backend.report(**kwargs)
+
+        for chunk in chunks:
+            # Run the utility directly; a shell would only cost us
+            # another process and trouble with unusual filenames.
+            returncode = _run(backend, command + chunk, directory,
+                    collected, timeout, running)
+
+            # Let the backend decide what its return code means.
+            backend.check(directory, returncode)
+
+            if report is not None:
+                _run(backend, [executable] + report + chunk, directory,
+                        collected, timeout, running)
+
+    # Raised when directory does not contain any files to process.
+    except NoMP3Error as e:
+        _report('\r{} did not contain any files to process.'.format(e))
+    # Raised when the sp.Popen() does not execute successfully.
+    except ProcessingError as e:
+        _report('\rThere was an error processing {}.'.format(e))
+    # Since this can be called by itself, let's also
+    # raise directory errors right here, too.
+    except DirectoryError as e:
+        _report('\r{} is not a real directory.'.format(e))
+
+    # The utility was taking too long, and was stopped.
+    except TimedOutError as e:
+        _report('\r{} took too long; skipping.'.format(e))
+
+    # Catch KeyboardInterrupts as a cue to cancel processing the current
+    # dir, unless the user is trying to break the outermost loop.
+    except KeyboardInterrupt:
+        if running.interrupt():
+            raise
+        _report('\rSkipping: {}'.format(dirbase))
+
+    # Stopped by a Ctrl-C caught in another thread, or by cancel().
+    except CancelledError:
+        _report('\rSkipping: {}'.format(dirbase))
+
+    # TODO: Has to be some way to suppress this output when gain()
+    # is not called from walk().
+    except NoExecutableError:
+        raise
+
+    # Any other errors are not expected.
+    except:
+        _report('\nSomething went horribly wrong processing our files!')
+
+    # Everything went according to plan.
+    else:
+        results = collected
+
+    # End of isdir()|Popen() try...except block
+
+    return results
+# End of gain() function
+
+
+def _run(backend, command, directory, results, timeout=None,
+        running=None):
+    """Runs a utility, adding the results it reports to results as """ \
+            """they arrive, and returns its exit status. It's kept """ \
+            """track of in running, if given."""
+
+    if running is None:
+        running = _running
+
+    # Progress meters and warnings go to stderr, and nobody would read
+    # them; results are read from stdout a line at a time, so there's
+    # no need to keep all of it around.
+    with open(os.devnull, 'w') as null:
+        try:
+            proc = sp.Popen(command, cwd=directory, stdout=sp.PIPE,
+                    stderr=null)
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                raise NoExecutableError(backend.name)
+            raise
+        running.add(proc)
+        timer = None
+        if timeout:
+            timer = threading.Timer(timeout, running.stop,
+                    (proc, 'timeout'))
+            timer.daemon = True
+            timer.start()
+
+        try:
+            results.extend(backend.parse(directory, _lines(proc.stdout)))
+            # Keep reading if the parser gave up early, so the process
+            # doesn't block on a full pipe.
+            for _ in _lines(proc.stdout):
+                pass
+        except BaseException:
+            # Most likely a KeyboardInterrupt; make sure it's gone.
+            running.stop(proc, 'cancelled')
+            raise
+        finally:
+            if timer is not None:
+                timer.cancel()
+            proc.stdout.close()
+            proc.wait()
+            reason = running.discard(proc)
+
+    # The terminal sends Ctrl-C to the utility as well as to us.
+    if reason == 'cancelled' or proc.returncode == -signal.SIGINT:
+        raise CancelledError(directory)
+    if reason == 'timeout':
+        raise TimedOutError(directory)
+    return proc.returncode
+
+
+def _lines(f):
+    """Yields lines from a pipe as soon as each one is written."""
+    while True:
+        # A signal interrupts the read, rather than raising the
+        # KeyboardInterrupt itself; that arrives once we try again.
+        try:
+            line = f.readline()
+        except IOError as e:
+            if e.errno == errno.EINTR:
+                continue
+            raise
+        if not line:
+            return
+        yield line
+
+
+class _Running(object):
+    """Keeps track of the utilities we have running, so they can be """ \
+            """stopped by Ctrl-C, a timeout or Walker.cancel()."""
+
+    # Two Ctrl-Cs within this many seconds stop everything.
+    window = 1.0
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Each process, and why we stopped it (None while running).
+        self.procs = {}
+        self.last = 0.0
+
+    def add(self, proc):
+        with self.lock:
+            self.procs[proc] = None
+
+    def discard(self, proc):
+        """Forgets a finished process, returning why it was stopped."""
+        with self.lock:
+            return self.procs.pop(proc, None)
+
+    def stop(self, proc, reason):
+        """Kills a process, remembering why."""
+        with self.lock:
+            if proc not in self.procs or self.procs[proc] is not None:
+                return
+            self.procs[proc] = reason
+            try:
+                proc.kill()
+            # It may well have finished on its own in the meantime.
+            except OSError:
+                pass
+
+    def stop_all(self, reason='cancelled'):
+        """Kills every process we have running."""
+        with self.lock:
+            procs = list(self.procs)
+        for proc in procs:
+            self.stop(proc, reason)
+
+    def interrupt(self):
+        """Handles a Ctrl-C by stopping whatever is running, and """ \
+                """returns True if it followed another one closely."""
+        now = time.time()
+        again = now - self.last < self.window
+        self.last = now
+        self.stop_all()
+        return again
+
+
+# For gain() and _run_jobs() outside of a walk.
+_running = _Running()
+
+
+class Result(namedtuple('Result', 'directory file backend gain peak '
+        'clipping')):
+    """The outcome of gaining one track, or one album.
+
+    Attributes:
+        directory -- directory the files are in
+        file -- track's filename, or None for the album as a whole
+        backend -- name of the utility that produced the result
+        gain -- suggested gain in dB
+        peak -- largest sample, relative to full scale
+        clipping -- whether applying the gain would clip
+
+    >>> Result('/a', None, 'mp3gain', -3.5, 0.5, False).json()
+    '{"backend": "mp3gain", "clipping": false, "directory": "/a", \
+"file": null, "gain": -3.5, "peak": 0.5}'
+    """
+
+    __slots__ = ()
+
+    @classmethod
+    def make(cls, directory, file_, backend, gain, peak):
+        """Builds a Result, working out whether it would clip."""
+        if file_ is not None:
+            file_ = os.path.normpath(file_)
+        return cls(directory, file_, backend, gain, peak,
+                peak * 10 ** (gain / 20.0) > 1.0)
+
+    def json(self):
+        """Returns the result as a line of JSON."""
+        record = self._asdict()
+        for key in ('directory', 'file'):
+            # Paths are bytes, in whatever encoding they were named in.
+            if isinstance(record[key], str):
+                record[key] = record[key].decode('utf-8', 'replace')
+        return json.dumps(record, sort_keys=True)
+
+
 def mp3gain(directory=os.getcwd(), **kwargs):
     """Attach IDv3 ReplayGain tags for the MP3 files in """ \
             """the specified directory.
@@ -185,6 +1393,7 @@ def mp3gain(directory=os.getcwd(), **kwargs):
 
     Attributes:
       directory -- Directory on which to apply ReplayGain
+      files -- MP3 files to process (*.mp3)
       assume -- Assume all files are MPEG Layer IIIs
       allowclip -- Ignore warnings about track clipping (False)
       noclip -- Automatically lower gain to avoid clipping (True)
@@ -192,132 +1401,1042 @@ def mp3gain(directory=os.getcwd(), **kwargs):
       delete -- Delete current ReplayGain tags (False)
       skip -- Do not read/write ReplayGain tags (False)
       preserve -- Preserve timestamps on current file (True)
+
+    Returns a list of Result records for each track and the album, or
+    None if the directory could not be processed.
     """
+    return gain(directory, 'mp3gain', **kwargs)
+# End of mp3gain() function
 
-    # Assign attributes from kwargs, applying a default value as needed.
-    # TODO: Look into other possible options, like 'undo'
-    # TODO: User may prefer APE over ID3v2, for whatever reason
-    assume = kwargs.pop('assume', True)
-    allowclip = kwargs.pop('allowclip', False)
-    noclip = kwargs.pop('noclip', True)
-    recalc = kwargs.pop('recalc', False)
-    delete = kwargs.pop('delete', False)
-    skip = kwargs.pop('skip', False)
-    preserve = kwargs.pop('preserve', True)
 
-    try:
-        # Check to make sure we're working in a real directory.
-        if os.path.isdir(directory) is False:
-            raise DirectoryError(directory)
+class Backend(object):
+    """A ReplayGain utility, and how to drive it.
+
+    Each backend names the file extensions its utility handles, builds
+    its command line from gain()'s options, and makes sense of its exit
+    status. Register new ones with register_backend().
+
+    Attributes:
+        name -- name of the utility
+        executable -- program name, found on the PATH, or full path
+        extensions -- lower case file extensions it handles
+    """
+
+    name = None
+    executable = None
+    extensions = ()
+
+    def command(self, **options):
+        """Returns a list of the utility's arguments for the given """ \
+                """options, or None if it can't carry them out."""
+        raise NotImplementedError
+
+    def report(self, **options):
+        """Returns arguments for a second run that reports the """ \
+                """results, for utilities that don't do so as they go."""
+        return None
+
+    def parse(self, directory, lines):
+        """Yields a Result for each track and album in the """ \
+                """utility's output."""
+        return iter(())
+
+    def check(self, directory, returncode):
+        """Raises the appropriate Error for an unsuccessful run."""
+        if returncode != 0:
+            raise ProcessingError(directory)
+
+    def available(self):
+        """Checks to see if the utility is installed."""
+        return which(self.executable) is not None
+
+    def __repr__(self):
+        return '<{} backend>'.format(self.name)
+
+
+class MP3GainBackend(Backend):
+    """MPEG Layer III files, with mp3gain."""
+
+    name = 'mp3gain'
+    executable = 'mp3gain'
+    extensions = ('.mp3',)
+
+    def command(self, **kwargs):
+        # Assign attributes from kwargs, applying a default value as needed.
+        # TODO: Look into other possible options, like 'undo'
+        # TODO: User may prefer APE over ID3v2, for whatever reason
+        assume = kwargs.pop('assume', True)
+        allowclip = kwargs.pop('allowclip', False)
+        noclip = kwargs.pop('noclip', True)
+        recalc = kwargs.pop('recalc', False)
+        delete = kwargs.pop('delete', False)
+        skip = kwargs.pop('skip', False)
+        preserve = kwargs.pop('preserve', True)
 
         # Set our command and options to use here.
-        # Make changes to IDv3 tags only
-        command = '/usr/bin/mp3gain -s i '
+        # Make changes to IDv3 tags only, and report our results in a
+        # tab delimited table.
+        command = ['-s', 'i', '-o']
         # Don't check for mislabed MPEG Layer I or II files
         if assume:
-            command += '-f '
+            command.append('-f')
         # Recalculate ReplayGain, regardless of current RG tags
         if recalc:
-            command += '-s r '
+            command.extend(['-s', 'r'])
         # Delete current ReplayGain tags from file
         if delete:
-            command += '-s d '
+            command.extend(['-s', 'd'])
         # Skip reading/writing of ReplayGain tags
         if skip:
-            command += '-s s '
+            command.extend(['-s', 's'])
         # Ignore or lower gain if clipping warning
         if allowclip:
-            command += '-c '
+            command.append('-c')
         if noclip:
-            command += '-k '
+            command.append('-k')
         # Preserve access/creation/modified times from file
         if preserve:
-            command += '-p '
-        command += '*.mp3'
-
-        # TODO: os.path.abspath/normpath
-        dirbase = os.path.basename(directory)
-
-        # mp3gain can produce a lot of output, and sp.PIPE only takes
-        # about 65kb of data before it shuts down. This TemporaryFile
-        # object should take as much data as we can through at it,
-        # and discard it on close.
-        tmp = temp.TemporaryFile()
-
-        # Create a subprocess, and call the command inside of a shell.
-        proc = sp.Popen(command, cwd=directory, shell=True,
-                stderr=sp.STDOUT, stdout=tmp)
-        proc.wait()
-
-        # 127 is the specific return code from the Linux shell
-        # to indicate the command was not found.
-        if proc.poll() is 127:
-            raise NoExecutableError()
+            command.append('-p')
+        return command
+
+    def parse(self, directory, lines):
+        # Tab delimited (-o): file, MP3 gain, dB gain, max amplitude,
+        # max and min global gain. The amplitude is a 16-bit value.
+        for line in lines:
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) < 4 or fields[0] == 'File':
+                continue
+            try:
+                db = float(fields[2])
+                peak = float(fields[3]) / 32768
+            except ValueError:
+                continue
+            file_ = None if fields[0] == '"Album"' else fields[0]
+            yield Result.make(directory, file_, self.name, db, peak)
+
+    def check(self, directory, returncode):
         # Return code of 1 indicates no files were processed.
-        if proc.poll() is 1:
+        if returncode == 1:
             raise NoMP3Error(directory)
-        # If /usr/bin/mp3gain returned something other
-        # than a 0, something went wrong with the process.
-        elif proc.poll() is not 0:
-            raise ProcessingError(directory)
+        Backend.check(self, directory, returncode)
+
+
+class AACGainBackend(MP3GainBackend):
+    """AAC in MP4 containers, with aacgain, which takes the same """ \
+            """options as mp3gain."""
+
+    name = 'aacgain'
+    executable = 'aacgain'
+    extensions = ('.m4a', '.mp4')
+
+    def command(self, **kwargs):
+        # aacgain would complain about every MP4 if told to assume
+        # they were all MP3s.
+        kwargs['assume'] = False
+        return MP3GainBackend.command(self, **kwargs)
+
+
+class VorbisGainBackend(Backend):
+    """Ogg Vorbis files, with vorbisgain."""
+
+    name = 'vorbisgain'
+    executable = 'vorbisgain'
+    extensions = ('.ogg', '.oga')
+
+    def command(self, **kwargs):
+        # Album gain, always.
+        command = ['-a']
+        # Clean out current ReplayGain tags
+        if kwargs.get('delete'):
+            command.append('-c')
+        # Display the results only, writing nothing
+        elif kwargs.get('skip'):
+            command.append('-d')
+        # Skip files that already have tags, unless told otherwise
+        elif not kwargs.get('recalc'):
+            command.append('-f')
+        return command
+
+    # '   Gain   |  Peak  | Scale | New Peak | Track' table rows, and
+    # 'Recommended Album Gain: -3.45 dB' at the end. Peaks are 16-bit.
+    _row = re.compile(r'^\s*([-+]?[\d.]+) dB\s*\|\s*([\d.]+)\s*\|'
+            r'[^|]*\|[^|]*\|\s?(.*)$')
+    _album = re.compile(r'^Recommended Album Gain:\s*([-+]?[\d.]+) dB')
+
+    def parse(self, directory, lines):
+        album_peak = 0.0
+        for line in lines:
+            line = line.rstrip('\n')
+            match = self._row.match(line)
+            if match:
+                peak = float(match.group(2)) / 32768
+                album_peak = max(album_peak, peak)
+                yield Result.make(directory, match.group(3), self.name,
+                        float(match.group(1)), peak)
+                continue
+            match = self._album.match(line)
+            if match:
+                yield Result.make(directory, None, self.name,
+                        float(match.group(1)), album_peak)
+
+
+class MetaflacBackend(Backend):
+    """FLAC files, with metaflac."""
+
+    name = 'metaflac'
+    executable = 'metaflac'
+    extensions = ('.flac',)
+
+    def command(self, **kwargs):
+        # metaflac can't analyse a file without tagging it.
+        if kwargs.get('skip'):
+            return None
+        if kwargs.get('delete'):
+            command = ['--remove-replay-gain']
+        else:
+            command = ['--add-replay-gain']
+        if kwargs.get('preserve', True):
+            command.append('--preserve-modtime')
+        return command
+
+    def report(self, **kwargs):
+        # Having just been written, the tags are all there is to read.
+        if kwargs.get('delete'):
+            return None
+        return ['--with-filename'] + ['--show-tag=REPLAYGAIN_' + tag
+                for tag in ('TRACK_GAIN', 'TRACK_PEAK', 'ALBUM_GAIN',
+                'ALBUM_PEAK')]
+
+    def parse(self, directory, lines):
+        # One 'file:NAME=value' line for each tag of each file.
+        tags = {}
+        order = []
+        for line in lines:
+            file_, sep, tag = line.rstrip('\n').rpartition(':')
+            name, sep, value = tag.partition('=')
+            if not sep:
+                continue
+            if file_ not in tags:
+                tags[file_] = {}
+                order.append(file_)
+            tags[file_][name.upper()] = value
+
+        album = None
+        for file_ in order:
+            track = _tag_values(tags[file_], 'TRACK')
+            if track is not None:
+                yield Result.make(directory, file_, self.name, *track)
+            album = album or _tag_values(tags[file_], 'ALBUM')
+        if album is not None:
+            yield Result.make(directory, None, self.name, *album)
+
+
+def _tag_values(tags, kind):
+    """Returns (gain, peak) from a file's ReplayGain tags, or None.
+
+    >>> _tag_values({'REPLAYGAIN_TRACK_GAIN': '-3.10 dB',
+    ...         'REPLAYGAIN_TRACK_PEAK': '0.5'}, 'TRACK')
+    (-3.1, 0.5)
+    """
+    try:
+        return (float(tags['REPLAYGAIN_{}_GAIN'.format(kind)].split()[0]),
+                float(tags['REPLAYGAIN_{}_PEAK'.format(kind)]))
+    except (KeyError, IndexError, ValueError):
+        return None
 
-    # Raised when  directory does not contain any MP3s.
-    except NoMP3Error as e:
-        print '\r{} did not contain any MP3s.'.format(e)
-    # Raised when the sp.Popen() does not execute successfully.
-    except ProcessingError as e:
-        print '\rThere was an error processing {}.'.format(e)
-    # Since this can be called by itself, let's also
-    # raise directory errors right here, too.
-    except DirectoryError as e:
-        print '\r{} is not a real directory.'.format(e)
 
-    # Catch KeyboardInterrupts as a cue to cancel processing the current dir.
-    except KeyboardInterrupt:
-        print '\rSkipping: {}'.format(dirbase)
+# Gain utilities, keyed by the file extensions they handle.
+BACKENDS = {}
 
-        # Sleep for a fraction of a second to let user break outermost loop.
-        # sleep(0.1)
+# Where we found each utility; see which().
+_executables = {}
 
-    # TODO: Has to be some way to suppress this output when mp3gain()
-    # is not called from walk().
-    except NoExecutableError:
-        raise
 
-    # Any other errors are not expected.
-    except:
-        print '\nSomething went horribly wrong processing our files!'
+def which(name):
+    """Finds an executable on the PATH, like the shell would, and """ \
+            """remembers where it was for next time.
 
-    # Everything went according to plan.
+    Returns the full path to the executable, or None if there isn't one.
+    """
+
+    if name not in _executables:
+        found = None
+        if os.path.dirname(name):
+            candidates = [name]
+        else:
+            candidates = [os.path.join(dir_, name) for dir_ in
+                    os.getenv('PATH', os.defpath).split(os.pathsep)]
+        for candidate in candidates:
+            if os.path.isfile(candidate) and os.access(candidate, os.X_OK):
+                found = candidate
+                break
+        _executables[name] = found
+    return _executables[name]
+
+
+def _split_args(command, files):
+    """Yields lists of files small enough to follow command on a """ \
+            """single command line.
+
+    The kernel limits the combined size of arguments and environment
+    (ARG_MAX); each argument also costs a pointer and a terminator.
+
+    >>> [len(chunk) for chunk in _split_args(['x'], ['a' * 50] * 10)]
+    [10]
+    """
+
+    limit = os.sysconf('SC_ARG_MAX') if hasattr(os, 'sysconf') else 131072
+    # Leave some room for the environment, and then some.
+    limit -= sum(len(key) + len(value) + 2 + 8
+            for key, value in os.environ.iteritems()) + 4096
+    base = sum(len(arg) + 1 + 8 for arg in command)
+
+    chunk = []
+    size = base
+    for file_ in files:
+        cost = len(file_) + 1 + 8
+        if chunk and size + cost > limit:
+            yield chunk
+            chunk = []
+            size = base
+        chunk.append(file_)
+        size += cost
+    if chunk:
+        yield chunk
+
+
+def register_backend(backend):
+    """Adds a Backend to the registry, replacing any backends """ \
+            """already registered for its extensions."""
+    for ext in backend.extensions:
+        BACKENDS[ext] = backend
+
+
+def get_backend(name):
+    """Returns the registered Backend with the given name."""
+    for backend in BACKENDS.itervalues():
+        if backend.name == name:
+            return backend
+    raise BackendError(name)
+
+
+for _backend in (MP3GainBackend(), AACGainBackend(), VorbisGainBackend(),
+        MetaflacBackend()):
+    register_backend(_backend)
+del _backend
+
+
+# Several mp3gain() calls may be running in their own threads, so
+# keep their messages from landing in the middle of one another.
+_output_lock = threading.Lock()
+
+
+def _report(message):
+    """Prints a message without interleaving it with other threads."""
+    with _output_lock:
+        print message
+
+
+# Tags mp3gain writes once it has finished with a file and its album.
+REQUIRED_TAGS = ('REPLAYGAIN_TRACK_GAIN', 'REPLAYGAIN_ALBUM_GAIN')
+
+
+def album_tagged(directory, files):
+    """Checks whether every one of files in directory already has """ \
+            """track and album ReplayGain tags."""
+    for file_ in files:
+        try:
+            tags = read_tags(os.path.join(directory, file_))
+        except (IOError, OSError):
+            return False
+        for tag in REQUIRED_TAGS:
+            if tag not in tags:
+                return False
+    return True
+
+
+def read_tags(path):
+    """Returns the ReplayGain tags found in an MP3 file as a dictionary """ \
+            """of upper-case names to values.
+
+    Only the tag regions are read: ID3v2 TXXX frames at the start of the
+    file, and APEv2 items at its end. Anything else in the file,
+    including the audio, is never touched.
+
+    Attributes:
+        path -- MP3 file to read
+    """
+
+    tags = {}
+    with open(path, 'rb') as f:
+        # APE tags come first so that ID3v2, which is what we ask
+        # mp3gain to write, wins if a file has both.
+        tags.update(_read_ape(f))
+        tags.update(_read_id3v2(f))
+    return dict((key, value) for key, value in tags.iteritems()
+            if key.startswith('REPLAYGAIN_'))
+
+
+def _syncsafe(data):
+    """Decodes a 28-bit ID3v2 syncsafe integer.
+
+    >>> _syncsafe('\\x00\\x00\\x02\\x01')
+    257
+    """
+    value = 0
+    for byte in bytearray(data):
+        value = (value << 7) | (byte & 0x7f)
+    return value
+
+
+def _read_id3v2(f):
+    """Reads TXXX frames from an ID3v2 tag at the start of f."""
+
+    f.seek(0)
+    header = f.read(10)
+    if len(header) < 10 or header[:3] != 'ID3':
+        return {}
+    major = ord(header[3])
+    flags = ord(header[5])
+    size = _syncsafe(header[6:10])
+
+    # Old-style unsynchronisation applies to the whole tag, so we
+    # can't skip around inside it; read it in one go instead.
+    if flags & 0x80 and major < 4:
+        data = f.read(size).replace('\xff\x00', '\xff')
+        frames = _id3_frames(data, major, flags)
     else:
-        pass
-        # print '\rFinished with:', dirbase,
+        frames = _id3_frames(f, major, flags, size)
 
-    # Close our temporary file as we leave the try block.
-    finally:
-        tmp.close()
+    tags = {}
+    for frame_id, body in frames:
+        if frame_id in ('TXXX', 'TXX'):
+            key, value = _txxx(body)
+            tags[key.upper()] = value
+    return tags
 
-    # End of isdir()|Popen() try...except block
-# End of mp3gain() function
 
+def _id3_frames(source, major, flags, size=None):
+    """Yields (frame id, body) pairs for TXXX frames, reading them """ \
+            """from a string, or seeking past other frames in a file."""
+
+    if isinstance(source, str):
+        f = _StringReader(source)
+        size = len(source)
+    else:
+        f = source
+
+    end = f.tell() + size
+
+    # Skip the extended header. Its size includes itself in ID3v2.4,
+    # but not in ID3v2.3.
+    if flags & 0x40 and major >= 3:
+        raw = f.read(4)
+        if major >= 4:
+            f.seek(_syncsafe(raw) - 4, os.SEEK_CUR)
+        else:
+            f.seek(struct.unpack('>I', raw)[0], os.SEEK_CUR)
+
+    # ID3v2.2 uses three byte ids and sizes, with no flags.
+    id_len, head_len = (3, 6) if major == 2 else (4, 10)
+
+    while f.tell() + head_len <= end:
+        head = f.read(head_len)
+        frame_id = head[:id_len]
+        # Padding, or garbage; either way there are no more frames.
+        if not frame_id.strip('\x00') or not frame_id.isalnum():
+            break
+        if major == 2:
+            length = struct.unpack('>I', '\x00' + head[3:6])[0]
+        elif major >= 4:
+            length = _syncsafe(head[4:8])
+        else:
+            length = struct.unpack('>I', head[4:8])[0]
+        if f.tell() + length > end:
+            break
+
+        # Compressed or encrypted frames aren't worth decoding here.
+        frame_flags = ord(head[9]) if major >= 3 else 0
+        if frame_id in ('TXXX', 'TXX') and not frame_flags & 0x0c:
+            body = f.read(length)
+            # ID3v2.4 marks unsynchronisation frame by frame.
+            if major >= 4 and frame_flags & 0x02:
+                body = body.replace('\xff\x00', '\xff')
+            # A data length indicator prefixes the body with its size.
+            if major >= 4 and frame_flags & 0x01:
+                body = body[4:]
+            yield frame_id, body
+        else:
+            f.seek(length, os.SEEK_CUR)
+
+
+class _StringReader(object):
+    """Just enough of a file interface to walk frames in a string."""
 
-def print_progress(current, total, length=50):
-    '''Prints a simple progress bar indicating progress.'''
-    # TODO: Add a doctest
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
 
-    # Calculates what percentage of work has been finished.
-    ratio = (current / total)
+    def read(self, size):
+        chunk = self.data[self.pos:self.pos + size]
+        self.pos += len(chunk)
+        return chunk
 
-    # Determines how long the line must be to represent work done.
-    # Subract one for our greater than symbol.
-    size = int(floor(ratio * length)) - 1
+    def seek(self, offset, whence=os.SEEK_SET):
+        self.pos = offset if whence == os.SEEK_SET else self.pos + offset
 
-    # Prints our bar and a percentage of progress.
-    # The trailing null string and comma ensures a new line is not printed.
-    print '\r{0:000.2f}% |{1}|'.format(ratio * 100, '=' * size +
-            '>' + ('-' * (length - size))) + '',
+    def tell(self):
+        return self.pos
+
+
+def _txxx(body):
+    """Splits a TXXX frame body into its description and value.
+
+    >>> _txxx('\\x00REPLAYGAIN_TRACK_GAIN\\x00-6.20 dB')
+    (u'REPLAYGAIN_TRACK_GAIN', u'-6.20 dB')
+    >>> _txxx('\\x01\\xff\\xfeA\\x00\\x00\\x00\\xff\\xfe1\\x00')
+    (u'A', u'1')
+    """
+
+    encoding = ord(body[0]) if body else 0
+    body = body[1:]
+
+    if encoding in (1, 2):
+        # UTF-16 terminators are two bytes and must be aligned.
+        codec = 'utf-16' if encoding == 1 else 'utf-16-be'
+        split = 0
+        while True:
+            split = body.find('\x00\x00', split)
+            if split < 0 or split % 2 == 0:
+                break
+            split += 1
+        width = 2
+    else:
+        codec = 'utf-8' if encoding == 3 else 'latin-1'
+        split = body.find('\x00')
+        width = 1
+
+    if split < 0:
+        return body.decode(codec, 'replace'), u''
+    desc = body[:split].decode(codec, 'replace')
+    value = body[split + width:].decode(codec, 'replace')
+    return desc, value.rstrip(u'\x00')
+
+
+def _read_ape(f):
+    """Reads items from an APEv2 tag at the end of f, which may be """ \
+            """followed by an ID3v1 tag."""
+
+    f.seek(0, os.SEEK_END)
+    end = f.tell()
+
+    # Look for the footer right at the end, then just ahead of a 128
+    # byte ID3v1 tag.
+    for offset in (32, 160):
+        if end < offset:
+            return {}
+        f.seek(end - offset)
+        footer = f.read(32)
+        if footer[:8] == 'APETAGEX':
+            break
+    else:
+        return {}
+
+    size, count = struct.unpack('<II', footer[12:20])
+    # The size includes the footer, but not the optional header.
+    if size < 32 or size > end:
+        return {}
+    f.seek(end - offset - (size - 32))
+    data = f.read(size - 32)
+
+    tags = {}
+    pos = 0
+    for _ in xrange(count):
+        if pos + 8 > len(data):
+            break
+        length, flags = struct.unpack('<II', data[pos:pos + 8])
+        key_end = data.find('\x00', pos + 8)
+        if key_end < 0:
+            break
+        key = data[pos + 8:key_end]
+        value = data[key_end + 1:key_end + 1 + length]
+        pos = key_end + 1 + length
+        # Only text items are interesting; skip binary and links.
+        if not (flags >> 1) & 0x03:
+            tags[key.upper()] = value.decode('utf-8', 'replace')
+    return tags
+
+
+class StateIndex(object):
+    """Remembers which album directories have been processed, so """ \
+            """later walks can skip albums that have not changed.
+
+    Each directory is stored with a fingerprint of its MP3s' names,
+    sizes, modification times and inodes, so checking an album costs
+    one stat() per file rather than a trip through mp3gain.
+
+    Attributes:
+        path -- SQLite database file, created if necessary
+        readonly -- only read an index that already exists, never
+                    creating or changing it; used by plans
+
+    >>> index = StateIndex(':memory:')
+    >>> index.record('/tmp', [])
+    >>> index.unchanged('/tmp', [])
+    True
+    >>> index.forget('/tmp')
+    >>> index.unchanged('/tmp', [])
+    False
+    >>> index.speed()
+    >>> index.record_speed(100, 2); index.record_speed(300, 2)
+    >>> index.speed()
+    100.0
+    >>> index.close()
+    """
+
+    # Commit after this many changes, so a crash doesn't cost us
+    # everything we've done, without syncing after every album.
+    batch = 50
+
+    def __init__(self, path=DEFAULT_INDEX, readonly=False):
+        self.path = path
+        self.pending = 0
+        if readonly:
+            # Python 2's sqlite3 can't open a file read-only, so have
+            # SQLite refuse any write made through this connection.
+            self.conn = sqlite3.connect(path)
+            self.conn.execute('PRAGMA query_only = ON')
+            return
+
+        dirname = os.path.dirname(path)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS albums ('
+                'directory TEXT PRIMARY KEY, fingerprint TEXT NOT NULL)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS stats ('
+                'name TEXT PRIMARY KEY, value REAL NOT NULL)')
+
+    @staticmethod
+    def fingerprint(directory, files):
+        """Returns a digest of the state of files in directory, or """ \
+                """None if any of them has gone missing."""
+        digest = hashlib.sha1()
+        for file_ in sorted(files):
+            try:
+                st = os.stat(os.path.join(directory, file_))
+            except OSError:
+                return None
+            digest.update('{}\0{}\0{}\0{}\n'.format(file_, st.st_size,
+                    st.st_mtime, st.st_ino))
+        return digest.hexdigest()
+
+    def unchanged(self, directory, files):
+        """Checks whether directory looks just like it did when it """ \
+                """was last recorded."""
+        row = self.conn.execute('SELECT fingerprint FROM albums '
+                'WHERE directory = ?',
+                (os.path.abspath(directory),)).fetchone()
+        return row is not None and \
+                row[0] == self.fingerprint(directory, files)
+
+    def record(self, directory, files):
+        """Stores the current state of a successfully processed album."""
+        fingerprint = self.fingerprint(directory, files)
+        if fingerprint is None:
+            self.forget(directory)
+            return
+        self.conn.execute('INSERT OR REPLACE INTO albums VALUES (?, ?)',
+                (os.path.abspath(directory), fingerprint))
+        self._changed()
+
+    def forget(self, directory):
+        """Removes directory, so the next walk processes it again."""
+        self.conn.execute('DELETE FROM albums WHERE directory = ?',
+                (os.path.abspath(directory),))
+        self._changed()
+
+    def clear(self):
+        """Forgets every directory in the index."""
+        self.conn.execute('DELETE FROM albums')
+        self._changed()
+
+    def speed(self):
+        """Returns the bytes a second a job has got through, over """ \
+                """every walk so far, or None if we don't know yet."""
+        stats = dict(self.conn.execute('SELECT name, value FROM stats'))
+        if stats.get('seconds'):
+            return stats.get('bytes', 0) / stats['seconds']
+        return None
+
+    def record_speed(self, size, seconds):
+        """Adds size bytes processed in seconds of job time to the """ \
+                """measured speed."""
+        for name, value in (('bytes', size), ('seconds', seconds)):
+            self.conn.execute('INSERT OR REPLACE INTO stats VALUES (?, '
+                    'COALESCE((SELECT value FROM stats WHERE name = ?), 0) '
+                    '+ ?)', (name, name, value))
+        self._changed()
+
+    def close(self):
+        """Commits any outstanding changes and closes the database."""
+        self.conn.commit()
+        self.conn.close()
+
+    def _changed(self):
+        self.pending += 1
+        if self.pending >= self.batch:
+            self.conn.commit()
+            self.pending = 0
+# End of StateIndex class
+
+
+class Journal(object):
+    """An append-only record of the directories a walk has started """ \
+            """and finished, so an interrupted walk can be resumed.
+
+    Each line is a JSON object. Lines are synced to disk in batches; a
+    crash may lose the last few, which only means redoing a little
+    work, and a line cut short part way through is ignored.
+
+    Attributes:
+        path -- file to keep the journal in
+        start_dir -- root directory of the walk being journalled
+        resume -- keep what the journal already holds, rather than
+                  starting a new one
+        readonly -- only read what the journal holds, never writing to
+                    it; used by plans
+
+    >>> import shutil, tempfile
+    >>> tree = tempfile.mkdtemp()
+    >>> path = os.path.join(tree, 'journal.jsonl')
+    >>> journal = Journal(path, '/music')
+    >>> journal.start('/music/a'); journal.start('/music/b')
+    >>> journal.finish('/music/a', 'ok')
+    >>> journal.close()
+    >>> journal = Journal(path, '/music', resume=True)
+    >>> journal.completed('/music/a'), journal.completed('/music/b')
+    (True, False)
+    >>> journal.complete(); journal.close()
+    >>> Journal(path, '/music', resume=True).finished
+    set([])
+
+    A read-only journal leaves the file as it found it:
+
+    >>> before = open(path).read()
+    >>> journal = Journal(path, '/elsewhere', resume=True, readonly=True)
+    >>> journal.start('/elsewhere/a'); journal.complete(); journal.close()
+    >>> open(path).read() == before
+    True
+    >>> shutil.rmtree(tree)
+    """
+
+    # Sync after this many lines.
+    batch = 20
+
+    def __init__(self, path=DEFAULT_JOURNAL, start_dir=os.getcwd(),
+            resume=False, readonly=False):
+        dirname = os.path.dirname(path)
+        if dirname and not readonly and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+
+        self.path = path
+        self.start_dir = os.path.abspath(start_dir)
+        self.finished = set()
+        self.started = set()
+        self.pending = 0
+        self.lock = threading.Lock()
+
+        if resume:
+            self._load()
+        # Nothing on disk changes when we're only looking.
+        if readonly:
+            self.f = None
+        # Start afresh when there's nothing worth keeping.
+        elif self.finished:
+            self.f = open(path, 'a')
+        else:
+            self.f = open(path, 'w')
+            self._write({'state': 'begin', 'start_dir': self.start_dir})
+
+    def _load(self):
+        try:
+            f = open(self.path)
+        except IOError:
+            return
+        with f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Probably the line we were writing when it died.
+                    continue
+                state = entry.get('state')
+                if state == 'begin':
+                    self.finished.clear()
+                    # A journal of some other walk is no use to us.
+                    if entry.get('start_dir') != self.start_dir:
+                        return
+                elif state == 'finished':
+                    # Failures get another go.
+                    if entry.get('outcome') == 'failed':
+                        self.finished.discard(entry.get('directory'))
+                    else:
+                        self.finished.add(entry.get('directory'))
+                elif state == 'complete':
+                    self.finished.clear()
+
+    def completed(self, directory):
+        """Checks whether directory was finished before we resumed."""
+        return os.path.abspath(directory) in self.finished
+
+    def start(self, directory):
+        """Notes that we've started on directory."""
+        directory = os.path.abspath(directory)
+        with self.lock:
+            if directory in self.started:
+                return
+            self.started.add(directory)
+            self._write({'state': 'started', 'directory': directory})
+
+    def finish(self, directory, outcome):
+        """Notes that directory is done with, and how it went."""
+        with self.lock:
+            self._write({'state': 'finished', 'outcome': outcome,
+                    'directory': os.path.abspath(directory)})
+
+    def complete(self):
+        """Notes that the walk got to the end, leaving nothing to """ \
+                """resume."""
+        with self.lock:
+            self._write({'state': 'complete'})
+            self._sync()
+
+    def close(self):
+        """Syncs anything outstanding and closes the journal."""
+        with self.lock:
+            if self.f is not None and not self.f.closed:
+                self._sync()
+                self.f.close()
+
+    def _write(self, entry):
+        if self.f is None:
+            return
+        self.f.write(json.dumps(entry, sort_keys=True) + '\n')
+        self.pending += 1
+        if self.pending >= self.batch:
+            self._sync()
+
+    def _sync(self):
+        if self.f is None:
+            return
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self.pending = 0
+# End of Journal class
+
+
+class Progress(object):
+    """Keeps count of a walk's work as the traversal finds it and as it
+    is done, redrawing a progress bar and writing the counters out for
+    monitoring now and then.
+
+    Attributes:
+        rate -- most times a second to redraw the bar; 0 for none (4)
+        metrics -- file to append the counters to, as JSON lines
+        prometheus -- file to keep the counters in, in Prometheus's text
+                      format, for node_exporter's textfile collector
+        interval -- seconds between writes of the counters (10)
+        length -- width of the bar (20)
+
+    >>> progress = Progress(rate=0)
+    >>> progress.directory(); progress.found(10, 5 * 2 ** 20)
+    >>> progress.resume(3); progress.scanned()
+    >>> progress.done(10, 5 * 2 ** 20); progress.directory_done()
+    >>> c = progress.counters()
+    >>> c['jobs_done'], c['jobs_total'], c['files_done'], c['eta']
+    (4, 4, 10, 0.0)
+    """
+
+    def __init__(self, rate=4, metrics=None, prometheus=None, interval=10,
+            length=20):
+        self.rate = rate
+        self.metrics = metrics
+        self.prometheus = prometheus
+        self.interval = interval
+        self.length = length
+
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.drawn = 0
+        self.written = self.started
+        self.width = 0
+        self.closed = False
+
+        self.scanning = True
+        self.dirs_found = self.dirs_done = 0
+        self.jobs_total = self.jobs_done = self.jobs_resumed = 0
+        self.files_total = self.files_done = 0
+        self.bytes_total = self.bytes_done = 0
+
+    def directory(self):
+        """Counts a directory the traversal found work in."""
+        with self.lock:
+            self.dirs_found += 1
+        self.update()
+
+    def found(self, files, size):
+        """Counts a job the traversal found."""
+        with self.lock:
+            self.jobs_total += 1
+            self.files_total += files
+            self.bytes_total += size
+        self.update()
+
+    def resume(self, jobs):
+        """Counts jobs finished by the walk we're resuming as done."""
+        with self.lock:
+            self.jobs_total += jobs
+            self.jobs_done += jobs
+            self.jobs_resumed += jobs
+
+    def scanned(self):
+        """Notes that the traversal is over, and the totals are final."""
+        with self.lock:
+            self.scanning = False
+        self.update()
+
+    def done(self, files, size):
+        """Counts a finished job."""
+        with self.lock:
+            self.jobs_done += 1
+            self.files_done += files
+            self.bytes_done += size
+        self.update()
+
+    def directory_done(self):
+        """Counts a directory with nothing left to do."""
+        with self.lock:
+            self.dirs_done += 1
+
+    def counters(self):
+        """Returns a dictionary of the counters, and rates worked out """ \
+                """from them."""
+        with self.lock:
+            elapsed = max(time.time() - self.started, 1e-6)
+            done = self.jobs_done - self.jobs_resumed
+            left = self.jobs_total - self.jobs_done
+            return {
+                'time': time.time(), 'elapsed': elapsed,
+                'scanning': self.scanning,
+                'dirs_found': self.dirs_found, 'dirs_done': self.dirs_done,
+                'jobs_total': self.jobs_total, 'jobs_done': self.jobs_done,
+                'files_total': self.files_total,
+                'files_done': self.files_done,
+                'bytes_total': self.bytes_total,
+                'bytes_done': self.bytes_done,
+                'dirs_per_sec': self.dirs_done / elapsed,
+                'files_per_sec': self.files_done / elapsed,
+                'bytes_per_sec': self.bytes_done / elapsed,
+                # Only what's known about so far while still scanning.
+                'eta': left * elapsed / done if done else None,
+                }
+
+    def update(self, force=False, draw=True):
+        """Redraws the bar and writes the counters, if it's time."""
+        now = time.time()
+        draw = draw and self.rate and \
+                (force or now - self.drawn >= 1.0 / self.rate)
+        write = (self.metrics or self.prometheus) and \
+                (force or now - self.written >= self.interval)
+        if not (draw or write):
+            return
+
+        counters = self.counters()
+        if draw:
+            self.drawn = now
+            self.draw(counters)
+        if write:
+            self.written = now
+            self.write(counters)
+
+    def draw(self, c):
+        """Prints the bar, with our rates and how long is left."""
+        total = c['jobs_total']
+        ratio = float(c['jobs_done']) / total if total else 0.0
+        size = int(floor(ratio * self.length))
+        bar = '=' * size + '>' + '-' * (self.length - size)
+        line = '\r{:6.2f}% |{}| {}/{}{} {:.1f} dirs/s {:.1f} files/s ' \
+                '{:.1f} MB/s ETA {}{}'.format(ratio * 100, bar,
+                c['jobs_done'], total, '+' if c['scanning'] else '',
+                c['dirs_per_sec'], c['files_per_sec'],
+                c['bytes_per_sec'] / 2 ** 20,
+                '~' if c['scanning'] else '', _duration(c['eta']))
+        with _output_lock:
+            # Cover up whatever was left of a longer line.
+            print line.ljust(self.width),
+            sys.stdout.flush()
+        self.width = len(line)
+
+    def write(self, c):
+        """Writes the counters to the metrics files."""
+        if self.metrics:
+            with open(self.metrics, 'a') as f:
+                f.write(json.dumps(c, sort_keys=True) + '\n')
+        if self.prometheus:
+            # Write the whole file and move it into place, so nothing
+            # ever reads half of it.
+            tmp = self.prometheus + '.tmp'
+            with open(tmp, 'w') as f:
+                for name, kind, help_ in _METRICS:
+                    value = c[name]
+                    if value is None:
+                        continue
+                    f.write('# HELP mp3gain_{0} {1}\n# TYPE mp3gain_{0} {2}\n'
+                            'mp3gain_{0} {3}\n'.format(name, help_, kind,
+                            float(value)))
+            os.rename(tmp, self.prometheus)
+
+    def close(self, draw=True):
+        """Draws and writes everything one last time."""
+        if not self.closed:
+            self.closed = True
+            self.update(force=True, draw=draw)
+# End of Progress class
+
+
+# The counters we give Prometheus, as (name, type, help).
+_METRICS = (
+        ('elapsed', 'gauge', 'Seconds since the walk started.'),
+        ('scanning', 'gauge', 'Whether the walk is still finding work.'),
+        ('dirs_found', 'gauge', 'Directories found with work to do.'),
+        ('dirs_done', 'gauge', 'Directories finished.'),
+        ('jobs_total', 'gauge', 'Utility runs found so far.'),
+        ('jobs_done', 'gauge', 'Utility runs finished.'),
+        ('files_total', 'gauge', 'Files found so far.'),
+        ('files_done', 'gauge', 'Files processed.'),
+        ('bytes_total', 'gauge', 'Bytes of audio found so far.'),
+        ('bytes_done', 'gauge', 'Bytes of audio processed.'),
+        ('dirs_per_sec', 'gauge', 'Directories finished per second.'),
+        ('files_per_sec', 'gauge', 'Files processed per second.'),
+        ('bytes_per_sec', 'gauge', 'Bytes of audio processed per second.'),
+        ('eta', 'gauge', 'Estimated seconds until the walk is done.'),
+        )
+
+
+def _duration(seconds):
+    """Formats a number of seconds as H:MM:SS.
+
+    >>> _duration(3725.2), _duration(None)
+    ('1:02:05', '?')
+    """
+    if seconds is None:
+        return '?'
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    return '{}:{:02d}:{:02d}'.format(hours, minutes, seconds)
 
-# End of print_progress function
 
 # End of module logic
 
@@ -377,14 +2496,62 @@ class NoMP3Error(Error):
 
 
 class NoExecutableError(Error):
-    """Exception raised when mp3gain utility is not installed on system.
+    """Exception raised when a gain utility is not installed on system.
 
     Attributes:
+        name -- name of the missing utility
     """
 
-    def __init__(self):
+    def __init__(self, name='mp3gain'):
+        Exception.__init__(self)
+        self.name = name
         print '\nException: NoExecutableError:'
-        print 'The mp3gain utility is not installed on this system.'
+        print 'The {} utility is not installed on this system.'.format(name)
+
+
+class TimedOutError(Error):
+    """Exception raised when a utility takes longer than allowed.
+
+    Attributes:
+        dir_ -- directory in which the error occured
+    """
+
+    def __init__(self, dir_):
+        Exception.__init__(self)
+        self.dir_ = dir_
+
+    def __str__(self):
+        return repr(self.dir_)
+
+
+class CancelledError(Error):
+    """Exception raised when a utility is stopped on our request.
+
+    Attributes:
+        dir_ -- directory in which the error occured
+    """
+
+    def __init__(self, dir_):
+        Exception.__init__(self)
+        self.dir_ = dir_
+
+    def __str__(self):
+        return repr(self.dir_)
+
+
+class BackendError(Error):
+    """Exception raised when asked for a gain utility we don't know.
+
+    Attributes:
+        name -- name of the unknown utility
+    """
+
+    def __init__(self, name):
+        Exception.__init__(self)
+        self.name = name
+
+    def __str__(self):
+        return repr(self.name)
 
 # End of customized module Exceptions.
 
@@ -394,16 +2561,130 @@ if __name__ == '__main__':
 
     # TODO: Add other options
     parser = argparse.ArgumentParser(description="Applies ReplayGain \
-            tags to MP3 files, normalizing volume")
+            tags to MP3, AAC, Ogg Vorbis and FLAC files, normalizing volume")
     parser.add_argument('directory', nargs='?',
             help='directory to begin searching')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+            help='number of directories to process at once')
+    parser.add_argument('-f', '--force', action='store_true',
+            help='recalculate every album, ignoring the state index')
+    parser.add_argument('-s', '--skip', action='store_true',
+            help='analyse without reading or writing ReplayGain tags')
+    parser.add_argument('-c', '--clear', action='store_true',
+            help='delete ReplayGain tags')
+    parser.add_argument('-b', '--backend', action='append',
+            dest='backends', choices=sorted(set(backend.name
+            for backend in BACKENDS.itervalues())),
+            help='gain utility to use; may be repeated (default: all)')
+    parser.add_argument('-o', '--report', metavar='FILE',
+            help='append track and album results to FILE as JSON lines')
+    parser.add_argument('-t', '--timeout', type=float, metavar='SECONDS',
+            help='give up on a directory after this long')
+    parser.add_argument('--per-device', type=int, metavar='N',
+            help='run at most N jobs at once on any one device')
+    parser.add_argument('--device', action='append', default=[],
+            metavar='PATH=N', help='run at most N jobs at once on the '
+            'device holding PATH; may be repeated')
+    parser.add_argument('-l', '--largest-first', action='store_true',
+            help='process the largest directories first')
+    parser.add_argument('-p', '--plan', action='store_true',
+            help='only show what would be done, and how long it should take')
+    parser.add_argument('--speed', type=float, metavar='MB/S',
+            help='speed of each job for --plan\'s estimate (default: as '
+            'measured by earlier runs)')
+    parser.add_argument('--shard', metavar='I/N',
+            help='process only the I-th of N shares of the directories, '
+            'so N machines can split the work between them')
+    parser.add_argument('--merge', nargs='+', metavar='REPORT',
+            help='combine the reports of several shards into --report '
+            '(or print them), then quit')
+    parser.add_argument('--progress-rate', type=float, default=4,
+            metavar='N', help='redraw the progress bar at most N times a '
+            'second; 0 to hide it (default: %(default)s)')
+    parser.add_argument('--metrics', metavar='FILE',
+            help='append progress counters to FILE as JSON lines')
+    parser.add_argument('--prometheus', metavar='FILE',
+            help='keep progress counters in FILE for Prometheus')
+    parser.add_argument('--metrics-interval', type=float, default=10,
+            metavar='SECONDS', help='how often to write the counters '
+            '(default: %(default)s)')
+    parser.add_argument('-w', '--watch', action='store_true',
+            help='keep running, and process albums as they change')
+    parser.add_argument('--quiet', type=float, default=30.0,
+            metavar='SECONDS', help='with --watch, how long an album must '
+            'go unchanged before it is processed (default: %(default)s)')
+    parser.add_argument('--poll', type=float, default=60.0,
+            metavar='SECONDS', help='with --watch, how often to scan when '
+            'inotify is unavailable (default: %(default)s)')
+    parser.add_argument('-r', '--resume', action='store_true',
+            help='carry on from where an interrupted run left off')
+    parser.add_argument('--journal', default=DEFAULT_JOURNAL,
+            help='run journal location (default: %(default)s)')
+    parser.add_argument('--index', default=DEFAULT_INDEX,
+            help='state index location (default: %(default)s)')
+    parser.add_argument('--no-index', dest='index', action='store_const',
+            const=None, help='do not use the state index')
+    parser.add_argument('--reset-index', action='store_true',
+            help='forget every album in the state index first')
     parser.add_argument('-v', '--version', action='version',
             version='%(prog)s ' + __version__)
     args = parser.parse_args()
 
+    if args.merge:
+        out = open(args.report, 'w') if args.report else sys.stdout
+        with out:
+            merge_reports(args.merge, out)
+        sys.exit()
+
+    shard = None
+    if args.shard:
+        match = re.match(r'^(\d+)/(\d+)$', args.shard)
+        if not match or not 1 <= int(match.group(1)) <= int(match.group(2)):
+            parser.error('--shard expects I/N, with I from 1 to N, not '
+                    '{!r}'.format(args.shard))
+        shard = int(match.group(1)), int(match.group(2))
+
+    # Each shard keeps an index of its own; reset the one walk() uses.
+    if args.reset_index and args.index:
+        index = StateIndex(_shard_path(args.index, shard) if shard else
+                args.index)
+        index.clear()
+        index.close()
+
+    if args.per_device is not None and args.per_device < 1:
+        parser.error('--per-device expects N of at least 1, not '
+                '{}'.format(args.per_device))
+
+    devices = {}
+    for device in args.device:
+        path, _, limit = device.rpartition('=')
+        if not path or not limit.isdigit() or not int(limit) or \
+                not os.path.exists(path):
+            parser.error('--device expects an existing PATH=N, with N of '
+                    'at least 1, not {!r}'.format(device))
+        devices[path] = int(limit)
+
+    options = {'jobs': args.jobs, 'per_device': args.per_device,
+            'devices': devices, 'largest': args.largest_first,
+            'plan': args.plan, 'shard': shard,
+            'speed': args.speed and args.speed * 2 ** 20,
+            'force': args.force, 'skip': args.skip,
+            'clear': args.clear, 'index': args.index,
+            'backends': args.backends, 'report': args.report,
+            'timeout': args.timeout, 'journal': args.journal,
+            'resume': args.resume, 'rate': args.progress_rate,
+            'metrics': args.metrics, 'prometheus': args.prometheus,
+            'interval': args.metrics_interval}
+
+    if args.watch:
+        options.update(quiet=args.quiet, poll=args.poll)
+        run = watch
+    else:
+        run = walk
+
     if args.directory is not None:
-        walk(args.directory)
+        run(args.directory, **options)
     else:
-        walk()
+        run(**options)
 
 # vim: set ts=4 sts=4 sw=4 et tw=79:
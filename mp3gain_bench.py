@@ -0,0 +1,202 @@
+#!/usr/bin/env python2
+#
+# Copyright (C) 2013 Dylan Steinmetz <dtsteinm@gmail.com>
+# This work is free. You can redistribute it and/or modify it under the
+# terms of the Do What The Fuck You Want To Public License, Version 2,
+# as published by Sam Hocevar. See the COPYING file for more details.
+
+"""Benchmark mp3gain.walk against synthetic libraries, using a """ \
+        """stand-in for the mp3gain utility."""
+import os
+import sys
+import time
+import shutil
+import tempfile as temp
+
+import mp3gain
+
+__all__ = ['build_library', 'install_fake', 'bench']
+__author__ = 'Dylan Steinmetz <dtsteinm@gmail.com>'
+__version__ = '0.1'
+__license__ = 'WTFPL'
+
+# The stand-in utility: prints what 'mp3gain -o' would for each file,
+# after pretending to analyse them for a while.
+FAKE_MP3GAIN = r'''#!/bin/sh
+printf 'File\tMP3 gain\tdB gain\tMax Amplitude\tMax global_gain\tMin global_gain\n'
+for arg in "$@"; do
+    case "$arg" in
+        *.mp3) printf '%s\t-2\t-3.160000\t29871.410000\t211\t97\n' "$arg" ;;
+    esac
+done
+sleep {sleep}
+printf '"Album"\t-3\t-4.110000\t32767.000000\t211\t94\n'
+'''
+
+
+def build_library(root, dirs, files=10, non_mp3=0.1):
+    """Creates a synthetic library of empty files under root.
+
+    Albums are spread over artist directories of 20, the way a real
+    library tends to be laid out.
+
+    Attributes:
+        root -- directory to build the library in
+        dirs -- number of album directories
+        files -- number of tracks in each album
+        non_mp3 -- fraction of albums holding no MP3s at all
+
+    Returns the number of albums containing MP3s.
+    """
+
+    # Spread the non-MP3 albums evenly, rather than all at the end.
+    every = int(round(1 / non_mp3)) if non_mp3 else 0
+    albums = 0
+    for i in xrange(dirs):
+        album = os.path.join(root, 'Artist {:05d}'.format(i // 20),
+                'Album {:06d}'.format(i))
+        os.makedirs(album)
+        if every and i % every == 0:
+            names = ['cover.jpg', 'notes.txt']
+        else:
+            names = ['{:02d} Track {:02d}.mp3'.format(n, n)
+                    for n in xrange(1, files + 1)] + ['cover.jpg']
+            albums += 1
+        for name in names:
+            open(os.path.join(album, name), 'w').close()
+    return albums
+
+
+def install_fake(bindir, sleep=0.0):
+    """Writes the stand-in mp3gain to bindir, and puts it first on """ \
+            """the PATH."""
+    path = os.path.join(bindir, 'mp3gain')
+    with open(path, 'w') as f:
+        f.write(FAKE_MP3GAIN.format(sleep=sleep))
+    os.chmod(path, 0755)
+    os.environ['PATH'] = bindir + os.pathsep + os.getenv('PATH', '')
+    return path
+
+
+def _timed(func, *args, **kwargs):
+    """Returns how long func took, with its output thrown away."""
+    stdout = sys.stdout
+    start = time.time()
+    try:
+        with open(os.devnull, 'w') as sys.stdout:
+            func(*args, **kwargs)
+    finally:
+        sys.stdout = stdout
+    return time.time() - start
+
+
+def bench(dirs, files=10, non_mp3=0.1, sleep=0.0, jobs=(1, 4), root=None):
+    """Runs walk() over a synthetic library in each of its modes.
+
+    Attributes:
+        dirs -- number of album directories
+        files -- number of tracks in each album
+        non_mp3 -- fraction of albums holding no MP3s at all
+        sleep -- seconds the stand-in mp3gain spends on each album
+        jobs -- numbers of parallel jobs to try
+        root -- where to build the library (a temporary directory)
+
+    Returns a list of dictionaries, one for each mode.
+    """
+
+    base = temp.mkdtemp(prefix='mp3gain-bench-', dir=root)
+    try:
+        library = os.path.join(base, 'library')
+        bindir = os.path.join(base, 'bin')
+        os.makedirs(bindir)
+        albums = build_library(library, dirs, files, non_mp3)
+        install_fake(bindir, sleep)
+
+        traversal = _timed(lambda: list(mp3gain._find_albums(library)))
+
+        results = []
+
+        def record(mode, elapsed, processed=0, parallel=1):
+            results.append({
+                'dirs': dirs, 'albums': albums, 'mode': mode,
+                'elapsed': elapsed, 'traversal': traversal,
+                'processing': max(elapsed - traversal, 0.0),
+                'dirs_per_sec': dirs / elapsed if elapsed else 0.0,
+                # Time spent on each album beyond the stand-in's own
+                # sleep: process startup, parsing and bookkeeping.
+                'overhead': (max(elapsed - traversal, 0.0) / processed -
+                    sleep / parallel) if processed else 0.0,
+                })
+
+        for jobs_ in jobs:
+            elapsed = _timed(mp3gain.walk, library, jobs=jobs_, index=None,
+                    journal=None)
+            record('jobs={}'.format(jobs_), elapsed, albums, jobs_)
+
+        # A rescan where the state index says nothing has changed,
+        # which should cost little more than the traversal.
+        index = os.path.join(base, 'index.sqlite')
+        _timed(mp3gain.walk, library, jobs=max(jobs), index=index,
+                journal=None)
+        elapsed = _timed(mp3gain.walk, library, jobs=max(jobs), index=index,
+                journal=None)
+        record('rescan', elapsed)
+
+        # The progress bar, on its own.
+        def progress():
+            progress = mp3gain.Progress()
+            for _ in xrange(albums):
+                progress.found(files, 0)
+            progress.scanned()
+            for _ in xrange(albums):
+                progress.done(files, 0)
+            progress.close()
+        record('progress', _timed(progress))
+
+        return results
+    finally:
+        shutil.rmtree(base, ignore_errors=True)
+
+
+def print_results(results):
+    """Prints benchmark results as a table."""
+    print '{:>8} {:>8} {:>9} {:>9} {:>10} {:>10} {:>9}'.format('dirs',
+            'mode', 'total s', 'walk s', 'process s', 'dirs/s',
+            'spawn ms')
+    for row in results:
+        print '{dirs:>8} {mode:>8} {elapsed:>9.3f} {traversal:>9.3f} ' \
+                '{processing:>10.3f} {dirs_per_sec:>10.0f} ' \
+                '{overhead_ms:>9.2f}'.format(overhead_ms=row['overhead'] *
+                1000, **row)
+
+
+# If we were called from command line...
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Benchmarks \
+            mp3gain.walk over synthetic libraries")
+    parser.add_argument('-d', '--dirs', type=int, nargs='+',
+            default=[1000, 10000, 100000],
+            help='library sizes, in album directories')
+    parser.add_argument('-f', '--files', type=int, default=10,
+            help='tracks in each album')
+    parser.add_argument('-n', '--non-mp3', type=float, default=0.1,
+            help='fraction of albums without MP3s')
+    parser.add_argument('-s', '--sleep', type=float, default=0.0,
+            help='seconds the stand-in mp3gain takes for each album')
+    parser.add_argument('-j', '--jobs', type=int, nargs='+', default=[1, 4],
+            help='numbers of parallel jobs to try')
+    parser.add_argument('-r', '--root',
+            help='where to build the libraries (default: $TMPDIR)')
+    parser.add_argument('-v', '--version', action='version',
+            version='%(prog)s ' + __version__)
+    args = parser.parse_args()
+
+    results = []
+    for dirs in args.dirs:
+        results.extend(bench(dirs, args.files, args.non_mp3, args.sleep,
+                args.jobs, args.root))
+    print_results(results)
+
+# vim: set ts=4 sts=4 sw=4 et tw=79:
@@ -0,0 +1,626 @@
+#!/usr/bin/env python2
+#
+# Copyright (C) 2013 Dylan Steinmetz <dtsteinm@gmail.com>
+# This work is free. You can redistribute it and/or modify it under the
+# terms of the Do What The Fuck You Want To Public License, Version 2,
+# as published by Sam Hocevar. See the COPYING file for more details.
+
+"""Calculate ReplayGain and EBU R128 loudness from PCM audio, """ \
+        """without the help of any external utilities."""
+import wave
+
+import numpy as np
+
+__all__ = ['analyse', 'read_wav', 'read_raw', 'ReplayGain', 'R128']
+__author__ = 'Dylan Steinmetz <dtsteinm@gmail.com>'
+__version__ = '0.1'
+__license__ = 'WTFPL'
+
+# Number of frames read and filtered at a time; memory use is bound by
+# this, rather than by the length of the file.
+CHUNK_FRAMES = 65536
+
+# Equal loudness filter coefficients from the ReplayGain 1.0 reference
+# implementation (gain_analysis.c): a 10th order Yule-Walk filter,
+# followed by a 2nd order Butterworth high-pass at 150 Hz.
+# Each entry is (b, a), leading 1 of a omitted.
+_YULE = {
+    44100: ([0.05418656406430, -0.02911007808948, -0.00848709379851,
+             -0.00851165645469, -0.00834990904936, 0.02245293253339,
+             -0.02596338512915, 0.01624864962975, -0.00240879051584,
+             0.00674613682247, -0.00187763777362],
+            [-3.47845948550071, 6.36317777566148, -8.54751527471874,
+             9.47693607801280, -8.81498681370155, 6.85401540936998,
+             -4.39470996079559, 2.19611684890774, -0.75104302451432,
+             0.13149317958808]),
+    48000: ([0.03857599435200, -0.02160367184185, -0.00123395316851,
+             -0.00009291677959, -0.01655260341619, 0.02161526843274,
+             -0.02074045215285, 0.00594298065125, 0.00306428023191,
+             0.00012025322027, 0.00288463683916],
+            [-3.84664617118067, 7.81501653005538, -11.34170355132042,
+             13.05504219327545, -12.28759895145294, 9.48293806319790,
+             -5.87257861775999, 2.75465861874613, -0.86984376593551,
+             0.13919314567432]),
+    }
+
+
+def analyse(sources, method='replaygain'):
+    """Calculates track and album gain for a list of audio sources.
+
+    Attributes:
+        sources -- (rate, channels, blocks) tuples, as returned by
+                   read_wav() or read_raw(), one for each track
+        method -- 'replaygain' (1.0, as mp3gain does; 44100 and 48000
+                  Hz only) or 'r128' (any sample rate)
+
+    Returns a list of (gain, peak) tuples for each track, followed by a
+    (gain, peak) tuple for the album as a whole. Gains are in dB, and
+    peaks are relative to full scale.
+
+    Example: replaygain.analyse([replaygain.read_wav(path) """ \
+            """for path in paths])
+    """
+
+    if method not in _METHODS:
+        raise MethodError(method)
+
+    analyser = None
+    tracks = []
+    for rate, channels, blocks in sources:
+        # Tracks can only be combined into an album when the filters
+        # and block sizes are the same for each of them.
+        if analyser is None:
+            analyser = _METHODS[method](rate, channels)
+        elif (rate, channels) != (analyser.rate, analyser.channels):
+            raise FormatError('every track in an album must share one '
+                    'sample rate and channel count')
+        for block in blocks:
+            analyser.feed(block)
+        tracks.append(analyser.track())
+
+    if analyser is None:
+        return [], (None, None)
+    return tracks, analyser.album()
+# End of analyse() function
+
+
+def read_wav(source, frames=CHUNK_FRAMES):
+    """Opens an integer PCM WAV file for analysis.
+
+    Attributes:
+        source -- filename or file object
+        frames -- number of frames to read at a time
+
+    Returns (rate, channels, blocks), where blocks generates arrays of
+    floating point samples shaped (frames, channels).
+
+    A 16-bit WAV of a 1 kHz sine at half scale, read in chunks that
+    don't divide it evenly, gets the same gain as the samples do:
+
+    >>> import StringIO
+    >>> wav = StringIO.StringIO()
+    >>> out = wave.open(wav, 'wb')
+    >>> out.setnchannels(2); out.setsampwidth(2); out.setframerate(44100)
+    >>> out.writeframes((_tone(44100, 2, 0.5, 1000, 5) *
+    ...         32768).astype('<i2').tostring())
+    >>> out.close(); wav.seek(0)
+    >>> tracks, album = analyse([read_wav(wav, frames=10000)])
+    >>> print '{0:.2f} {1:.2f}'.format(*album)
+    -8.15 0.50
+    """
+
+    try:
+        wav = wave.open(source, 'rb')
+    except (wave.Error, EOFError) as e:
+        raise FormatError(str(e))
+    rate = wav.getframerate()
+    channels = wav.getnchannels()
+    width = wav.getsampwidth()
+
+    def blocks():
+        try:
+            while True:
+                data = wav.readframes(frames)
+                if not data:
+                    break
+                yield _decode(data, channels, width)
+        finally:
+            wav.close()
+
+    return rate, channels, blocks()
+
+
+def read_raw(source, rate, channels, width=2, frames=CHUNK_FRAMES):
+    """Opens a stream of raw, little-endian, signed PCM for analysis, """ \
+            """such as the output of 'mpg123 -s'.
+
+    Attributes:
+        source -- file object to read from
+        rate -- sample rate in Hz
+        channels -- number of interleaved channels
+        width -- bytes per sample (2)
+        frames -- number of frames to read at a time
+
+    Returns (rate, channels, blocks), just like read_wav().
+
+    A pipe that hands over a frame and a bit at a time gives the same
+    gain as the WAV file in read_wav():
+
+    >>> import StringIO
+    >>> class Pipe(object):
+    ...     def __init__(self, data):
+    ...         self.data = StringIO.StringIO(data)
+    ...     def read(self, size):
+    ...         return self.data.read(min(size, 4099))
+    >>> pcm = (_tone(44100, 2, 0.5, 1000, 5) * 32768).astype('<i2')
+    >>> tracks, album = analyse([read_raw(Pipe(pcm.tostring()), 44100,
+    ...         2)])
+    >>> print '{0:.2f} {1:.2f}'.format(*album)
+    -8.15 0.50
+    """
+
+    size = frames * channels * width
+
+    def blocks():
+        leftover = ''
+        while True:
+            data = source.read(size)
+            if not data:
+                break
+            # Pipes can hand us partial frames; keep them for later.
+            data = leftover + data
+            whole = len(data) - len(data) % (channels * width)
+            leftover = data[whole:]
+            if whole:
+                yield _decode(data[:whole], channels, width)
+
+    return rate, channels, blocks()
+
+
+def _decode(data, channels, width):
+    """Converts interleaved PCM bytes to floats in [-1.0, 1.0).
+
+    >>> _decode(np.array([0, 16384, -32768, 32767], '<i2').tostring(),
+    ...         2, 2)
+    array([[ 0.        ,  0.5       ],
+           [-1.        ,  0.99996948]])
+    """
+
+    if width == 1:
+        # 8-bit WAV is the odd one out, and is unsigned.
+        samples = np.frombuffer(data, np.uint8).astype(np.float64) - 128
+    elif width == 3:
+        raw = np.frombuffer(data, np.uint8).reshape(-1, 3).astype(np.int32)
+        samples = raw[:, 0] | (raw[:, 1] << 8) | (raw[:, 2] << 16)
+        samples = np.where(samples & 0x800000, samples - 0x1000000,
+                samples).astype(np.float64)
+    elif width in (2, 4):
+        samples = np.frombuffer(data, '<i%d' % width).astype(np.float64)
+    else:
+        raise FormatError('unsupported sample width: {}'.format(width))
+    return samples.reshape(-1, channels) / float(1 << (8 * width - 1))
+
+
+class _Filter(object):
+    """IIR filter applied to a block of samples at once.
+
+    Running a recursive filter one sample at a time is far too slow in
+    Python, so the filter is written in state space form instead. Each
+    block's output is then the block convolved with the impulse
+    response (done with FFTs), plus the response to the state left by
+    the previous block; both are exact, not approximations.
+
+    Attributes:
+        b, a -- transfer function coefficients; a[0] must be 1
+        channels -- number of independent channels to filter
+        block -- largest number of frames filtered at once
+    """
+
+    def __init__(self, b, a, channels, block=4096):
+        order = max(len(a), len(b)) - 1
+        b = np.pad(np.asarray(b, np.float64), (0, order + 1 - len(b)),
+                'constant')
+        a = np.pad(np.asarray(a, np.float64), (0, order + 1 - len(a)),
+                'constant')
+
+        # Controllable canonical form: s' = A s + B x, y = C s + D x.
+        self.A = np.eye(order, k=-1)
+        self.A[0] = -a[1:]
+        C = b[1:] - b[0] * a[1:]
+
+        # powers[m] = A^m B, and response[m] = C A^m, for each m.
+        powers = np.zeros((block, order))
+        response = np.zeros((block, order))
+        powers[0, 0] = 1.0
+        response[0] = C
+        for m in xrange(1, block):
+            powers[m] = self.A.dot(powers[m - 1])
+            response[m] = response[m - 1].dot(self.A)
+
+        impulse = np.empty(block)
+        impulse[0] = b[0]
+        impulse[1:] = powers[:-1].dot(C)
+
+        self.block = block
+        self.powers = powers
+        self.response = response
+        self.nfft = 2 * block
+        self.spectrum = np.fft.rfft(impulse, self.nfft)
+        self.step = np.linalg.matrix_power(self.A, block)
+        self.state = np.zeros((order, channels))
+
+    def __call__(self, samples):
+        """Filters samples shaped (frames, channels), carrying the """ \
+                """filter state over to the next call."""
+
+        out = np.empty_like(samples)
+        for start in xrange(0, len(samples), self.block):
+            x = samples[start:start + self.block]
+            n = len(x)
+
+            # Response to this block alone (transposed, so each
+            # channel's FFT runs over contiguous memory)...
+            y = np.fft.irfft(np.fft.rfft(x.T, self.nfft) * self.spectrum,
+                    self.nfft)[:, :n].T
+            # ... and to whatever was left ringing from the last one.
+            y += self.response[:n].dot(self.state)
+            out[start:start + n] = y
+
+            step = self.step if n == self.block else \
+                    np.linalg.matrix_power(self.A, n)
+            self.state = step.dot(self.state) + \
+                    self.powers[n - 1::-1].T.dot(x)
+        return out
+
+
+def _cascade(*stages, **kwargs):
+    """Combines several (b, a) filter stages into a single _Filter."""
+    b, a = [1.0], [1.0]
+    for stage_b, stage_a in stages:
+        b = np.convolve(b, stage_b)
+        a = np.convolve(a, stage_a)
+    return _Filter(b, a, **kwargs)
+
+
+class ReplayGain(object):
+    """ReplayGain 1.0 analysis, as performed by mp3gain.
+
+    Samples are run through an equal loudness filter, and the loudness
+    of each 50ms window is collected in a histogram with 0.01 dB steps.
+    The level 5% of the way down from the loudest window is compared to
+    the level of the reference pink noise to give the gain.
+
+    Attributes:
+        rate -- sample rate; 44100 or 48000 Hz
+        channels -- number of channels
+
+    The reference implementation has equal loudness filters for other
+    rates too, but only these two are carried here. Audio at any other
+    rate, such as a 32 kHz or 22.05 kHz MP3, has to be resampled when
+    it's decoded ('mpg123 -r 44100'), or measured with R128 instead:
+
+    >>> ReplayGain(32000, 2)
+    Traceback (most recent call last):
+    FormatError: ReplayGain needs 44100 or 48000 Hz audio, not 32000
+
+    Pink noise at -14 dBFS RMS is the reference level, and needs no
+    gain; halving a tone's amplitude raises its gain by 6.02 dB:
+
+    >>> rg = ReplayGain(44100, 2)
+    >>> rg.feed(_pink(44100, 2, 10 ** (-14 / 20.0), 30))
+    >>> abs(rg.track()[0]) < 0.5
+    True
+    >>> rg.feed(_tone(44100, 2, 0.5, 1000, 5))
+    >>> print '{0:.2f} {1:.2f}'.format(*rg.track())
+    -8.15 0.50
+    >>> rg.feed(_tone(44100, 2, 0.25, 1000, 5))
+    >>> print '{0:.2f} {1:.2f}'.format(*rg.track())
+    -2.13 0.25
+    """
+
+    # Loudness of the reference pink noise, in dB.
+    reference = 64.82
+    window = 0.050
+    steps_per_db = 100
+    max_db = 120
+    percentile = 0.95
+
+    def __init__(self, rate, channels):
+        if rate not in _YULE:
+            raise FormatError('ReplayGain needs 44100 or 48000 Hz audio, '
+                    'not {}'.format(rate))
+        self.rate = rate
+        self.channels = channels
+
+        # Both stages run as one filter, which halves the FFTs needed.
+        b, a = _YULE[rate]
+        self.filter = _cascade((b, [1.0] + a),
+                _highpass(150.0, rate, 0.5 ** 0.5), channels=channels)
+
+        self.size = int(np.ceil(rate * self.window))
+        self.bins = self.steps_per_db * self.max_db
+        self.album_hist = np.zeros(self.bins, np.int64)
+        self.album_peak = 0.0
+        self._reset()
+
+    def _reset(self):
+        self.hist = np.zeros(self.bins, np.int64)
+        self.peak = 0.0
+        self.leftover = np.zeros(0)
+
+    def feed(self, samples):
+        """Adds a block of samples, shaped (frames, channels), to the """ \
+                """current track."""
+
+        if not len(samples):
+            return
+        self.peak = max(self.peak, np.abs(samples).max())
+
+        # The reference implementation works on 16-bit sample values.
+        filtered = self.filter(samples * 32768.0)
+        power = np.concatenate((self.leftover,
+                (filtered ** 2).mean(axis=1)))
+
+        # Only whole windows count; save the rest for the next block.
+        whole = len(power) - len(power) % self.size
+        self.leftover = power[whole:]
+        windows = power[:whole].reshape(-1, self.size).mean(axis=1)
+
+        levels = self.steps_per_db * 10 * np.log10(windows + 1e-37)
+        levels = np.clip(levels.astype(np.int64), 0, self.bins - 1)
+        self.hist += np.bincount(levels, minlength=self.bins)
+
+    def track(self):
+        """Finishes the current track, returning its (gain, peak)."""
+        result = self._gain(self.hist), self.peak
+        self.album_hist += self.hist
+        self.album_peak = max(self.album_peak, self.peak)
+        self._reset()
+        return result
+
+    def album(self):
+        """Returns (gain, peak) for every track finished so far."""
+        return self._gain(self.album_hist), self.album_peak
+
+    def _gain(self, hist):
+        total = hist.sum()
+        if not total:
+            return None
+        # Walk down from the loudest window until we've passed 5% of
+        # them.
+        upper = int(np.ceil(total * (1 - self.percentile)))
+        index = np.searchsorted(np.cumsum(hist[::-1]), upper)
+        level = self.bins - 1 - index
+        return self.reference - level / float(self.steps_per_db)
+
+
+class R128(object):
+    """EBU R128 (ITU-R BS.1770) integrated loudness, reported as """ \
+            """a ReplayGain 2.0 gain relative to -18 LUFS.
+
+    Samples are K-weighted, and the loudness of overlapping 400ms
+    blocks is gated twice: once at -70 LUFS to drop silence, then 10 LU
+    below the loudness of what's left.
+
+    Attributes:
+        rate -- sample rate in Hz
+        channels -- number of channels; five or more are taken to be
+                    L, R, C, LFE, Ls, Rs
+
+    EBU Tech 3341 test signals; stereo 1 kHz sines at -23 dBFS, then
+    at -33 dBFS, then -36/-23/-36 dBFS for 10/60/10 seconds:
+
+    >>> r128 = R128(48000, 2)
+    >>> r128.feed(_tone(48000, 2, 10 ** (-23 / 20.0), 1000, 20))
+    >>> print '{0:.1f}'.format(-18 - r128.track()[0])
+    -23.0
+    >>> r128.feed(_tone(48000, 2, 10 ** (-33 / 20.0), 1000, 20))
+    >>> print '{0:.1f}'.format(-18 - r128.track()[0])
+    -33.0
+    >>> for level, seconds in ((-36, 10), (-23, 60), (-36, 10)):
+    ...     r128.feed(_tone(48000, 2, 10 ** (level / 20.0), 1000, seconds))
+    >>> print '{0:.1f}'.format(-18 - r128.track()[0])
+    -23.0
+    """
+
+    target = -18.0
+    block = 0.400
+    overlap = 4
+    absolute_gate = -70.0
+    relative_gate = -10.0
+
+    def __init__(self, rate, channels):
+        self.rate = rate
+        self.channels = channels
+
+        # K-weighting: a high shelf for the head, and the RLB high-pass.
+        # BS.1770 leaves the RLB filter's numerator unnormalised.
+        a = _highpass(38.13547087602444, rate, 0.5003270373238773)[1]
+        self.filter = _cascade(_highshelf(rate), ([1.0, -2.0, 1.0], a),
+                channels=channels)
+
+        self.weights = np.ones(channels)
+        if channels >= 5:
+            self.weights[3] = 0.0
+            self.weights[4:6] = 1.41
+
+        self.size = int(round(rate * self.block / self.overlap))
+        self.album_blocks = []
+        self.album_peak = 0.0
+        self._reset()
+
+    def _reset(self):
+        self.blocks = []
+        self.peak = 0.0
+        self.leftover = np.zeros((0, self.channels))
+        # The last few sub-blocks, which start the next gating block.
+        self.recent = np.zeros((0, self.channels))
+
+    def feed(self, samples):
+        """Adds a block of samples, shaped (frames, channels), to the """ \
+                """current track."""
+
+        if not len(samples):
+            return
+        self.peak = max(self.peak, np.abs(samples).max())
+
+        power = np.concatenate((self.leftover,
+                self.filter(samples) ** 2))
+        whole = len(power) - len(power) % self.size
+        self.leftover = power[whole:]
+
+        # Mean square of each 100ms sub-block; every run of four is
+        # one gating block.
+        subs = np.concatenate((self.recent, power[:whole].reshape(
+                -1, self.size, self.channels).mean(axis=1)))
+        if len(subs) >= self.overlap:
+            sums = np.cumsum(np.vstack((np.zeros((1, self.channels)),
+                    subs)), axis=0)
+            means = (sums[self.overlap:] - sums[:-self.overlap]) / \
+                    self.overlap
+            self.blocks.append(means.dot(self.weights))
+        self.recent = subs[-(self.overlap - 1):]
+
+    def track(self):
+        """Finishes the current track, returning its (gain, peak)."""
+        blocks = np.concatenate(self.blocks) if self.blocks else \
+                np.zeros(0)
+        result = self._gain(blocks), self.peak
+        self.album_blocks.append(blocks)
+        self.album_peak = max(self.album_peak, self.peak)
+        self._reset()
+        return result
+
+    def album(self):
+        """Returns (gain, peak) for every track finished so far."""
+        return self._gain(np.concatenate(self.album_blocks)), \
+                self.album_peak
+
+    def _gain(self, blocks):
+        blocks = blocks[_lufs(blocks) > self.absolute_gate]
+        if not len(blocks):
+            return None
+        threshold = _lufs(blocks.mean()) + self.relative_gate
+        blocks = blocks[_lufs(blocks) > threshold]
+        return self.target - _lufs(blocks.mean())
+
+
+_METHODS = {'replaygain': ReplayGain, 'r128': R128}
+
+
+def _lufs(power):
+    """Converts weighted mean square power to loudness units."""
+    return -0.691 + 10 * np.log10(np.maximum(power, 1e-37))
+
+
+def _highpass(freq, rate, q):
+    """Returns (b, a) for a 2nd order high-pass filter."""
+    k = np.tan(np.pi * freq / rate)
+    a0 = 1 + k / q + k * k
+    return ([1 / a0, -2 / a0, 1 / a0],
+            [1.0, 2 * (k * k - 1) / a0, (1 - k / q + k * k) / a0])
+
+
+def _highshelf(rate):
+    """Returns (b, a) for the BS.1770 pre-filter, at any sample rate."""
+    k = np.tan(np.pi * 1681.974450955533 / rate)
+    q = 0.7071752369554196
+    vh = 10 ** (3.999843853973347 / 20)
+    vb = vh ** 0.4996667741545416
+    a0 = 1 + k / q + k * k
+    return ([(vh + vb * k / q + k * k) / a0, 2 * (k * k - vh) / a0,
+            (vh - vb * k / q + k * k) / a0],
+            [1.0, 2 * (k * k - 1) / a0, (1 - k / q + k * k) / a0])
+
+
+def _tone(rate, channels, amplitude, freq, seconds):
+    """Generates a sine wave for testing, shaped (frames, channels)."""
+    t = np.arange(int(rate * seconds)) / float(rate)
+    wave_ = amplitude * np.sin(2 * np.pi * freq * t)
+    return np.repeat(wave_[:, np.newaxis], channels, axis=1)
+
+
+def _pink(rate, channels, rms, seconds, seed=0):
+    """Generates pink noise for testing, shaped (frames, channels)."""
+    frames = int(rate * seconds)
+    spectrum = np.fft.rfft(np.random.RandomState(seed).randn(frames))
+    spectrum[1:] /= np.sqrt(np.arange(1, len(spectrum)))
+    noise = np.fft.irfft(spectrum, frames)
+    noise *= rms / np.sqrt((noise ** 2).mean())
+    return np.repeat(noise[:, np.newaxis], channels, axis=1)
+
+
+# Begin customized module Exceptions.
+class Error(Exception):
+    """Base class for exceptions caused by methods in """ \
+            """the replaygain module.
+    """
+    pass
+
+
+class FormatError(Error):
+    """Exception raised for audio that can't be analysed.
+
+    Attributes:
+        reason -- what was wrong with the audio
+    """
+
+    def __init__(self, reason):
+        Exception.__init__(self)
+        self.reason = reason
+
+    def __str__(self):
+        return self.reason
+
+
+class MethodError(Error):
+    """Exception raised for an unknown analysis method.
+
+    Attributes:
+        method -- method which caused the error
+    """
+
+    def __init__(self, method):
+        Exception.__init__(self)
+        self.method = method
+
+    def __str__(self):
+        return repr(self.method)
+
+
+# If we were called from command line...
+if __name__ == '__main__':
+    import argparse
+    import sys
+
+    parser = argparse.ArgumentParser(description="Calculates track and \
+            album gain for WAV files, or raw PCM on standard input")
+    parser.add_argument('files', nargs='*', help='WAV files of one album')
+    parser.add_argument('-m', '--method', default='replaygain',
+            choices=sorted(_METHODS), help='loudness algorithm')
+    parser.add_argument('-r', '--raw', metavar='RATE:CHANNELS[:WIDTH]',
+            help='read one track of raw PCM from standard input')
+    parser.add_argument('-v', '--version', action='version',
+            version='%(prog)s ' + __version__)
+    args = parser.parse_args()
+
+    if args.raw:
+        names = ['-']
+        sources = [read_raw(sys.stdin, *[int(field) for field in
+                args.raw.split(':')])]
+    else:
+        names = args.files
+        sources = (read_wav(name) for name in names)
+
+    try:
+        tracks, album = analyse(sources, args.method)
+    except Error as e:
+        sys.exit('Error: {}'.format(e))
+
+    # Same layout as 'mp3gain -o', minus the columns we don't have.
+    print 'File\tdB gain\tMax Amplitude'
+    for name, (gain, peak) in zip(names, tracks):
+        print '{}\t{:.2f}\t{:.6f}'.format(name, gain or 0.0, peak)
+    print '"Album"\t{:.2f}\t{:.6f}'.format(album[0] or 0.0, album[1] or 0.0)
+
+# vim: set ts=4 sts=4 sw=4 et tw=79: